@@ -5,7 +5,7 @@
 """
 
 from .query import Database
-from .reader import File, Template, get_templates, read_annotations
+from .reader import File, LazyFile, Template, Comparisons, get_templates, read_annotations
 
 
 def get_config():
@@ -31,7 +31,9 @@ def __appropriate__(*args):
 __appropriate__(
     Database,
     File,
+    LazyFile,
     Template,
+    Comparisons,
     get_templates,
     read_annotations,
     )
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Benchmarks of the loading and query paths of the IJB-A database.
+
+As the original file lists are not distributed, the benchmarks run on
+synthetic file lists with the layout and the approximate size of the IJB-A
+protocols, see :py:func:`generate`.  The ``scale`` multiplies the number of
+templates of each file list, so that the behavior on larger databases can be
+measured as well.
+
+For each operation, the wall time and the peak memory allocated by Python (as
+reported by :py:mod:`tracemalloc`) are measured, see :py:func:`run`.  The
+results can be stored as JSON and compared with a baseline, see
+:py:func:`compare`.  The ``benchmark`` command of ``bob_dbmanage.py ijba``
+provides a command line interface.
+"""
+
+import os
+import time
+import shutil
+import logging
+import tracemalloc
+
+import numpy
+
+logger = logging.getLogger("bob.db.ijba")
+
+#: The header of the file lists
+HEADER = "TEMPLATE_ID,SUBJECT_ID,FILE,MEDIA_ID,SIGHTING_ID,FRAME,FACE_X,FACE_Y,FACE_WIDTH,FACE_HEIGHT,RIGHT_EYE_X,RIGHT_EYE_Y,LEFT_EYE_X,LEFT_EYE_Y,NOSE_BASE_X,NOSE_BASE_Y,FACE_YAW,FOREHEAD_VISIBLE,EYES_VISIBLE,NOSE_MOUTH_VISIBLE,INDOOR,GENDER,SKIN_TONE,AGE,FACIAL_HAIR\n"
+
+#: The approximate number of templates of the file lists of one split of IJB-A, which are multiplied by the ``scale``
+TEMPLATES = {
+  'train'    : 1750,
+  'gallery'  : 112,
+  'probe'    : 1760,
+  'metadata' : 1760,
+}
+
+#: The number of comparisons of one split of IJB-A, which is multiplied by the ``scale``
+COMPARISONS = 11750
+
+
+def _write_file_list(filename, random, templates, first_template, subjects):
+  """Writes a synthetic file list with the given number of templates, with ids starting at ``first_template``, for the given subject ids"""
+
+  # 1 to 20 files per template, about 10 on average
+  counts = random.randint(1, 20, size=templates)
+  rows = int(counts.sum())
+  template_ids = numpy.repeat(numpy.arange(first_template, first_template + templates), counts)
+  subject_ids = numpy.repeat(random.choice(subjects, size=templates), counts)
+  media_ids = random.randint(1, 30000 * max(1, templates // 1000), size=rows)
+  video = random.random_sample(rows) < 0.6
+  frames = random.randint(1, 30000, size=rows)
+  sightings = random.randint(0, 4, size=rows)
+  values = random.uniform(0, 500, size=(rows, 11))
+  # the eyes, nose and yaw are missing for some of the files
+  missing = random.random_sample((rows, 7)) < 0.2
+  categories = numpy.stack([random.randint(0, 2, size=rows) for _ in range(5)] + [random.randint(1, 7, size=rows), random.randint(1, 5, size=rows), random.randint(0, 4, size=rows)], axis=1)
+
+  with open(filename, "w") as f:
+    f.write(HEADER)
+    for i in range(rows):
+      if video[i]:
+        path, frame = "frame/%d_%05d.png" % (media_ids[i], frames[i]), "%d" % frames[i]
+      else:
+        path, frame = "img/%d.jpg" % media_ids[i], ""
+      points = ["" if missing[i, j] else "%.2f" % values[i, 4 + j] for j in range(7)]
+      f.write("%d,%d,%s,%d,%d,%s,%.1f,%.1f,%.1f,%.1f,%s,%s\n" % (
+          template_ids[i], subject_ids[i], path, media_ids[i], sightings[i], frame,
+          values[i, 0], values[i, 1], values[i, 2], values[i, 3],
+          ",".join(points), ",".join("%d" % c for c in categories[i])))
+
+  return first_template + templates
+
+
+def generate(directory, scale=1, splits=10, seed=0):
+  """Generates synthetic file lists with the layout of the IJB-A annotations directory.
+
+  Keyword Parameters:
+
+  directory : str
+    The annotations directory to write, which can be passed as ``annotations_directory`` to :py:class:`bob.db.ijba.Database`.
+
+  scale : float
+    The factor for the number of templates of each file list, where ``1`` is the approximate size of IJB-A.
+
+  splits : int
+    The number of splits with file lists of the given ``scale``.
+    The file lists of the remaining splits contain a single template each, so that all protocols can be opened.
+
+  seed : int
+    The seed of the random number generator, so that the generated file lists are reproducible.
+
+  Returns: the ``directory``.
+  """
+
+  random = numpy.random.RandomState(seed)
+  sizes = dict((k, max(1, int(round(v * scale)))) for k, v in TEMPLATES.items())
+  subjects = numpy.arange(1, max(2, int(round(500 * scale))) + 1)
+
+  for split in range(1, 11):
+    search = os.path.join(directory, "IJB-A_1N_sets", "split%d" % split)
+    compare = os.path.join(directory, "IJB-A_11_sets", "split%d" % split)
+    for d in (search, compare):
+      if not os.path.isdir(d):
+        os.makedirs(d)
+
+    # two thirds of the subjects are used for training, the others for evaluation
+    order = random.permutation(subjects)
+    train, dev = order[:len(order) * 2 // 3], order[len(order) * 2 // 3:]
+
+    current = sizes if split <= splits else dict((k, 1) for k in sizes)
+    template_id = split * 10 * sum(sizes.values())
+    train_file = os.path.join(search, "train_%d.csv" % split)
+    template_id = _write_file_list(train_file, random, current['train'], template_id, train)
+    shutil.copyfile(train_file, os.path.join(compare, "train_%d.csv" % split))
+
+    template_id = _write_file_list(os.path.join(search, "search_gallery_%d.csv" % split), random, current['gallery'], template_id, dev)
+    template_id = _write_file_list(os.path.join(search, "search_probe_%d.csv" % split), random, current['probe'], template_id, dev)
+
+    first = template_id
+    template_id = _write_file_list(os.path.join(compare, "verify_metadata_%d.csv" % split), random, current['metadata'], template_id, dev)
+    comparisons = random.randint(first, template_id, size=(max(1, int(round(COMPARISONS * scale))) if split <= splits else 1, 2))
+    numpy.savetxt(os.path.join(compare, "verify_comparisons_%d.csv" % split), comparisons, fmt="%d", delimiter=",")
+
+  return directory
+
+
+def measure(function, setup=None, repeat=3):
+  """Measures the wall time and the peak memory of the given function.
+
+  Keyword Parameters:
+
+  function : callable
+    The function to measure, which gets the result of ``setup`` as its only parameter (if ``setup`` is given).
+
+  setup : callable or ``None``
+    A function without parameters that prepares the measurement, e.g., creates a fresh database; it is not measured.
+
+  repeat : int
+    The number of repetitions; the fastest of them is reported.
+
+  Returns: a dictionary with the ``seconds`` of the fastest run, and the ``peak_bytes`` allocated by Python during a separate run.
+  """
+
+  def _call():
+    if setup is None:
+      return function
+    state = setup()
+    return lambda: function(state)
+
+  times = []
+  for _ in range(repeat):
+    call = _call()
+    start = time.perf_counter()
+    call()
+    times.append(time.perf_counter() - start)
+
+  # tracemalloc slows down the execution, so the memory is measured in a separate run
+  call = _call()
+  tracemalloc.start()
+  try:
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+  return {'seconds' : min(times), 'peak_bytes' : peak}
+
+
+def operations(directory):
+  """Returns the benchmarked operations on the file lists inside the given annotations ``directory``
+
+  Returns: a list of ``(name, function, setup)`` tuples, see :py:func:`measure`.
+  """
+
+  from .query import Database
+  from .reader import get_templates, read_annotations, read_columns, read_file
+
+  protocol = 'search_split1'
+  train = os.path.join(directory, "IJB-A_1N_sets", "split1", "train_1.csv")
+  cache_directory = os.path.join(directory, "cache")
+  with open(train) as f:
+    raw = [line.rstrip("\n").split(",")[6:] for line in f.readlines()[1:]]
+
+  def _database(cached=False):
+    return Database(annotations_directory=directory, cache_directory=cache_directory if cached else False)
+
+  def _loaded():
+    db = _database()
+    db.objects(protocol=protocol)
+    return db
+
+  def _model_id():
+    db = _database(True)
+    return db, db.model_ids(protocol=protocol)[0]
+
+  # compile the cache of all protocols, which is used by the cached operations
+  _database(True).compile()
+
+  return [
+    ('read_columns',          lambda: read_columns(train), None),
+    ('read_file',             lambda: list(read_file(train)), None),
+    ('get_templates',         lambda: get_templates(train, verbose=False, cache_directory=False), None),
+    ('read_annotations',      lambda: [read_annotations(r) for r in raw], None),
+    ('load_data',             lambda db: db._load_data(protocol, "world", "train"), _database),
+    ('load_data_compiled',    lambda db: db._load_data(protocol, "world", "train"), lambda: _database(True)),
+    ('objects',               lambda db: db.objects(protocol=protocol), _loaded),
+    ('annotations',           lambda db: [f.annotations for f in db.objects(protocol=protocol, groups='world')], _loaded),
+    ('object_sets',           lambda db: db.object_sets(protocol=protocol, purposes=('enroll', 'probe')), _loaded),
+    ('client_ids',            lambda db: db.client_ids(protocol=protocol), _loaded),
+    ('get_client_id_from_model_id', lambda state: state[0].get_client_id_from_model_id(state[1]), _model_id),
+  ]
+
+
+def run(scales=(1,), repeat=3, directory=None, names=None):
+  """Runs the benchmarks on synthetic file lists of the given scales.
+
+  Keyword Parameters:
+
+  scales : [float]
+    The scales of the synthetic file lists, see :py:func:`generate`.
+
+  repeat : int
+    The number of repetitions of each operation, see :py:func:`measure`.
+
+  directory : str or ``None``
+    The directory, where the synthetic file lists are stored, so that they can be reused by later runs.
+    If not given, a temporary directory is used, which is deleted afterwards.
+
+  names : [str] or ``None``
+    If given, only the operations with these names are run.
+
+  Returns: a dictionary from ``"<scale>x/<operation>"`` to the result of :py:func:`measure`.
+  """
+
+  import tempfile
+  temporary = directory is None
+  if temporary:
+    directory = tempfile.mkdtemp(prefix="bob.db.ijba-benchmark-")
+
+  results = {}
+  try:
+    for scale in scales:
+      data = os.path.join(directory, "scale%g" % scale)
+      if not os.path.exists(os.path.join(data, "IJB-A_11_sets", "split10", "verify_comparisons_10.csv")):
+        logger.info("Generating file lists of scale %g in '%s'", scale, data)
+        generate(data, scale, splits=1)
+
+      for name, function, setup in operations(data):
+        if names is not None and name not in names:
+          continue
+        key = "%gx/%s" % (scale, name)
+        results[key] = measure(function, setup, repeat)
+        logger.info("%s: %.4f s, %.1f MB", key, results[key]['seconds'], results[key]['peak_bytes'] / 1e6)
+  finally:
+    if temporary:
+      shutil.rmtree(directory)
+
+  return results
+
+
+def compare(results, baseline, tolerance=0.2):
+  """Compares benchmark results with a baseline.
+
+  Keyword Parameters:
+
+  results, baseline : dict
+    The results of :py:func:`run`, e.g., as stored in JSON files.
+
+  tolerance : float
+    The relative increase of the time or the memory of an operation that is tolerated.
+
+  Returns: a list of ``(operation, metric, baseline, result)`` tuples, one for each metric that increased by more than the ``tolerance``.
+  Operations that are not contained in both dictionaries are ignored.
+  """
+
+  regressions = []
+  for key in sorted(set(results) & set(baseline)):
+    for metric in ('seconds', 'peak_bytes'):
+      old, new = baseline[key][metric], results[key][metric]
+      if new > old * (1. + tolerance):
+        regressions.append((key, metric, old, new))
+  return regressions
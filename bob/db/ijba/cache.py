@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Compiled on-disk cache of the parsed IJB-A file lists.
+
+Parsing the original CSV file lists is the main cost of opening the database.
+The parsed columns are, hence, stored as uncompressed ``.npz`` files in a cache
+directory, keyed by the absolute path of the CSV file.  Each compiled file
+records the modification time and the size of its source, so that it is
+rebuilt automatically whenever the source file list changes.
+"""
+
+import os
+import hashlib
+import logging
+import tempfile
+
+import numpy
+
+logger = logging.getLogger("bob.db.ijba")
+
+#: The version of the compiled layout; increase it whenever the parsers change
+CACHE_VERSION = 3
+
+#: The environment variable that can be used to set the default cache directory
+CACHE_DIRECTORY_VARIABLE = "BOB_DB_IJBA_CACHE_DIRECTORY"
+
+
+def default_cache_directory():
+  """Returns the default directory of the compiled cache, which is either taken from the ``BOB_DB_IJBA_CACHE_DIRECTORY`` environment variable, or ``~/.cache/bob.db.ijba``"""
+  return os.environ.get(CACHE_DIRECTORY_VARIABLE, os.path.join(os.path.expanduser("~"), ".cache", "bob.db.ijba"))
+
+
+def signature(filename):
+  """Returns the signature of the given source file, i.e., the cache version, its modification time and its size"""
+  stat = os.stat(filename)
+  return numpy.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype=numpy.int64)
+
+
+def digest(filename):
+  """Returns the size and the SHA-1 digest of the content of the given file as a string, which is identical for identical files"""
+  sha1 = hashlib.sha1()
+  with open(filename, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      sha1.update(block)
+  return "%d-%s" % (os.path.getsize(filename), sha1.hexdigest())
+
+
+def compiled_filename(filename, cache_directory):
+  """Returns the name of the compiled file for the given source file inside the ``cache_directory``"""
+  filename = os.path.abspath(filename)
+  key = hashlib.sha1(filename.encode("utf-8")).hexdigest()[:16]
+  return os.path.join(cache_directory, "%s-%s.npz" % (os.path.splitext(os.path.basename(filename))[0], key))
+
+
+def read(compiled, expected_signature):
+  """Reads the columns from the given compiled file.
+
+  Returns ``None`` if the compiled file does not exist, cannot be read, or if it was compiled from a different version of the source file.
+  """
+  if not os.path.exists(compiled):
+    return None
+  try:
+    with numpy.load(compiled, allow_pickle=False) as data:
+      if not numpy.array_equal(data["__signature__"], expected_signature):
+        return None
+      return dict((key, data[key]) for key in data.files if key != "__signature__")
+  except (IOError, OSError, ValueError, KeyError) as e:
+    logger.warning("Ignoring unreadable compiled file '%s': %s", compiled, e)
+    return None
+
+
+def write(compiled, columns, source_signature):
+  """Writes the given columns atomically into the compiled file, so that concurrent jobs never see partially written files.
+
+  Returns ``False`` if the file could not be written, e.g., since the cache directory is read-only.
+  """
+  directory = os.path.dirname(compiled)
+  try:
+    # several jobs might create the directory at once
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(suffix=".npz", dir=directory)
+  except OSError as e:
+    logger.warning("Cannot write compiled file '%s': %s", compiled, e)
+    return False
+  try:
+    with os.fdopen(fd, "wb") as f:
+      numpy.savez(f, __signature__=source_signature, **columns)
+    os.replace(temporary, compiled)
+  except OSError as e:
+    # e.g., a full disk; the database works without the compiled file
+    logger.warning("Cannot write compiled file '%s': %s", compiled, e)
+    _remove(temporary)
+    return False
+  except Exception:
+    _remove(temporary)
+    raise
+  return True
+
+
+def _remove(filename):
+  """Removes the given file, if it still exists"""
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
+
+
+def _load(compiled, source_signature, build, force):
+  """Reads the columns from the ``compiled`` file or, if not up to date, builds and writes them
+
+  Returns the columns, and whether they were read from the compiled file.
+  """
+  if not force:
+    columns = read(compiled, source_signature)
+    if columns is not None:
+      return columns, True
+
+  logger.debug("Compiling '%s'", compiled)
+  columns = build()
+  write(compiled, columns, source_signature)
+  return columns, False
+
+
+def load(filename, parser, cache_directory=None, force=False, report=False):
+  """Loads the columns of the given file list, using the compiled cache when possible.
+
+  Keyword Parameters:
+
+  filename : str
+    The original CSV file list.
+
+  parser : callable
+    The function that parses the ``filename`` into a dictionary of :py:class:`numpy.ndarray`'s, e.g., :py:func:`bob.db.ijba.reader.read_columns`.
+
+  cache_directory : str or ``None``
+    The directory of the compiled cache.
+    If ``None`` or empty, the file is parsed without using the cache.
+
+  force : bool
+    If set, the compiled file is rebuilt even if it is up to date.
+
+  report : bool
+    If set, it is returned whether the compiled file was used.
+
+  Returns: the dictionary of columns as returned by ``parser``; if ``report`` is set, a tuple of the columns and a bool that tells if they were read from the compiled file.
+  """
+  if not cache_directory:
+    columns, hit = parser(filename), False
+  else:
+    columns, hit = _load(compiled_filename(filename, cache_directory), signature(filename), lambda: parser(filename), force)
+
+  return (columns, hit) if report else columns
+
+
+def load_derived(name, filenames, builder, cache_directory=None, force=False):
+  """Loads columns that are derived from several file lists, e.g., an index, using the compiled cache when possible.
+
+  The compiled file is rebuilt whenever any of the source ``filenames`` changes.
+
+  Keyword Parameters:
+
+  name : str
+    The name of the derived data, which is used as the prefix of the compiled file.
+
+  filenames : [str]
+    The original CSV file lists, from which the data is derived.
+
+  builder : callable
+    The function without parameters that builds the dictionary of :py:class:`numpy.ndarray`'s.
+
+  cache_directory : str or ``None``
+    The directory of the compiled cache.
+    If ``None`` or empty, the data is built without using the cache.
+
+  force : bool
+    If set, the compiled file is rebuilt even if it is up to date.
+
+  Returns: the dictionary of columns as returned by ``builder``.
+  """
+  if not cache_directory:
+    return builder()
+
+  filenames = [os.path.abspath(f) for f in filenames]
+  key = hashlib.sha1("\n".join(filenames).encode("utf-8")).hexdigest()[:16]
+  compiled = os.path.join(cache_directory, "%s-%s.npz" % (name, key))
+  source_signature = numpy.concatenate([signature(f) for f in filenames])
+  return _load(compiled, source_signature, builder, force)[0]
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Extraction of fixed-size face crops from the original IJB-A images.
+
+The face bounding boxes are taken from the ``topleft`` and ``size``
+annotations of the :py:class:`bob.db.ijba.File` objects of a protocol.  The
+crops are grouped by their original image, so that each image is decoded only
+once, and the images are decoded in a pool of worker processes, see
+:py:func:`extract`.  The crops are written either as one ``.npy`` file per
+:py:attr:`bob.db.ijba.File.id` into a directory, or into a single
+:py:class:`CropStore`.  Crops that already exist are skipped, so that an
+interrupted extraction can be resumed.
+"""
+
+import os
+import time
+import logging
+import collections
+import concurrent.futures
+
+import numpy
+
+logger = logging.getLogger("bob.db.ijba")
+
+
+def _load(filename):
+  """Loads an image with :py:func:`bob.io.base.load`, which returns gray images as 2D and color images as 3D arrays in ``(C, H, W)`` order"""
+  import bob.io.base
+  import bob.io.image # registers the image codecs
+  return bob.io.base.load(filename)
+
+
+def crop(image, topleft, size, shape=(112, 112), gray=False):
+  """Crops the given bounding box from the image, and scales it to a fixed shape with bilinear interpolation.
+
+  Parts of the bounding box that lie outside of the image are filled by repeating the border pixels.
+
+  Keyword Parameters:
+
+  image : :py:class:`numpy.ndarray`
+    The gray ``(H, W)`` or color ``(C, H, W)`` image.
+
+  topleft, size : (float, float)
+    The top-left corner and the size of the bounding box in ``(y, x)`` order, as in the annotations of :py:class:`bob.db.ijba.File`.
+
+  shape : (int, int)
+    The ``(height, width)`` of the crop.
+
+  gray : bool
+    If set, the crop is converted to a 2D gray image; otherwise, it is a ``(3, height, width)`` color image.
+
+  Returns: the crop as :py:class:`numpy.ndarray` with the data type of the ``image``.
+
+  Raises a :py:exc:`ValueError` if the bounding box is not finite, e.g., when the annotations are missing.
+  """
+  if not numpy.all(numpy.isfinite(numpy.concatenate((topleft, size)))):
+    raise ValueError("The bounding box with top-left %s and size %s is not finite." % (tuple(topleft), tuple(size)))
+  image = numpy.asarray(image)
+  if image.ndim == 2:
+    image = image[None]
+  height, width = image.shape[1:]
+
+  # the sampling positions of the crop pixels in the image
+  y = topleft[0] + (numpy.arange(shape[0]) + 0.5) * size[0] / shape[0] - 0.5
+  x = topleft[1] + (numpy.arange(shape[1]) + 0.5) * size[1] / shape[1] - 0.5
+  y = numpy.clip(y, 0, height - 1)
+  x = numpy.clip(x, 0, width - 1)
+  y0, x0 = numpy.floor(y).astype(int), numpy.floor(x).astype(int)
+  y1, x1 = numpy.minimum(y0 + 1, height - 1), numpy.minimum(x0 + 1, width - 1)
+  wy, wx = (y - y0)[:, None], (x - x0)[None, :]
+
+  data = image.astype(numpy.float64)
+  result = (data[:, y0][:, :, x0] * (1 - wy) * (1 - wx) + data[:, y0][:, :, x1] * (1 - wy) * wx +
+            data[:, y1][:, :, x0] * wy * (1 - wx) + data[:, y1][:, :, x1] * wy * wx)
+
+  if gray:
+    result = result[0] if len(result) == 1 else numpy.tensordot([0.299, 0.587, 0.114], result[:3], axes=1)
+  elif len(result) == 1:
+    result = numpy.repeat(result, 3, axis=0)
+
+  if numpy.issubdtype(image.dtype, numpy.integer):
+    result = numpy.round(result)
+  return result.astype(image.dtype)
+
+
+def _crop_image(task):
+  """Decodes one original image and extracts all of its crops, in a worker process of :py:func:`extract`
+
+  The ``task`` is a tuple ``(filename, boxes, shape, gray, loader, directory)`` with a list of ``(file_id, topleft, size)`` boxes.
+  Returns a ``(file_id, data, error)`` tuple for each box, where the ``error`` is set if the crop failed.
+  If ``directory`` is given, the crops are written there, and only their ids are returned; otherwise, the crops themselves are returned.
+  """
+  filename, boxes, shape, gray, loader, directory = task
+  try:
+    image = (loader or _load)(filename)
+  except Exception as e:
+    return filename, None, str(e)
+
+  results = []
+  for file_id, topleft, size in boxes:
+    try:
+      data = crop(image, topleft, size, shape, gray)
+      if directory is not None:
+        _save(os.path.join(directory, file_id + ".npy"), data)
+        data = None
+    except Exception as e:
+      results.append((file_id, None, str(e)))
+      continue
+    results.append((file_id, data, None))
+  return filename, results, None
+
+
+def _save(filename, data):
+  """Writes the crop atomically, so that interrupted extractions do not leave partial crops behind"""
+  parent = os.path.dirname(filename)
+  if not os.path.isdir(parent):
+    os.makedirs(parent, exist_ok=True)
+  temporary = filename + ".tmp"
+  with open(temporary, "wb") as f:
+    numpy.save(f, data)
+  os.replace(temporary, filename)
+
+
+class CropStore(object):
+  """A single memory-mapped array of face crops, with one crop per file id
+
+  The store is a directory containing ``crops.npy`` with all crops, ``ids.npy`` with the file id of each crop, and ``done.npy``, which tells which of the crops have been extracted already.
+  Use :py:meth:`create` to create a new store, and the constructor to open an existing one.
+  """
+
+  def __init__(self, directory, mode='r'):
+    """**Constructor Documentation**
+
+    Opens an existing store.
+
+    Parameters:
+
+    directory : str
+      The directory of the store.
+
+    mode : str
+      The mode to memory-map the crops with, ``'r'`` for reading and ``'r+'`` for writing.
+    """
+    self.directory = directory
+    self.crops = numpy.load(os.path.join(directory, "crops.npy"), mmap_mode=mode)
+    self.ids = numpy.load(os.path.join(directory, "ids.npy"))
+    self.done = numpy.load(os.path.join(directory, "done.npy"))
+    self._rows = dict((i, r) for r, i in enumerate(self.ids.tolist()))
+
+  @classmethod
+  def create(cls, directory, ids, shape, dtype=numpy.uint8):
+    """Creates a new store for the crops of the given file ids, with all crops set to 0, or opens the existing store if it contains the same ids.
+
+    Keyword Parameters:
+
+    directory : str
+      The directory of the store, which is created if needed.
+
+    ids : [str]
+      The distinct file ids of the crops.
+
+    shape : tuple
+      The shape of each crop, e.g., ``(3, 112, 112)``.
+
+    dtype : :py:class:`numpy.dtype`
+      The data type of the crops.
+
+    Returns: the :py:class:`CropStore`, opened for writing.
+    """
+    ids = numpy.asarray(ids, dtype=str)
+    if os.path.exists(os.path.join(directory, "done.npy")):
+      store = cls(directory, mode='r+')
+      if numpy.array_equal(store.ids, ids) and store.crops.shape[1:] == tuple(shape):
+        return store
+      raise ValueError("The crop store '%s' contains different crops; use another directory." % directory)
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    crops = numpy.lib.format.open_memmap(os.path.join(directory, "crops.npy"), mode='w+', dtype=dtype, shape=(len(ids),) + tuple(shape))
+    crops.flush()
+    del crops
+    numpy.save(os.path.join(directory, "ids.npy"), ids)
+    numpy.save(os.path.join(directory, "done.npy"), numpy.zeros(len(ids), dtype=bool))
+    return cls(directory, mode='r+')
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, file_id):
+    """Returns the crop of the given file id"""
+    return self.crops[self._rows[file_id]]
+
+  def write(self, file_id, data):
+    """Writes the crop of the given file id, and marks it as extracted; both are persisted by the next :py:meth:`flush`"""
+    row = self._rows[file_id]
+    self.crops[row] = data
+    self.done[row] = True
+
+  def flush(self):
+    """Writes the crops and, atomically, the extracted marks to disk"""
+    self.crops.flush()
+    _save(os.path.join(self.directory, "done.npy"), self.done)
+
+
+def extract(db, output, protocol='search_split1', groups=None, purposes=None, shape=(112, 112), gray=False, store=False, workers=None, loader=None, flush_interval=1000):
+  """Extracts the face crops of all files of a protocol.
+
+  The crops are extracted from the original images, see :py:meth:`bob.db.ijba.Database.original_file_name`, using the bounding boxes of the file annotations.
+  Files that are shared between templates (see :py:class:`bob.db.ijba.Database`) are extracted once, with the bounding box of their first occurrence.
+
+  Keyword Parameters:
+
+  db : :py:class:`bob.db.ijba.Database`
+    The database, which needs to be created with the ``original_directory``.
+
+  output : str
+    The output directory, which will contain one ``<file.id>.npy`` file per crop, or the :py:class:`CropStore` if ``store`` is set.
+
+  protocol, groups, purposes
+    The query of the files to extract, see :py:meth:`bob.db.ijba.Database.objects`.
+
+  shape, gray
+    The shape and the color of the crops, see :py:func:`crop`.
+
+  store : bool
+    If set, the crops are written into a :py:class:`CropStore` of ``uint8`` crops.
+
+  workers : int or ``None``
+    The number of worker processes that decode the images; if not given, the number of CPUs is used.
+    With ``workers=1``, the images are decoded in the current process.
+
+  loader : callable or ``None``
+    The function that loads an image from a file name; by default, :py:func:`bob.io.base.load` is used.
+    It needs to be picklable when ``workers`` is not 1.
+
+  flush_interval : int
+    The number of crops after which a :py:class:`CropStore` is flushed to disk, which limits the work that is repeated after an interruption.
+
+  Returns: a dictionary with the number of ``extracted`` crops, the number of ``skipped`` crops that existed already, the list of ``missing`` images that could not be loaded, the list of ``failed`` file ids whose crops could not be extracted, e.g., because of invalid bounding boxes, and the ``seconds`` needed.
+  """
+  start = time.time()
+
+  # the distinct files, grouped by their original image
+  files = collections.OrderedDict()
+  for f in db.iter_objects(groups=groups, protocol=protocol, purposes=purposes):
+    files.setdefault(f.id, f)
+
+  crop_shape = tuple(shape) if gray else (3,) + tuple(shape)
+  if store:
+    crops = CropStore.create(output, list(files), crop_shape)
+    existing = set(crops.ids[crops.done].tolist())
+  else:
+    crops = None
+    existing = set(i for i in files if os.path.exists(os.path.join(output, i + ".npy")))
+
+  images = collections.OrderedDict()
+  for file_id, f in files.items():
+    if file_id not in existing:
+      annotations = f.annotations
+      images.setdefault(db.original_file_name(f, check_existence=False), []).append((file_id, annotations['topleft'], annotations['size']))
+  logger.info("Extracting %d crops of %d images (%d crops exist already)", sum(len(b) for b in images.values()), len(images), len(existing))
+
+  tasks = [(filename, boxes, shape, gray, loader, None if store else output) for filename, boxes in images.items()]
+  if workers == 1 or len(tasks) <= 1:
+    executor = None
+    results = (_crop_image(t) for t in tasks)
+  else:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    results = executor.map(_crop_image, tasks, chunksize=max(1, min(64, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+
+  extracted, missing, failed, pending = 0, [], [], 0
+  try:
+    for filename, result, error in results:
+      if result is None:
+        logger.warning("Cannot load image '%s': %s", filename, error)
+        missing.append(filename)
+        continue
+      for file_id, data, error in result:
+        if error is not None:
+          logger.warning("Cannot extract crop of '%s' from image '%s': %s", file_id, filename, error)
+          failed.append(file_id)
+          continue
+        if crops is not None:
+          crops.write(file_id, data)
+          pending += 1
+          if pending >= flush_interval:
+            crops.flush()
+            pending = 0
+        extracted += 1
+  finally:
+    if executor is not None:
+      executor.shutdown()
+    if crops is not None:
+      crops.flush()
+
+  seconds = time.time() - start
+  logger.info("Extracted %d crops in %.2f s (%.1f crops/s)", extracted, seconds, extracted / max(seconds, 1e-6))
+  return {'extracted' : extracted, 'skipped' : len(existing), 'missing' : missing, 'failed' : failed, 'seconds' : seconds}
@@ -11,32 +11,58 @@ import pkg_resources
 from bob.db.base.driver import Interface as BaseInterface
 
 
+def _scan(directory):
+  """Returns the set of entry names of the given directory, an empty set if it does not exist, or ``None`` if it cannot be listed"""
+  try:
+    with os.scandir(directory or '.') as entries:
+      return set(e.name for e in entries)
+  except FileNotFoundError:
+    return set()
+  except OSError:
+    return None
+
+
 def checkfiles(args):
   """Checks existence of files based on your criteria"""
 
   from .query import Database
+  import time
+  import concurrent.futures
 
-  protocols        = ['search_split%d' % s for s in range(1,11)]
-  protocols.extend(['compare_split%d' % s for s in range(1,11)])
-
-  for p in protocols:
+  start = time.time()
+  db = Database()
 
-    db = Database()
-    r = db.objects(protocol=p)
-    good = {}
-    bad = {}
-    # go through all files, check if they are available on the filesystem
-    for f in r:
-
-      found = False
-      for e in args.extension:
-
-        if os.path.exists(f.make_path(args.directory,e)):
-          good[f.id] = f.make_path(args.directory,e)
-          found = True
-          break
-      if not found:
-        bad[f.id] = f.make_path(args.directory,args.extension[0])
+  # collect the files of all protocols; files shared between protocols are checked once
+  files = {}
+  for p in db.protocols():
+    for f in db.iter_objects(protocol=p):
+      files.setdefault(f.id, f)
+
+  extensions = args.extension or ['']
+  candidates = dict((i, [f.make_path(args.directory, e) for e in extensions]) for i, f in files.items())
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+    # list each directory once
+    directories = sorted(set(os.path.dirname(c) for paths in candidates.values() for c in paths))
+    listings = dict(zip(directories, executor.map(_scan, directories)))
+
+    # directories that cannot be listed are checked path by path
+    remaining = sorted(set(c for paths in candidates.values() for c in paths if listings[os.path.dirname(c)] is None))
+    existing = set(c for c, exists in zip(remaining, executor.map(os.path.exists, remaining)) if exists)
+
+  good = {}
+  bad = {}
+  # go through all files, check if they are available on the filesystem
+  for i, paths in candidates.items():
+    for c in paths:
+      listing = listings[os.path.dirname(c)]
+      if (c in existing) if listing is None else (os.path.basename(c) in listing):
+        good[i] = c
+        break
+    else:
+      bad[i] = paths[0]
+
+  seconds = time.time() - start
 
   # report
   output = sys.stdout
@@ -48,9 +74,63 @@ def checkfiles(args):
     for id, f in bad.items():
       output.write('Cannot find file "%s"\n' % f)
     output.write('%d files (out of %d) were not found at "%s"\n' % \
-        (len(bad), len(r), args.directory))
+        (len(bad), len(files), args.directory))
   else:
-    output.write('All files were found !!!')
+    output.write('All files were found !!!\n')
+  output.write('Checked %d files in %d directories in %.2f s (%.0f files/s)\n' % (len(files), len(directories), seconds, len(files) / max(seconds, 1e-6)))
+
+  return 0
+
+
+def compile(args):
+  """Prebuilds the compiled cache of the file lists for all protocols"""
+
+  from .query import Database
+  db = Database(cache_directory=args.cache_directory)
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  compiled = db.compile(protocols=args.protocols, force=args.force)
+  for filename in compiled:
+    output.write('Compiled "%s"\n' % filename)
+  output.write('%d file lists were compiled into "%s"\n' % (len(compiled), db.cache_directory))
+
+  return 0
+
+
+def benchmark(args):
+  """Measures the time and memory of the loading and query operations on synthetic file lists"""
+
+  import json
+  from . import benchmark as bench
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  results = bench.run(scales=args.scales, repeat=args.repeat, directory=args.directory, names=args.operations)
+  for key in sorted(results):
+    output.write('%-45s %10.4f s %10.1f MB\n' % (key, results[key]['seconds'], results[key]['peak_bytes'] / 1e6))
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    output.write('Wrote the results to "%s"\n' % args.output)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = bench.compare(results, baseline, args.tolerance)
+    for key, metric, old, new in regressions:
+      output.write('Regression of %s (%s): %g -> %g (%+.0f%%)\n' % (key, metric, old, new, 100. * (new - old) / old if old else float('inf')))
+    if regressions:
+      output.write('%d regressions compared to "%s"\n' % (len(regressions), args.baseline))
+      return 1
+    output.write('No regressions compared to "%s"\n' % args.baseline)
 
   return 0
 
@@ -110,9 +190,30 @@ class Interface(BaseInterface):
     parser = subparsers.add_parser('checkfiles', help=checkfiles.__doc__)
     parser.add_argument('-d', '--directory', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', nargs="+", help="if given, this extension will be appended to every entry returned.")
+    parser.add_argument('-j', '--jobs', type=int, default=16, help="the number of threads that list the directories in parallel.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=checkfiles) #action
 
+    # the "compile" action
+    parser = subparsers.add_parser('compile', help=compile.__doc__)
+    parser.add_argument('-c', '--cache-directory', help="the directory of the compiled cache; if not given, the default cache directory is used.")
+    parser.add_argument('-p', '--protocols', nargs="+", choices=db.protocols(), help="if given, only the file lists of these protocols are compiled.")
+    parser.add_argument('-f', '--force', action='store_true', help="rebuild the compiled file lists even if they are up to date.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=compile) #action
+
+    # the "benchmark" action
+    parser = subparsers.add_parser('benchmark', help=benchmark.__doc__)
+    parser.add_argument('-s', '--scales', type=float, nargs="+", default=[1], help="the scales of the synthetic file lists, relative to the size of IJB-A, e.g., 1 10 100.")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="the number of repetitions of each operation; the fastest is reported.")
+    parser.add_argument('-d', '--directory', help="if given, the synthetic file lists are stored in (and reused from) this directory.")
+    parser.add_argument('-O', '--operations', nargs="+", help="if given, only these operations are measured.")
+    parser.add_argument('-o', '--output', help="if given, the results are written to this JSON file, which can be used as a baseline.")
+    parser.add_argument('-b', '--baseline', help="if given, the results are compared with this JSON file, and the command fails on regressions.")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help="the relative increase of time or memory that is tolerated when comparing with the baseline.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=benchmark) #action
+
     # adds the "path" command
     parser = subparsers.add_parser('path', help=path.__doc__)
     parser.add_argument('-d', '--directory', help="if given, this path will be prepended to every entry returned.")
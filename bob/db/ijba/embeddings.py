@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Memory-mapped store of file embeddings, keyed by the ids of the IJB-A files.
+
+Instead of writing one feature file per :py:class:`bob.db.ijba.File`, all
+embeddings are stored in a single matrix with one row per file id (see
+:py:attr:`bob.db.ijba.File.id`), which is memory-mapped when reading.  The
+store is a directory containing:
+
+* ``embeddings.npy``: the ``(N, D)`` matrix of embeddings
+* ``ids.npy``: the file id of each row
+* ``order.npy``: the rows sorted by file id, which is used to look up rows
+"""
+
+import os
+
+import numpy
+
+
+class EmbeddingStore(object):
+  """A memory-mapped matrix of embeddings with an index from file id to row
+
+  Use :py:meth:`create` to create a new store, and the constructor to open an existing one.
+  The rows of files that are listed consecutively when creating the store, e.g., the files of a :py:class:`bob.db.ijba.Template`, are stored consecutively, so that they can be read without copy, see :py:meth:`template`.
+  """
+
+  def __init__(self, directory, mode='r'):
+    """**Constructor Documentation**
+
+    Opens an existing store.
+
+    Parameters:
+
+    directory : str
+      The directory of the store.
+
+    mode : str
+      The mode to memory-map the embeddings with, ``'r'`` for reading and ``'r+'`` for writing.
+    """
+    self.directory = directory
+    self.data = numpy.load(os.path.join(directory, "embeddings.npy"), mmap_mode=mode)
+    self.ids = numpy.load(os.path.join(directory, "ids.npy"))
+    self._order = numpy.load(os.path.join(directory, "order.npy"))
+
+  @classmethod
+  def create(cls, directory, ids, dimension, dtype=numpy.float32):
+    """Creates a new store for the given file ids, with all embeddings set to 0.
+
+    Keyword Parameters:
+
+    directory : str
+      The directory of the new store, which is created if needed.
+
+    ids : [str]
+      The ids of the files, e.g., ``[f.id for f in db.objects(...)]``.
+      Duplicate ids are stored only once, at their first position.
+
+    dimension : int
+      The dimension of the embeddings.
+
+    dtype : :py:class:`numpy.dtype`
+      The data type of the embeddings.
+
+    Returns: the new :py:class:`EmbeddingStore`, opened for writing.
+    """
+    ids = numpy.asarray(ids, dtype=str)
+    _, first = numpy.unique(ids, return_index=True)
+    ids = ids[numpy.sort(first)]
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    data = numpy.lib.format.open_memmap(os.path.join(directory, "embeddings.npy"), mode='w+', dtype=dtype, shape=(len(ids), dimension))
+    data.flush()
+    del data
+    numpy.save(os.path.join(directory, "ids.npy"), ids)
+    numpy.save(os.path.join(directory, "order.npy"), numpy.argsort(ids, kind='stable'))
+    return cls(directory, mode='r+')
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self, file_id):
+    return bool(self.contains([file_id])[0])
+
+  def _positions(self, ids):
+    """Returns the candidate rows of the given ids, and whether the ids are stored in these rows"""
+    ids = numpy.asarray(ids, dtype=str)
+    positions = numpy.searchsorted(self.ids, ids, sorter=self._order)
+    rows = self._order[numpy.minimum(positions, len(self.ids) - 1)] if len(self.ids) else numpy.zeros(len(ids), dtype=numpy.int64)
+    found = (self.ids[rows] == ids) if len(self.ids) else numpy.zeros(len(ids), dtype=bool)
+    return rows, found
+
+  def contains(self, ids):
+    """Returns a boolean array that tells, which of the given file ids are stored"""
+    return self._positions(ids)[1]
+
+  def rows(self, ids):
+    """Returns the rows of the given file ids as an integer array; raises a :py:exc:`KeyError` if one of the ids is not stored"""
+    rows, found = self._positions(ids)
+    if not numpy.all(found):
+      raise KeyError("The file ids %s are not in the embedding store '%s'." % (numpy.asarray(ids)[~found][:10].tolist(), self.directory))
+    return rows
+
+  def write(self, ids, embeddings):
+    """Writes the embeddings of the given file ids in bulk.
+
+    Keyword Parameters:
+
+    ids : [str]
+      The ids of the files to write.
+
+    embeddings : :py:class:`numpy.ndarray`
+      The ``(len(ids), D)`` array of embeddings.
+    """
+    self.data[self.rows(ids)] = embeddings
+
+  def flush(self):
+    """Writes all modified embeddings to disk"""
+    if isinstance(self.data, numpy.memmap):
+      self.data.flush()
+
+  def gather(self, ids):
+    """Returns the ``(len(ids), D)`` array of embeddings of the given file ids.
+
+    If the ids are stored in consecutive rows, a view of the memory-mapped data is returned, otherwise the rows are copied.
+    """
+    return self.data[_as_slice(self.rows(ids))]
+
+  def template(self, template):
+    """Returns the embeddings of the files of the given :py:class:`bob.db.ijba.Template`, see :py:meth:`gather`"""
+    return self.gather([f.id for f in template.files])
+
+
+def _as_slice(rows):
+  """Returns a slice for consecutive rows, or the rows themselves"""
+  if len(rows) and rows[-1] - rows[0] == len(rows) - 1 and numpy.all(numpy.diff(rows) == 1):
+    return slice(int(rows[0]), int(rows[-1]) + 1)
+  return rows
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Evaluation of the IJB-A protocols.
+
+The verification protocols (``compare_splitN``) are evaluated by the true
+accept rate (TAR) at given false accept rates (FAR), see :py:func:`roc` and
+:py:func:`tar_at_far`.  The identification protocols (``search_splitN``) are
+evaluated closed-set by the cumulative match characteristic (CMC), see
+:py:func:`cmc`, and open-set by the false negative identification rate (FNIR)
+at given false positive identification rates (FPIR), see
+:py:func:`fnir_at_fpir`.
+
+All metrics are computed by sorting whole arrays of scores.  The scores are
+given as ``(model_ids, probe_ids, scores)`` arrays with one entry per score,
+or as an iterable of such chunks, e.g., as returned by
+:py:func:`bob.db.ijba.scoring.score_protocol`.  The ten splits of a task are
+evaluated in parallel and aggregated as mean and standard deviation, see
+:py:func:`evaluate`.
+"""
+
+import concurrent.futures
+
+import numpy
+
+#: The default false accept rates of the verification protocols
+FAR_VALUES = (0.001, 0.01, 0.1)
+
+#: The default ranks of the identification protocols
+RANKS = (1, 5, 10)
+
+#: The default false positive identification rates of the identification protocols
+FPIR_VALUES = (0.01, 0.1)
+
+
+def _as_arrays(scores):
+  """Returns the ``(model_ids, probe_ids, scores)`` arrays of the given scores, which might be given in chunks"""
+  if isinstance(scores, tuple) and len(scores) == 3 and all(isinstance(s, numpy.ndarray) for s in scores):
+    return scores
+  chunks = list(scores)
+  if not chunks:
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+  return tuple(numpy.concatenate([numpy.asarray(c[i]) for c in chunks]) for i in range(3))
+
+
+def _lookup(keys, ids, values):
+  """Returns the ``values`` of the given ``keys`` inside ``ids``, raising a :py:exc:`KeyError` for unknown keys"""
+  order = numpy.argsort(ids)
+  positions = order[numpy.minimum(numpy.searchsorted(ids, keys, sorter=order), len(ids) - 1)]
+  missing = ids[positions] != keys
+  if numpy.any(missing):
+    raise KeyError("The templates %s are not part of the protocol." % numpy.asarray(keys)[missing][:10].tolist())
+  return values[positions]
+
+
+def roc(genuine, impostor):
+  """Computes the receiver operating characteristic of the given genuine and impostor scores.
+
+  A score is accepted, when it is greater than or equal to the threshold.
+
+  Returns: the ``(far, tar, thresholds)`` arrays, with one entry for each distinct score, in descending order of the thresholds.
+  """
+  genuine = numpy.sort(numpy.asarray(genuine, dtype=numpy.float64))
+  impostor = numpy.sort(numpy.asarray(impostor, dtype=numpy.float64))
+  thresholds = numpy.unique(numpy.concatenate((genuine, impostor)))[::-1]
+  far = (len(impostor) - numpy.searchsorted(impostor, thresholds)) / float(max(len(impostor), 1))
+  tar = (len(genuine) - numpy.searchsorted(genuine, thresholds)) / float(max(len(genuine), 1))
+  return far, tar, thresholds
+
+
+def _thresholds(impostor, far_values):
+  """Returns the lowest thresholds that accept at most the given fractions of the sorted ``impostor`` scores"""
+  # the number of impostors that are accepted at each false accept rate
+  accepted = numpy.floor(numpy.asarray(far_values, dtype=numpy.float64) * len(impostor)).astype(numpy.int64)
+  # accept everything above the highest rejected impostor score
+  rejected = len(impostor) - accepted - 1
+  return numpy.where(rejected >= 0, numpy.nextafter(impostor[numpy.maximum(rejected, 0)], numpy.inf), -numpy.inf)
+
+
+def tar_at_far(genuine, impostor, far_values=FAR_VALUES):
+  """Computes the true accept rates at the given false accept rates.
+
+  For each false accept rate, the threshold is chosen as the lowest one that accepts at most the given fraction of the impostor scores.
+  As in :py:func:`roc`, a score is accepted, when it is greater than or equal to the threshold.
+
+  Keyword Parameters:
+
+  genuine, impostor : :py:class:`numpy.ndarray`
+    The genuine and impostor scores.
+
+  far_values : [float]
+    The false accept rates.
+
+  Returns: the arrays of the true accept rates and of the thresholds, with one entry per false accept rate.
+  """
+  genuine = numpy.sort(numpy.asarray(genuine, dtype=numpy.float64))
+  impostor = numpy.sort(numpy.asarray(impostor, dtype=numpy.float64))
+  if not len(genuine) or not len(impostor):
+    raise ValueError("Both genuine and impostor scores are required.")
+
+  thresholds = _thresholds(impostor, far_values)
+  tar = (len(genuine) - numpy.searchsorted(genuine, thresholds)) / float(len(genuine))
+  return tar, thresholds
+
+
+def search_statistics(model_ids, probe_ids, scores, template_ids, client_ids, gallery_ids=None, probes=None):
+  """Computes the rank and the score of the mated comparison of each mated probe, and the highest score of each non-mated probe.
+
+  A probe is mated, if the gallery contains a template of its client.
+  This is decided from the ``gallery_ids``, and not from the scores, so that partial scores, e.g., the top-k candidates of :py:func:`bob.db.ijba.search.top_k`, are evaluated correctly: a mated probe, whose mated template is not scored, gets the rank ``inf`` and the score ``-inf``.
+
+  Keyword Parameters:
+
+  model_ids, probe_ids, scores : :py:class:`numpy.ndarray`
+    The scores of the probes with the gallery templates, one entry per score.
+
+  template_ids, client_ids : :py:class:`numpy.ndarray`
+    The client id of each template of the protocol.
+
+  gallery_ids : :py:class:`numpy.ndarray` or ``None``
+    The ids of all gallery templates; if not given, the scored ``model_ids`` are used.
+
+  probes : :py:class:`numpy.ndarray` or ``None``
+    The ids of all probe templates; if not given, the scored ``probe_ids`` are used.
+    Non-mated probes without scores get the score ``-inf``.
+
+  Returns: a dictionary with the ``mated_ranks`` (counting from 1) and ``mated_scores`` of the mated probes, and the highest ``nonmated_scores`` of the other probes.
+  """
+  model_ids, probe_ids, scores = (numpy.asarray(a) for a in (model_ids, probe_ids, scores))
+  template_ids, client_ids = numpy.asarray(template_ids), numpy.asarray(client_ids)
+  gallery_ids = numpy.unique(model_ids if gallery_ids is None else numpy.asarray(gallery_ids))
+  probes = numpy.unique(probe_ids if probes is None else numpy.asarray(probes))
+
+  gallery_clients = numpy.unique(_lookup(gallery_ids, template_ids, client_ids))
+  probe_mated = numpy.isin(_lookup(probes, template_ids, client_ids), gallery_clients)
+  mated = _lookup(model_ids, template_ids, client_ids) == _lookup(probe_ids, template_ids, client_ids)
+  probe_index = _lookup(probe_ids, probes, numpy.arange(len(probes)))
+
+  # sort by probe, and by descending score inside each probe
+  order = numpy.lexsort((-scores, probe_index))
+  probe_index, scores, mated = probe_index[order], scores[order], mated[order]
+  starts = numpy.searchsorted(probe_index, numpy.arange(len(probes)))
+  ranks = numpy.arange(len(order)) - starts[probe_index] + 1
+
+  # the first mated score of each probe is the best one
+  mated_ranks = numpy.full(len(probes), numpy.inf)
+  mated_scores = numpy.full(len(probes), -numpy.inf)
+  found, first = numpy.unique(probe_index[mated], return_index=True)
+  positions = numpy.flatnonzero(mated)[first]
+  mated_ranks[found] = ranks[positions]
+  mated_scores[found] = scores[positions]
+
+  # the highest score of each probe, if it has any score
+  highest = numpy.full(len(probes), -numpy.inf)
+  scored = numpy.unique(probe_index)
+  highest[scored] = scores[starts[scored]]
+
+  return {
+    'mated_ranks'     : mated_ranks[probe_mated],
+    'mated_scores'    : mated_scores[probe_mated],
+    'nonmated_scores' : highest[~probe_mated],
+  }
+
+
+def cmc(mated_ranks, ranks=RANKS):
+  """Returns the identification rates at the given ranks, i.e., the fraction of mated probes whose mated rank is not higher than each rank"""
+  mated_ranks = numpy.sort(numpy.asarray(mated_ranks))
+  if not len(mated_ranks):
+    raise ValueError("There are no mated probes.")
+  return numpy.searchsorted(mated_ranks, numpy.asarray(ranks), side='right') / float(len(mated_ranks))
+
+
+def fnir_at_fpir(mated_ranks, mated_scores, nonmated_scores, fpir_values=FPIR_VALUES, rank=1):
+  """Computes the false negative identification rates at the given false positive identification rates.
+
+  A mated probe is identified, if its mated rank is not higher than ``rank`` and its mated score reaches the threshold.
+  The thresholds are chosen as the lowest ones that accept at most the given fraction of the non-mated probes, see :py:func:`tar_at_far`.
+
+  Returns: the arrays of the false negative identification rates and of the thresholds, with one entry per false positive identification rate.
+  """
+  mated_ranks, mated_scores = numpy.asarray(mated_ranks), numpy.asarray(mated_scores, dtype=numpy.float64)
+  nonmated_scores = numpy.sort(numpy.asarray(nonmated_scores, dtype=numpy.float64))
+  if not len(mated_ranks) or not len(nonmated_scores):
+    raise ValueError("Both mated and non-mated probes are required.")
+
+  thresholds = _thresholds(nonmated_scores, fpir_values)
+  identified = numpy.sort(mated_scores[mated_ranks <= rank])
+  tpir = (len(identified) - numpy.searchsorted(identified, thresholds)) / float(len(mated_ranks))
+  return 1. - tpir, thresholds
+
+
+def _template_clients(db, protocol):
+  """Returns the template ids and client ids of all templates of the given protocol"""
+  templates = db.object_sets(protocol=protocol, purposes=('enroll', 'probe'))
+  template_ids = numpy.array([t.id for t in templates], dtype=numpy.int64)
+  client_ids = numpy.array([t.client_id for t in templates], dtype=numpy.int64)
+  return template_ids, client_ids
+
+
+def evaluate_protocol(db, protocol, scores, far_values=FAR_VALUES, ranks=RANKS, fpir_values=FPIR_VALUES):
+  """Computes the metrics of one protocol.
+
+  Keyword Parameters:
+
+  db : :py:class:`bob.db.ijba.Database`
+    The database that defines the protocol.
+
+  protocol : str
+    The ``compare_splitN`` or ``search_splitN`` protocol.
+
+  scores : (:py:class:`numpy.ndarray`, :py:class:`numpy.ndarray`, :py:class:`numpy.ndarray`) or iterable
+    The ``(model_ids, probe_ids, scores)`` of the protocol, or an iterable of such chunks.
+
+  far_values, ranks, fpir_values
+    The false accept rates, the ranks and the false positive identification rates to report.
+
+  Returns: a dictionary from the names of the metrics, e.g., ``'TAR@FAR=0.001'``, ``'rank-1'`` or ``'FNIR@FPIR=0.01'``, to their values.
+  """
+  model_ids, probe_ids, values = _as_arrays(scores)
+  template_ids, client_ids = _template_clients(db, protocol)
+
+  if db.protocol_table[protocol]['task'] == 'compare':
+    genuine = _lookup(model_ids, template_ids, client_ids) == _lookup(probe_ids, template_ids, client_ids)
+    tar, _ = tar_at_far(values[genuine], values[~genuine], far_values)
+    return dict(("TAR@FAR=%g" % far, float(t)) for far, t in zip(far_values, tar))
+
+  gallery_ids = db.model_ids(protocol=protocol, purposes='enroll')
+  probes = db.model_ids(protocol=protocol, purposes='probe')
+  statistics = search_statistics(model_ids, probe_ids, values, template_ids, client_ids, gallery_ids, probes)
+  metrics = dict(("rank-%d" % r, float(rate)) for r, rate in zip(ranks, cmc(statistics['mated_ranks'], ranks)))
+  if len(statistics['nonmated_scores']):
+    fnir, _ = fnir_at_fpir(statistics['mated_ranks'], statistics['mated_scores'], statistics['nonmated_scores'], fpir_values)
+    metrics.update(("FNIR@FPIR=%g" % fpir, float(f)) for fpir, f in zip(fpir_values, fnir))
+  return metrics
+
+
+def aggregate(results):
+  """Aggregates the metrics of several protocols, as returned by :py:func:`evaluate_protocol`, into ``(mean, std)`` tuples
+
+  Metrics that are not reported for all protocols are aggregated over the protocols that report them.
+  """
+  names = sorted(set(name for metrics in results.values() for name in metrics))
+  summary = {}
+  for name in names:
+    values = numpy.array([metrics[name] for metrics in results.values() if name in metrics])
+    summary[name] = (float(values.mean()), float(values.std()))
+  return summary
+
+
+def evaluate(db, scores, task='compare', workers=None, **kwargs):
+  """Evaluates all ten splits of the given task in parallel, and aggregates the results.
+
+  Keyword Parameters:
+
+  db : :py:class:`bob.db.ijba.Database`
+    The database that defines the protocols.
+
+  scores : dict or callable
+    The scores of each protocol, either as a dictionary from protocol name to scores, or as a function that returns the scores for a given protocol name, see :py:func:`evaluate_protocol`.
+
+  task : str
+    ``'compare'`` to evaluate the ``compare_splitN`` protocols, or ``'search'`` for the ``search_splitN`` protocols.
+
+  workers : int or ``None``
+    The number of threads that evaluate the splits; if not given, one thread per split is used.
+
+  kwargs
+    The metrics to report, see :py:func:`evaluate_protocol`.
+
+  Returns: a dictionary with the metrics of each protocol, and the aggregated ``(mean, std)`` of each metric, see :py:func:`aggregate`.
+  """
+  if task not in ('compare', 'search'):
+    raise ValueError("The task '%s' is not known; use 'compare' or 'search'." % task)
+  protocols = sorted((p for p, entry in db.protocol_table.items() if entry['task'] == task), key=lambda p: db.protocol_table[p]['split'])
+
+  def _evaluate(protocol):
+    return evaluate_protocol(db, protocol, scores(protocol) if callable(scores) else scores[protocol], **kwargs)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers or len(protocols)) as executor:
+    results = dict(zip(protocols, executor.map(_evaluate, protocols)))
+
+  return results, aggregate(results)
+
+
+def report(summary):
+  """Formats the aggregated metrics of :py:func:`evaluate` as lines of ``"<metric>: <mean> +- <std>"``"""
+  return "\n".join("%s: %.4f +- %.4f" % (name, mean, std) for name, (mean, std) in sorted(summary.items()))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Opt-in instrumentation of the :py:class:`bob.db.ijba.Database`.
+
+When enabled, the database records each file list that it loads (with the
+number of rows, the time and whether the compiled cache was used), and the
+number of calls, the result sizes and the latency of its query methods.  The
+statistics are returned by :py:meth:`bob.db.ijba.Database.stats`.
+
+The instrumentation is enabled with the ``statistics`` parameter of the
+database, or for all databases with the ``BOB_DB_IJBA_STATS`` environment
+variable.  If the variable is set to a file name ending with ``.json``, the
+statistics of all databases are written to this file when the program exits,
+otherwise they are written to the ``bob.db.ijba`` logger.  When disabled, each
+query costs one additional attribute lookup.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import weakref
+import functools
+import threading
+
+logger = logging.getLogger("bob.db.ijba")
+
+#: The environment variable that enables the statistics of all databases
+STATISTICS_VARIABLE = "BOB_DB_IJBA_STATS"
+
+
+class Statistics(object):
+  """Thread-safe counters and timers of the loads and queries of one database"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.loads = []
+    self.queries = {}
+
+  def load(self, filename, rows, seconds, source):
+    """Records the load of a file list, where ``source`` is ``'compiled'``, ``'parsed'`` or ``'preloaded'``"""
+    with self._lock:
+      self.loads.append({'file' : filename, 'rows' : rows, 'seconds' : seconds, 'source' : source})
+
+  def query(self, name, seconds, size):
+    """Records a call of the query method ``name``, which returned ``size`` elements"""
+    with self._lock:
+      entry = self.queries.get(name)
+      if entry is None:
+        entry = self.queries[name] = {'calls' : 0, 'results' : 0, 'seconds' : 0., 'max_seconds' : 0.}
+      entry['calls'] += 1
+      entry['results'] += size
+      entry['seconds'] += seconds
+      entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+  def reset(self):
+    """Clears all recorded loads and queries"""
+    with self._lock:
+      self.loads = []
+      self.queries = {}
+
+  def report(self):
+    """Returns a copy of the recorded statistics, with a summary of the loads"""
+    with self._lock:
+      loads = [dict(l) for l in self.loads]
+      queries = dict((name, dict(entry)) for name, entry in self.queries.items())
+
+    return {
+      'loads'   : loads,
+      'summary' : {
+        'loads'        : len(loads),
+        'rows'         : sum(l['rows'] for l in loads),
+        'seconds'      : sum(l['seconds'] for l in loads),
+        'cache_hits'   : sum(1 for l in loads if l['source'] == 'compiled'),
+        'cache_misses' : sum(1 for l in loads if l['source'] == 'parsed'),
+      },
+      'queries' : queries,
+    }
+
+
+def _size(result):
+  """Returns the number of elements of the result of a query, or 1 for scalar results"""
+  try:
+    return len(result)
+  except TypeError:
+    return 1
+
+
+# the databases whose query methods are currently running in each thread
+_active = threading.local()
+
+
+def instrumented(method):
+  """Decorator of the query methods of the :py:class:`bob.db.ijba.Database`, which records their calls if the statistics of the database are enabled
+
+  Query methods that are called by another query method of the same database in the same thread are not recorded, since they are part of the outer query.
+  """
+
+  name = method.__name__
+
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    statistics = self._statistics
+    if statistics is None:
+      return method(self, *args, **kwargs)
+    active = getattr(_active, 'databases', None)
+    if active is None:
+      active = _active.databases = set()
+    if id(self) in active:
+      return method(self, *args, **kwargs)
+
+    active.add(id(self))
+    try:
+      start = time.perf_counter()
+      result = method(self, *args, **kwargs)
+    finally:
+      active.discard(id(self))
+    statistics.query(name, time.perf_counter() - start, _size(result))
+    return result
+
+  return wrapper
+
+
+def environment_enabled():
+  """Returns whether the ``BOB_DB_IJBA_STATS`` environment variable enables the statistics"""
+  return os.environ.get(STATISTICS_VARIABLE, "").lower() not in ("", "0", "false", "no")
+
+
+# the databases whose statistics are written at exit
+_databases = weakref.WeakSet()
+_registered = False
+
+
+def register(database):
+  """Registers a database, whose statistics are written to the destination of the ``BOB_DB_IJBA_STATS`` environment variable at exit"""
+  global _registered
+  _databases.add(database)
+  if not _registered:
+    atexit.register(dump)
+    _registered = True
+
+
+def dump(destination=None):
+  """Writes the statistics of all registered databases.
+
+  Keyword Parameters:
+
+  destination : str or ``None``
+    The JSON file to write; if not given, the value of the ``BOB_DB_IJBA_STATS`` environment variable is used.
+    If it does not end with ``.json``, the statistics are written to the ``bob.db.ijba`` logger.
+  """
+  if destination is None:
+    destination = os.environ.get(STATISTICS_VARIABLE, "")
+  reports = [db.stats() for db in list(_databases)]
+  if not reports:
+    return
+
+  if destination.endswith(".json"):
+    with open(destination, "w") as f:
+      json.dump(reports, f, indent=2, sort_keys=True)
+  else:
+    for report in reports:
+      logger.info("Database statistics: %s", json.dumps(report, sort_keys=True))
@@ -5,24 +5,179 @@
 """
 
 import os
+import sys
+import time
+import asyncio
+import functools
+import weakref
+import threading
+import logging
+import collections
+import concurrent.futures
+import numpy
 from bob.db.base import utils
 
 #from .models import *
 
 from .driver import Interface
-from .reader import get_templates, get_comparisons
+from .reader import Template, Comparisons, read_columns, read_comparisons, templates_from_columns, _interned_files
+from . import cache
+from . import instrumentation
+from .instrumentation import instrumented
 
 import bob.db.base
 
+logger = logging.getLogger("bob.db.ijba")
+
+
+def _as_list(values):
+  """Turns a single value into a list, keeping lists and ``None`` untouched"""
+  if values is None or isinstance(values, (list, tuple, set)):
+    return values
+  return [values]
+
+
+def _template_order(template_ids):
+  """Returns the distinct ids of the ``template_id`` column of a file list, in the order of their first row"""
+  ids, first = numpy.unique(template_ids, return_index=True)
+  return ids[numpy.argsort(first)]
+
+
+def _ranges(starts, counts):
+  """Returns the concatenated ranges ``[start, start + count)`` of the given starts and counts"""
+  offsets = numpy.repeat(starts - (numpy.cumsum(counts) - counts), counts)
+  return numpy.arange(len(offsets)) + offsets
+
+
+def _template_rows(columns, template_ids, media_ids, frames):
+  """Returns the rows of the given templates in the columns of a file list, in the order of the given template ids
+
+  Within each template, the rows are ordered by the given media ids (or frames) and then by row, as the files returned by :py:meth:`_FileIndex.files` for this template.
+  """
+
+  ids = columns['template_id']
+  order = numpy.argsort(ids, kind='stable')
+  template_ids = numpy.asarray(template_ids, dtype=numpy.int64)
+  starts = numpy.searchsorted(ids[order], template_ids, side='left')
+  counts = numpy.searchsorted(ids[order], template_ids, side='right') - starts
+  rows = order[_ranges(starts, counts)]
+  if media_ids is None and frames is None:
+    return rows
+
+  # each row is repeated for each of the requested media ids (or frames) that it matches, ranked by their position in the request
+  wanted = numpy.asarray([int(v) for v in (media_ids if media_ids is not None else frames)], dtype=numpy.int64)
+  sorter = numpy.argsort(wanted, kind='stable')
+  values = columns['media_id' if media_ids is not None else 'frame'][rows]
+  first = numpy.searchsorted(wanted[sorter], values, side='left')
+  matches = numpy.searchsorted(wanted[sorter], values, side='right') - first
+  if frames is not None:
+    # images have no frame number
+    frame = columns['frame'][rows]
+    matches *= numpy.isin(frame, [int(f) for f in frames]) & (frame >= 0)
+  sequence = numpy.repeat(numpy.arange(len(template_ids)), counts)
+  rank = sorter[_ranges(first, matches)]
+  rows, sequence = numpy.repeat(rows, matches), numpy.repeat(sequence, matches)
+  return rows[numpy.lexsort((rank, sequence))]
+
+
+class _FileIndex(object):
+  """Hash indexes of the files of a dictionary of templates, by media id and by frame number of video frames"""
+
+  def __init__(self, templates):
+    self.templates = templates
+    self.media = {} # media_id -> {template_id: [files]}
+    self.frames = {} # frame -> {template_id: [files]}, for video frames only
+    for template_id, template in templates.items():
+      for f in template.files:
+        self.media.setdefault(int(f.media_id), {}).setdefault(template_id, []).append(f)
+        if f.frame is not None:
+          self.frames.setdefault(f.frame, {}).setdefault(template_id, []).append(f)
+
+  def _buckets(self, media_ids, frames):
+    """Returns the buckets of the narrower index, and the frames that still need to be checked"""
+    if media_ids is not None:
+      return [self.media.get(int(m), {}) for m in media_ids], None if frames is None else set(int(f) for f in frames)
+    return [self.frames.get(int(f), {}) for f in frames], None
+
+  def files(self, template_ids, media_ids, frames):
+    """Yields the files of the given templates (``None`` for all templates), which have one of the given media ids and frames"""
+    buckets, check = self._buckets(media_ids, frames)
+    for bucket in buckets:
+      if template_ids is None:
+        selected = (f for files in bucket.values() for f in files)
+      else:
+        selected = (f for t in template_ids for f in bucket.get(t, ()))
+      for f in selected:
+        if check is None or f.frame in check:
+          yield f
+
+  def template(self, template, media_ids, frames):
+    """Returns a copy of the given template restricted to the files with the given media ids and frames, or ``None`` if no file is left"""
+    files = list(self.files([template.id], media_ids, frames))
+    if not files:
+      return None
+    restricted = Template(template.id, template.client_id, files)
+    restricted.path = template.path
+    return restricted
+
+
+class _SubjectIndex(object):
+  """The subject ids of a dictionary of templates, with the number of templates and files of each subject"""
+
+  def __init__(self, templates):
+    self.templates = templates
+    columns = dict((id(t.columns), t.columns) for t in templates.values() if t.columns is not None)
+    if len(columns) == 1 and sum(len(t.rows) for t in templates.values()) == len(next(iter(columns.values()))['subject_id']):
+      # all templates were created from the same file list
+      columns = next(iter(columns.values()))
+      self.subject_ids, self.file_counts = numpy.unique(columns['subject_id'], return_counts=True)
+      _, first = numpy.unique(columns['template_id'], return_index=True)
+      self.template_counts = numpy.unique(columns['subject_id'][first], return_counts=True)[1]
+    else:
+      counts = {}
+      for t in templates.values():
+        entry = counts.setdefault(t.client_id, [0, 0])
+        entry[0] += 1
+        entry[1] += len(t.files)
+      self.subject_ids = numpy.array(sorted(counts), dtype=numpy.int64)
+      self.template_counts = numpy.array([counts[s][0] for s in self.subject_ids.tolist()], dtype=numpy.int64)
+      self.file_counts = numpy.array([counts[s][1] for s in self.subject_ids.tolist()], dtype=numpy.int64)
+
+
+def _parse(source):
+  """Parses the given ``(filename, parser, cache_directory)`` source in a worker process of :py:meth:`Database.preload`"""
+  filename, parser, cache_directory = source
+  start = time.time()
+  columns = cache.load(filename, parser, cache_directory)
+  return filename, columns, time.time() - start
+
 
 class Database(bob.db.base.Database):
   """The database class opens and maintains a connection opened to the Database.
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
+
+  The parsed file lists are stored in a compiled cache inside ``cache_directory``, see :py:mod:`bob.db.ijba.cache`.
+  If ``cache_directory`` is ``None``, the default cache directory is used, see :py:func:`bob.db.ijba.cache.default_cache_directory`.
+  Set it to ``False`` to disable the compiled cache.
+
+  The task, split number and file lists of each protocol are listed in the ``protocol_table``, which is computed once.
+
+  The training sets are shared between the search and the comparison protocols of the same split.
+  They are kept in a least-recently-used cache keyed by the content of the file list, so that identical training lists of both tasks are parsed only once.
+  The cache holds at most ``train_cache_size`` training sets (``None`` for no limit); the default keeps the training sets of both tasks of all splits.
+
+  One database can be queried from several threads at once.
+  Each file list is loaded only once, while the other threads that need it wait for it to be loaded.
+  The data of a protocol is replaced as a whole when new data is loaded, so that queries on already loaded data never need to wait for a lock.
+  For asyncio applications, the coroutines :py:meth:`aobjects`, :py:meth:`aobject_sets` and :py:meth:`apreload` load the file lists in an executor, without blocking the event loop.
+
+  If ``statistics`` is set, the loads of the file lists and the calls of the query methods are recorded, see :py:meth:`stats`.
+  If ``statistics`` is ``None``, they are recorded when the ``BOB_DB_IJBA_STATS`` environment variable is set, see :py:mod:`bob.db.ijba.instrumentation`.
   """
 
-  def __init__(self, original_directory = None, annotations_directory=None, original_extension=None):
+  def __init__(self, original_directory = None, annotations_directory=None, original_extension=None, cache_directory=None, train_cache_size=20, statistics=None):
 
     # call base class constructor
     self.original_directory = original_directory
@@ -31,6 +186,10 @@ class Database(bob.db.base.Database):
     #Creating our data structure to deal with the db files
     self.memory_db = {}
     self.templates = {} #Dictionary with the templates in a unique list
+    self._template_index = None #Dictionary template_id -> {protocol: client_id}, see _get_template_index
+    self._file_indexes = {} #Indexes of the files by media id and frame, see _file_index
+    self._subject_indexes = {} #Subject ids of the loaded templates, see _subject_index
+    self._files = weakref.WeakValueDictionary() #Interned files of all protocols, by file id
 
     if(annotations_directory is None):#Get the default location
       import pkg_resources
@@ -38,22 +197,59 @@ class Database(bob.db.base.Database):
 
     self.annotations_directory = annotations_directory
 
+    #Task, split number and file lists of each protocol
+    self.protocol_table = self._build_protocol_table()
 
-  def _solve_comparisons(self, protocol):
+    if cache_directory is None:
+      cache_directory = cache.default_cache_directory()
+    self.cache_directory = cache_directory
+
+    #LRU cache of the training sets, keyed by the file list
+    self.train_cache_size = train_cache_size
+    self._train_cache = collections.OrderedDict()
+    self._train_keys = {} #Signature and content key of the training file lists, see _train_key
+
+    #Locks for concurrent queries: one lock guarding the shared dictionaries, and one lock per file list being loaded
+    self._lock = threading.Lock()
+    self._load_locks = {}
+    self._intern_lock = threading.Lock()
+    self._async_loads = {} #Running loads of the asyncio interface, see _aload
+
+    #Opt-in statistics of the loads and queries, see stats
+    self._statistics = None
+    if statistics is None and instrumentation.environment_enabled():
+      self._statistics = instrumentation.Statistics()
+      instrumentation.register(self)
+    elif statistics:
+      self._statistics = instrumentation.Statistics()
+
+
+  def _build_protocol_table(self):
     """
-    Given a protocol, try to solve the filename verify_comparisons_[n].csv where n is the split number
+    Creates the table that maps each protocol name to its task ('search' or 'compare'), its split number and the paths of all its file lists
     """
 
-    relative_dir = "IJB-A_11_sets"
+    table = {}
+    for task, relative_dir in (("search", "IJB-A_1N_sets"), ("compare", "IJB-A_11_sets")):
+      for split_number in range(1, 11):
+        directory = os.path.join(self.annotations_directory, relative_dir, "split{0}".format(split_number))
+        entry = {'task': task, 'split': split_number, 'train': os.path.join(directory, "train_{0}.csv".format(split_number))}
+        if task == "search":
+          entry['enroll'] = os.path.join(directory, "search_gallery_{0}.csv".format(split_number))
+          entry['probe'] = os.path.join(directory, "search_probe_{0}.csv".format(split_number))
+        else:
+          entry['metadata'] = os.path.join(directory, "verify_metadata_{0}.csv".format(split_number))
+          entry['comparisons'] = os.path.join(directory, "verify_comparisons_{0}.csv".format(split_number))
+        table["{0}_split{1}".format(task, split_number)] = entry
+    return table
+
 
-    #Getting the split
-    for i in range(1,10):
-      split = "split{0}".format(i)
-      if(split in protocol):
-        relative_dir = os.path.join(self.annotations_directory,relative_dir,split,"verify_comparisons_{0}.csv".format(i))
-        break
+  def _solve_comparisons(self, protocol):
+    """
+    Given a protocol, try to solve the filename verify_comparisons_[n].csv where n is the split number
+    """
 
-    return relative_dir
+    return self.protocol_table[protocol]['comparisons']
 
 
   def _solve_filename(self, protocol, purpose):
@@ -61,64 +257,373 @@ class Database(bob.db.base.Database):
     Given a protocol and the purpose, try to solve the filename
     """
 
-    relative_dir = ""
+    entry = self.protocol_table[protocol]
+    if purpose == "train":
+      return entry['train']
+    if entry['task'] == "search":
+      return entry['enroll'] if purpose == "enroll" else entry['probe']
+    #comparison
+    return entry['metadata']
 
-    #Getting the recognition task
-    if("search" in protocol):
-      relative_dir = "IJB-A_1N_sets"
-    else:
-      relative_dir = "IJB-A_11_sets"
 
-    #Getting the split
-    for i in range(1,10):
-      split = "split{0}".format(i)
-      if(split in protocol):
-        relative_dir = os.path.join(relative_dir,split)
-        split_number = i
-        break
+  def _load_columns(self, filename, parser, preloaded=None):
+    """
+    Returns the columns of the given file list, which might have been parsed already by :py:meth:`preload`, and their source ('preloaded', 'compiled' or 'parsed')
+    """
 
-    #Getting the file
-    if purpose=="train":
-      return os.path.join(self.annotations_directory, relative_dir,"train_{0}.csv".format(split_number))
+    if preloaded is not None and filename in preloaded:
+      return preloaded[filename], 'preloaded'
+    columns, hit = cache.load(filename, parser, self.cache_directory, report=True)
+    return columns, 'compiled' if hit else 'parsed'
 
-    if("search" in protocol):
-      if purpose=="enroll":
-        return os.path.join(self.annotations_directory,relative_dir,"search_gallery_{0}.csv".format(split_number))
-      else:
-        return os.path.join(self.annotations_directory,relative_dir,"search_probe_{0}.csv".format(split_number))
 
-    else:
-      #comparison
-      return os.path.join(self.annotations_directory, relative_dir,"verify_metadata_{0}.csv".format(split_number))
+  def _get_templates(self, filename, preloaded=None):
+    """
+    Returns the templates of the given file list, which might have been parsed already by :py:meth:`preload`
+    """
+
+    start = time.perf_counter()
+    columns, source = self._load_columns(filename, read_columns, preloaded)
+    # files with the same id share one File object in all protocols
+    templates = templates_from_columns(columns, files=self._files, lock=self._intern_lock)
 
+    if self._statistics is not None:
+      self._statistics.load(filename, len(columns['template_id']), time.perf_counter() - start, source)
+    return templates
 
-  def _load_data(self, protocol, group, purpose):
+
+  def _get_comparisons(self, filename, preloaded=None):
     """
-    Check and load the data from a specific protocol in the variable self.memory_db
+    Returns the comparisons of the given file list, which might have been parsed already by :py:meth:`preload`
     """
 
-    if not protocol in self.memory_db:
-      self.memory_db[protocol] = {}
+    start = time.perf_counter()
+    columns, source = self._load_columns(filename, read_comparisons, preloaded)
+    comparisons = Comparisons(columns['pairs'])
+
+    if self._statistics is not None:
+      self._statistics.load(filename, len(columns['pairs']), time.perf_counter() - start, source)
+    return comparisons
+
+
+  def _lock_for(self, key):
+    """
+    Returns the lock that serializes the loading of the given key, e.g., ``(protocol, purpose)``, which is created on first use
+    """
+
+    with self._lock:
+      lock = self._load_locks.get(key)
+      if lock is None:
+        lock = self._load_locks[key] = threading.Lock()
+      return lock
+
+
+  def _publish(self, protocol, entries):
+    """
+    Replaces the data of the given protocol by a copy that contains the given entries, and returns the new data
+
+    Queries that still use the old data are not affected; this function needs to be called while holding ``self._lock``.
+    """
+
+    data = dict(self.memory_db.get(protocol, {}))
+    data.update(entries)
+    self.memory_db[protocol] = data
+    return data
+
+
+  def _train_key(self, filename):
+    """
+    Returns the key of the given training file list in the LRU cache of the training sets, which is computed from its content, so that identical file lists of both tasks share one training set
+
+    The content is only read again when the modification time or the size of the file list changes.
+    """
+
+    filename = os.path.realpath(filename)
+    source = tuple(cache.signature(filename).tolist())
+    known = self._train_keys.get(filename)
+    if known is None or known[0] != source:
+      known = self._train_keys[filename] = (source, cache.digest(filename))
+    return known[1]
+
+
+  def _load_train(self, filename, preloaded=None):
+    """
+    Returns the training templates of the given file list, using the LRU cache of the training sets
+    """
+
+    key = self._train_key(filename)
+    # lock-free fast path for loaded training sets; the LRU order is only updated when the lock is free
+    templates = self._train_cache.get(key)
+    if templates is not None:
+      if self._lock.acquire(blocking=False):
+        try:
+          if key in self._train_cache:
+            self._train_cache.move_to_end(key)
+        finally:
+          self._lock.release()
+      return templates
+
+    with self._lock_for(("train", key)):
+      # another thread might have loaded the training set in the meantime
+      with self._lock:
+        if key in self._train_cache:
+          self._train_cache.move_to_end(key)
+          return self._train_cache[key]
+
+      templates = self._get_templates(filename, preloaded)
+
+      with self._lock:
+        self._train_cache[key] = templates
+        while self.train_cache_size is not None and len(self._train_cache) > self.train_cache_size:
+          _, evicted = self._train_cache.popitem(last=False)
+          # release the references of the protocols to the evicted training set
+          for protocol, data in list(self.memory_db.items()):
+            if data.get('train') is evicted:
+              self.memory_db[protocol] = dict((k, v) for k, v in data.items() if k != 'train')
+          self._file_indexes = dict((k, index) for k, index in self._file_indexes.items() if index.templates is not evicted)
+          self._subject_indexes = dict((k, index) for k, index in self._subject_indexes.items() if index.templates is not evicted)
+
+    return templates
+
+
+  def _evicted(self, key, templates):
+    """
+    Checks if the given ``templates`` are a training set (``key == 'train'``) that has been evicted from the LRU cache; this function needs to be called while holding ``self._lock``
+    """
+
+    return key == 'train' and not any(t is templates for t in self._train_cache.values())
+
+
+  def _load_data(self, protocol, group, purpose, preloaded=None):
+    """
+    Check and load the data from a specific protocol in the variable self.memory_db, and return the data of the protocol
+
+    The ``preloaded`` dictionary might contain the columns of already parsed file lists, see :py:meth:`preload`.
+    The returned dictionary is never modified, so that it can be used even when other threads load more data.
+    """
 
     #Training set is the same for both major protocols (search and comparison)
     if purpose=="train":
-      self.memory_db[protocol][purpose] = get_templates(self._solve_filename(protocol,purpose))
-      return
+      templates = self._load_train(self._solve_filename(protocol,purpose), preloaded)
+      data = self.memory_db.get(protocol, {})
+      if data.get('train') is templates:
+        return data
+      self._subject_index(protocol, 'train', templates)
+      with self._lock:
+        # another thread might have evicted the training set in the meantime, which must not be published again
+        if self._evicted('train', templates):
+          return dict(self.memory_db.get(protocol, {}), train=templates)
+        return self._publish(protocol, {'train' : templates})
 
     #Special treatment for the comparison
+    key = purpose if "search" in protocol else 'comparison-templates'
+    data = self.memory_db.get(protocol, {})
+    if key in data:
+      return data
+
+    # only one thread loads the file list, while the others wait for it
+    with self._lock_for((protocol, key)):
+      data = self.memory_db.get(protocol, {})
+      if key in data:
+        return data
+
+      if "search" in protocol:
+        entries = {purpose : self._get_templates(self._solve_filename(protocol,purpose), preloaded)}
+      else:
+        entries = {
+          'comparison-templates' : self._get_templates(self._solve_filename(protocol,""), preloaded),
+          'comparisons'          : self._get_comparisons(self._solve_comparisons(protocol), preloaded),
+        }
+
+      self._subject_index(protocol, key, entries[key])
+      with self._lock:
+        self.templates.update(entries[key])
+        return self._publish(protocol, entries)
+
+
+  def _is_loaded(self, protocol, purpose):
+    """
+    Checks if the data of the given protocol and purpose ('train', 'enroll' or 'probe') is already loaded
+    """
+
+    if purpose == "train":
+      return self._train_key(self._solve_filename(protocol, purpose)) in self._train_cache
     if "search" in protocol:
-      if not purpose in self.memory_db[protocol]:
-        templates =                       get_templates(self._solve_filename(protocol,purpose))
-        self.memory_db[protocol][purpose] = templates
+      return purpose in self.memory_db.get(protocol, {})
+    return 'comparison-templates' in self.memory_db.get(protocol, {})
+
 
-        self.templates.update(templates)
+  def _purpose_files(self, protocol, purpose):
+    """
+    Returns the list of ``(filename, parser)`` tuples of the file lists that define the given protocol and purpose ('train', 'enroll' or 'probe')
+    """
+
+    if purpose == "train" or "search" in protocol:
+      return [(self._solve_filename(protocol, purpose), read_columns)]
+    return [(self._solve_filename(protocol, ""), read_columns), (self._solve_comparisons(protocol), read_comparisons)]
+
+
+  def _source_files(self, protocol):
+    """
+    Returns the list of ``(filename, parser)`` tuples of all file lists that define the given protocol
+    """
+
+    sources = []
+    for purpose in ("train", "enroll", "probe"):
+      sources.extend(s for s in self._purpose_files(protocol, purpose) if s not in sources)
+    return sources
+
+
+  def preload(self, protocols=None, purposes=None, workers=None):
+    """Loads the file lists of several protocols in parallel.
+
+    The independent file lists are parsed (or read from the compiled cache) in a pool of worker processes, and the results are merged into this database.
+    The parsing time of each file list is reported through the ``bob.db.ijba`` logger.
+
+    Keyword Parameters:
+
+    protocols : str or [str] or ``None``
+      The protocols to load; if not given, all protocols are loaded.
+
+    purposes : str or [str] or ``None``
+      The purposes ('train', 'enroll', 'probe') to load; if not given, all purposes are loaded.
+
+    workers : int or ``None``
+      The number of worker processes; if not given, the number of CPUs is used.
+      With ``workers=1``, the file lists are parsed in the current process.
+
+    Returns: a dictionary with the time (in seconds) needed to parse each of the file lists.
+    """
+
+    protocols = self.check_parameters_for_validity(protocols, "protocol", self.protocol_names())
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ("train", "enroll", "probe"))
+
+    return self._preload([(protocol, purpose) for protocol in protocols for purpose in purposes], workers)
+
+
+  def _preload(self, requests, workers=None):
+    """
+    Loads the data of the given list of ``(protocol, purpose)`` tuples in parallel, see :py:meth:`preload`
+    """
+
+    # collect the file lists that are not yet loaded
+    requests = [(protocol, purpose) for protocol, purpose in requests if not self._is_loaded(protocol, purpose)]
+    sources = []
+    for protocol, purpose in requests:
+      sources.extend((f, p, self.cache_directory) for f, p in self._purpose_files(protocol, purpose) if (f, p, self.cache_directory) not in sources)
+
+    train_files = set(self._train_key(self._solve_filename(p, "train")) for p, purpose in requests if purpose == "train")
+    if self.train_cache_size is not None and len(train_files) > self.train_cache_size:
+      logger.warning("Preloading %d training sets, but only %d of them are kept; increase the 'train_cache_size' of the Database", len(train_files), self.train_cache_size)
+
+    preloaded, timings = {}, {}
+    start = time.time()
+    if workers == 1 or len(sources) <= 1:
+      results = (_parse(s) for s in sources)
+      executor = None
     else:
-      if not 'comparison-templates' in self.memory_db[protocol]:
-        templates                                        = get_templates(self._solve_filename(protocol,""))
-        self.memory_db[protocol]['comparison-templates'] = templates
-        self.memory_db[protocol]['comparisons']          = get_comparisons(self._solve_comparisons(protocol))
-        self.templates.update(templates)
+      executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+      results = (f.result() for f in concurrent.futures.as_completed([executor.submit(_parse, s) for s in sources]))
+
+    try:
+      for filename, columns, seconds in results:
+        preloaded[filename] = columns
+        timings[filename] = seconds
+        logger.info("Loaded '%s' (%d rows) in %.3f s (%d of %d)", filename, len(next(iter(columns.values()))), seconds, len(preloaded), len(sources))
+    finally:
+      if executor is not None:
+        executor.shutdown()
+
+    # merge the parsed file lists
+    for protocol, purpose in requests:
+      self._load_data(protocol, "world" if purpose == "train" else "dev", purpose if purpose == "train" or "search" in protocol else "", preloaded)
+
+    logger.info("Preloaded %d file lists of %d protocols in %.3f s", len(sources), len(set(p for p, _ in requests)), time.time() - start)
+    return timings
+
+
+  def _template_files(self, protocol):
+    """
+    Returns the file lists that define the enrollment and probe templates of the given protocol
+    """
+
+    if "search" in protocol:
+      return [self._solve_filename(protocol, p) for p in ("enroll", "probe")]
+    return [self._solve_filename(protocol, "")]
+
+
+  def _build_template_index(self):
+    """
+    Collects the template ids and client ids of the enrollment and probe templates of all protocols into columns
+    """
+
+    template_ids, client_ids, protocol_ids = [], [], []
+    for index, protocol in enumerate(self.protocols()):
+      for filename in self._template_files(protocol):
+        columns = cache.load(filename, read_columns, self.cache_directory)
+        # one entry per template and protocol
+        ids, rows = numpy.unique(columns['template_id'], return_index=True)
+        template_ids.append(ids)
+        client_ids.append(columns['subject_id'][rows])
+        protocol_ids.append(numpy.full(len(ids), index, dtype=numpy.int64))
+
+    return {
+      'template_id' : numpy.concatenate(template_ids),
+      'client_id'   : numpy.concatenate(client_ids),
+      'protocol'    : numpy.concatenate(protocol_ids),
+    }
+
+
+  def _get_template_index(self, force=False):
+    """
+    Returns the dictionary template_id -> {protocol: client_id} of all enrollment and probe templates, which is stored in the compiled cache
+    """
 
+    if self._template_index is not None and not force:
+      return self._template_index
+
+    with self._lock_for("template_index"):
+      if self._template_index is None or force:
+        protocols = self.protocols()
+        filenames = sorted(set(f for p in protocols for f in self._template_files(p)))
+        columns = cache.load_derived("template_index", filenames, self._build_template_index, self.cache_directory, force=force)
+
+        index = {}
+        for template_id, client_id, protocol in zip(columns['template_id'].tolist(), columns['client_id'].tolist(), columns['protocol'].tolist()):
+          index.setdefault(template_id, {})[protocols[protocol]] = client_id
+        self._template_index = index
+
+      return self._template_index
+
+
+  def compile(self, protocols=None, force=False):
+    """Prebuilds the compiled cache of the file lists for the given protocols.
+
+    Keyword Parameters:
+
+    protocols : str or [str] or ``None``
+      The protocols to compile; if not given, all protocols are compiled.
+
+    force : bool
+      If set, the compiled files are rebuilt even if they are up to date.
+
+    Returns: a list of the source files that have been compiled.
+    """
+
+    if not self.cache_directory:
+      raise ValueError("The compiled cache was disabled in the constructor.")
+    protocols = self.check_parameters_for_validity(protocols, "protocol", self.protocol_names())
+
+    compiled = []
+    for protocol in protocols:
+      for filename, parser in self._source_files(protocol):
+        # file lists shared between protocols are compiled only once
+        if filename not in compiled:
+          cache.load(filename, parser, self.cache_directory, force=force)
+          compiled.append(filename)
+
+    self._get_template_index(force=force)
+    return compiled
 
 
   def provides_file_set_for_protocol(self, protocol=None):
@@ -163,6 +668,7 @@ class Database(bob.db.base.Database):
     return self.client_ids(groups = groups, protocol = protocol)
 
 
+  @instrumented
   def client_ids(self, groups=None, protocol='search_split1'):
     """Returns a list of client ids (aka. subject_id) for the specific query by the user.
 
@@ -175,29 +681,54 @@ class Database(bob.db.base.Database):
     protocol
       One of the available protocol names, see :py:meth:`protocol_names`.
 
-    Returns: A list containing all the client ids which have the desired properties.
+    The client ids of each file list are computed once when it is loaded, so that no :py:class:`File` objects are created.
+
+    Returns: A sorted list containing all the client ids which have the desired properties.
     """
 
     protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
 
-    if "search" in protocol:
-      objects = self.objects(groups=groups, protocol=protocol)
-    else:
+    indexes = self._subject_indexes_of(groups, protocol, ("enroll", "probe"))
+    if len(indexes) == 1:
+      return indexes[0].subject_ids.tolist()
+    return numpy.unique(numpy.concatenate([index.subject_ids for index in indexes])).tolist()
 
-      objects = []
-      for g in groups:
-          if g == "world":
-            objects.extend(self.objects(groups=g, protocol=protocol))
-          else:
-            self._load_data(protocol, "dev", "")
-            objects.extend([o for t in self.memory_db[protocol]['comparison-templates'] for o in self.memory_db[protocol]['comparison-templates'][t].files ])
 
-    ids = list(set([o.client_id for o in objects ]))
+  @instrumented
+  def subject_counts(self, groups=None, protocol='search_split1', purposes=None):
+    """Returns the number of templates and files of each client (aka. subject_id), without creating any :py:class:`File` object.
 
-    return ids
+    Keyword Parameters:
 
+    groups : str or [str] or ``None``
+      One or several groups ('world', 'dev').
+      If not specified, all groups are counted.
 
+    protocol : str
+      One of the available protocol names, see :py:meth:`protocol_names`.
+
+    purposes : str or [str] or ``None``
+      One or several purposes ('enroll', 'probe') of the 'dev' group.
+      For the ``compare_splitN`` protocols, the enrollment and probe templates are taken from the same list, and they are counted only once.
+
+    Returns: a dictionary from client id to a dictionary with the number of ``templates`` and ``files`` of the client.
+    """
+
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    groups = self.check_parameters_for_validity(groups, "group", self.groups())
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
+
+    counts = {}
+    for index in self._subject_indexes_of(groups, protocol, purposes):
+      for subject_id, templates, files in zip(index.subject_ids.tolist(), index.template_counts.tolist(), index.file_counts.tolist()):
+        entry = counts.setdefault(subject_id, {'templates' : 0, 'files' : 0})
+        entry['templates'] += templates
+        entry['files'] += files
+    return counts
+
+
+  @instrumented
   def model_ids(self, groups=None, protocol='search_split1', purposes='enroll', model_ids=None):
     """Returns a list of model ids for the specific query by the user.
 
@@ -218,32 +749,51 @@ class Database(bob.db.base.Database):
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
     purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
 
+    return self._model_ids(protocol, purposes, model_ids)
+
+
+  def _model_ids(self, protocol, purposes, model_ids):
+    """
+    Returns the model ids of the already checked query, see :py:meth:`model_ids`
+    """
+
     ids = []
     if "search" in protocol:
       for p in purposes:
-        self._load_data(protocol, "dev", p)
-        ids.extend([t for t in self.memory_db[protocol][p]])
+        ids.extend([t for t in self._load_data(protocol, "dev", p)[p]])
     else:
-      self._load_data(protocol, "dev", "")
+      comparisons = self._load_data(protocol, "dev", "")['comparisons']
       for p in purposes:
 
         if p == "enroll":
-          for c in self.memory_db[protocol]['comparisons']:
-            ids.append(c)
+          ids.extend(comparisons.model_ids.tolist())
         else:
           if(model_ids is None):
-            for c in self.memory_db[protocol]['comparisons']:
-              for probe in self.memory_db[protocol]['comparisons'][c]:
-                ids.append(probe)
+            ids.extend(comparisons.probes.tolist())
           else:
             for c in model_ids:
-              for probe in self.memory_db[protocol]['comparisons'][c]:
-                ids.append(probe)
+              ids.extend(comparisons[c].tolist())
 
     return ids
 
 
 
+  @instrumented
+  def comparisons(self, protocol):
+    """Returns the :py:class:`Comparisons` of the given ``compare_splitN`` protocol, which provide the probes of each model in compressed sparse row layout."""
+
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    if "search" in protocol:
+      raise ValueError("The protocol '%s' does not define a list of comparisons; all probes are compared with all models." % protocol)
+    return self._load_data(protocol, "dev", "")['comparisons']
+
+
+  def comparison_pairs(self, protocol):
+    """Returns all comparisons of the given ``compare_splitN`` protocol as an ``(N, 2)`` integer array of ``(model_id, probe_id)`` template id pairs, in the order of the comparison file list."""
+
+    return self.comparisons(protocol).pairs
+
+
   def template_ids(self, protocol='search_split1'):
     """Returns a list of valid template ids, where :py:class:`Template`'s can be used both for model enrollment or probing.
 
@@ -254,7 +804,107 @@ class Database(bob.db.base.Database):
 
 
 
-  def objects(self, groups=None, protocol='search_split1', purposes=None, model_ids=None, media_ids=None, frames=None):
+  def _file_index(self, protocol, key, templates):
+    """
+    Returns the :py:class:`_FileIndex` of the given ``templates``, which are stored in ``self.memory_db[protocol][key]``; the index is created on first use
+    """
+
+    index = self._file_indexes.get((protocol, key))
+    # the templates might have been reloaded, e.g., after eviction of a training set
+    if index is None or index.templates is not templates:
+      with self._lock_for(("index", protocol, key)):
+        index = self._file_indexes.get((protocol, key))
+        if index is None or index.templates is not templates:
+          index = _FileIndex(templates)
+          with self._lock:
+            if not self._evicted(key, templates):
+              self._file_indexes[(protocol, key)] = index
+    return index
+
+
+  def _subject_index(self, protocol, key, templates):
+    """
+    Returns the :py:class:`_SubjectIndex` of the given ``templates``, which are stored in ``self.memory_db[protocol][key]``; the index is created when the templates are loaded
+    """
+
+    index = self._subject_indexes.get((protocol, key))
+    if index is None or index.templates is not templates:
+      index = _SubjectIndex(templates)
+      with self._lock:
+        if not self._evicted(key, templates):
+          self._subject_indexes[(protocol, key)] = index
+    return index
+
+
+  def _subject_indexes_of(self, groups, protocol, purposes):
+    """
+    Returns the :py:class:`_SubjectIndex` objects of the templates of the given groups and purposes, loading the templates if required
+    """
+
+    indexes = []
+    if 'world' in groups:
+      indexes.append(self._subject_index(protocol, 'train', self._load_data(protocol, "world", "train")['train']))
+    if 'dev' in groups:
+      if "search" in protocol:
+        for p in purposes:
+          indexes.append(self._subject_index(protocol, p, self._load_data(protocol, "dev", p)[p]))
+      else:
+        templates = self._load_data(protocol, "dev", "")['comparison-templates']
+        indexes.append(self._subject_index(protocol, 'comparison-templates', templates))
+    return indexes
+
+
+  def _selections(self, groups, protocol, purposes, model_ids, load=True):
+    """
+    Yields ``(key, templates, template_ids)`` tuples of the given query, where ``key`` is the entry of ``self.memory_db[protocol]`` that contains the ``templates``, and ``template_ids`` are the selected templates in query order (``None`` for all templates)
+
+    The data of each selection is loaded right before it is yielded.
+    If ``load`` is not set, templates that are not loaded yet are not loaded; instead, the file list that defines them is yielded as ``templates``.
+    """
+
+    def _templates(group, purpose, key):
+      if load or self._is_loaded(protocol, purpose):
+        return self._load_data(protocol, group, purpose)[key]
+      return self._solve_filename(protocol, purpose)
+
+    if 'world' in groups:
+      yield 'train', _templates("world", "train", 'train'), None
+
+    if 'dev' in groups:
+
+      #Dealing with the search protocol
+      if "search" in protocol:
+        if 'enroll' in purposes:
+          yield 'enroll', _templates("dev", "enroll", 'enroll'), model_ids
+
+        if 'probe' in purposes:
+          #The probes for the search are the same for all users
+          yield 'probe', _templates("dev", "probe", 'probe'), None
+
+      #Dealing with comparisons
+      else:
+
+        templates = _templates("dev", "", 'comparison-templates')
+        # the comparisons are small, and they are needed to select the templates
+        comparisons = self.memory_db.get(protocol, {}).get('comparisons')
+        if comparisons is None:
+          comparisons = self._get_comparisons(self._solve_comparisons(protocol))
+
+        if 'enroll' in purposes:
+          if model_ids is None:
+            yield 'comparison-templates', templates, list(comparisons)
+          else:
+            yield 'comparison-templates', templates, model_ids
+
+        if 'probe' in purposes:
+          if model_ids is None:
+            yield 'comparison-templates', templates, None
+          else:
+            yield 'comparison-templates', templates, [probe for c in model_ids for probe in comparisons[c].tolist()]
+
+
+  @instrumented
+  def objects(self, groups=None, protocol='search_split1', purposes=None, model_ids=None, media_ids=None, frames=None, shard=None, shard_by='file'):
     """Using the specified restrictions, this function returns a list of File objects.
 
     Keyword Parameters:
@@ -280,70 +930,109 @@ class Database(bob.db.base.Database):
     frames : int or [int] or ``None``
       If given, only the video files with the given frame number are returned.
       Note that the images of the database will be ignored, when this option is selected.
+
+    shard : (int, int) or ``None``
+      If given as ``(k, n)``, the query is split into ``n`` shards, and only the files of the ``k``-th shard (counting from 0) are returned.
+      The shards are deterministic and balanced: files (or templates) are assigned to the shards in turn, ordered by template first, also when ``media_ids`` or ``frames`` are given.
+
+    shard_by : str
+      Split the query by ``'file'`` (the default), or by ``'template'``, so that all files of a template end up in the same shard.
+
+    The ``media_ids`` and ``frames`` are looked up in hash indexes of the protocol, so that the files are ordered by the given media ids (or frames) first.
     """
 
     # check that every parameter is as expected
     groups = self.check_parameters_for_validity(groups, "group", ["dev","world"])
     purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
     protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    model_ids, media_ids, frames = _as_list(model_ids), _as_list(media_ids), _as_list(frames)
 
-    # collect the queries
-    objects = []
-    if 'world' in groups:
-      self._load_data(protocol, "world", "train")
-      objects.extend([o for t in self.memory_db[protocol]['train'] for o in self.memory_db[protocol]['train'][t].files ])
+    return list(self.iter_objects(groups, protocol, purposes, model_ids, media_ids, frames, shard, shard_by))
 
-    if 'dev' in groups:
-
-      #Dealing with the search protocol
-      if "search" in protocol:
-        if 'enroll' in purposes:
-          self._load_data(protocol, "dev", "enroll")
-
-          if(model_ids is None):
-            objects.extend([o for t in self.memory_db[protocol]['enroll'] for o in self.memory_db[protocol]['enroll'][t].files])
-          else:
-            objects.extend([o for t in model_ids for o in self.memory_db[protocol]['enroll'][t].files])
 
+  def iter_objects(self, groups=None, protocol='search_split1', purposes=None, model_ids=None, media_ids=None, frames=None, shard=None, shard_by='file'):
+    """Yields the same File objects as :py:meth:`objects`, in the same order.
 
-        if 'probe' in purposes:
-          self._load_data(protocol, "dev", "probe")
-
-          #The probes for the search are the same for all users
-          objects.extend([o for t in self.memory_db[protocol]['probe'] for o in self.memory_db[protocol]['probe'][t].files])
-
+    The parameters are checked immediately, but the data of each group and purpose is only loaded when the iteration reaches it, and no list of files is created.
+    When iterating a ``shard`` of templates that are not loaded yet, only the files of the shard are created, and the templates are not loaded.
+    See :py:meth:`objects` for the description of the parameters.
+    """
 
-      #Dealing with comparisons
-      else:
+    # check that every parameter is as expected
+    groups = self.check_parameters_for_validity(groups, "group", ["dev","world"])
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    model_ids, media_ids, frames = _as_list(model_ids), _as_list(media_ids), _as_list(frames)
+    shard_by = self.check_parameter_for_validity(shard_by, "shard_by", ("file", "template"))
+    if shard is not None:
+      k, n = shard
+      if not 0 <= k < n:
+        raise ValueError("The shard (%d, %d) is invalid; it needs to be (k, n) with 0 <= k < n." % (k, n))
 
-        self._load_data(protocol, "dev", "")
+    return self._iter_objects(groups, protocol, purposes, model_ids, media_ids, frames, shard, shard_by)
 
-        if 'enroll' in purposes:
 
-          if model_ids is None:
-            for c in self.memory_db[protocol]['comparisons']:
-              objects.extend(self.memory_db[protocol]['comparison-templates'][c].files)
-          else:
-            for m in model_ids:
-              objects.extend(self.memory_db[protocol]['comparison-templates'][m].files)
+  def _iter_objects(self, groups, protocol, purposes, model_ids, media_ids, frames, shard=None, shard_by='file'):
+    """
+    Yields the files of the already checked query, see :py:meth:`iter_objects`
 
+    If ``shard=(k, n)`` is given, only every ``n``-th file (or the files of every ``n``-th template), starting with the ``k``-th, are yielded.
+    The files are ordered by template first, also when ``media_ids`` or ``frames`` are given.
+    For templates that are not loaded yet, the rows of the shard are selected from the ``template_id`` column of the file list, and only the files of these rows are created.
+    """
 
-        if 'probe' in purposes:
-          if(model_ids is None):
-            for t in self.memory_db[protocol]['comparison-templates']:
-              objects.extend(self.memory_db[protocol]['comparison-templates'][t].files)
-            #import ipdb; ipdb.set_trace();
-            #raise ValueError("`model_ids` parameter required for the protocol `{0}`. For the comparison protocols, each model has an specific set of probes.".format(protocol))
-          else:
-            for c in model_ids:
-              for probe in self.memory_db[protocol]['comparisons'][c]:
-                objects.extend(self.memory_db[protocol]['comparison-templates'][probe].files)
+    if shard is not None:
+      k, n = shard
+
+    position = 0
+    for key, templates, template_ids in self._selections(groups, protocol, purposes, model_ids, load=shard is None):
+      filtered = media_ids is not None or frames is not None
+
+      if isinstance(templates, str):
+        # select the rows of the shard from the columns of the file list, which is not loaded
+        columns, _ = self._load_columns(templates, read_columns)
+        template_ids = _template_order(columns['template_id']) if template_ids is None else template_ids
+        if shard_by == "template":
+          owned = template_ids[(k - position) % n::n]
+          position += len(template_ids)
+          rows = _template_rows(columns, owned, media_ids, frames)
+        else:
+          rows = _template_rows(columns, template_ids, media_ids, frames)
+          owned = rows[(k - position) % n::n]
+          position += len(rows)
+          rows = owned
+        files = _interned_files(columns, self._files, True, self._intern_lock, rows)
+
+      elif shard is not None:
+        template_ids = list(templates) if template_ids is None else template_ids
+        if shard_by == "template":
+          owned = template_ids[(k - position) % n::n]
+          position += len(template_ids)
+          template_ids = owned
+        if filtered:
+          index = self._file_index(protocol, key, templates)
+          files = (f for t in template_ids for f in index.files([t], media_ids, frames))
+        else:
+          files = (o for t in template_ids for o in templates[t].files)
 
+      elif filtered:
+        files = self._file_index(protocol, key, templates).files(template_ids, media_ids, frames)
+      elif template_ids is None:
+        files = (o for t in templates for o in templates[t].files)
+      else:
+        files = (o for t in template_ids for o in templates[t].files)
 
-    # we have collected all queries, now extract the File objects
-    return objects
+      # the loaded files are counted while iterating, so that no list of files is created
+      counted = shard is not None and shard_by == "file" and not isinstance(templates, str)
+      for f in files:
+        if counted:
+          position += 1
+          if (position - 1) % n != k:
+            continue
+        yield f
 
 
+  @instrumented
   def object_sets(self, groups='dev', protocol='search_split1', purposes='probe', model_ids=None, media_ids=None, frames=None):
     """Using the specified restrictions, this function returns a list of :py:class:`Template` objects.
 
@@ -359,7 +1048,8 @@ class Database(bob.db.base.Database):
       Only the 'probe' purpose is accepted.
 
     model_ids : int or [int] or ``None``
-      ignored
+      If given, the probe templates to be compared with these models (for the 'probe' purpose), or the model templates themselves (for the 'enroll' purpose) are returned.
+      Otherwise, all templates of the given purposes are returned.
 
     media_ids : int or [int] or ``None``
       If given, only the files with the given media ids are returned.
@@ -367,42 +1057,292 @@ class Database(bob.db.base.Database):
     frames : int or [int] or ``None``
       If given, only the video files with the given frame number are returned.
       Note that the images of the database will be ignored, when this option is selected.
+
+    When ``media_ids`` or ``frames`` are given, the returned templates contain only the selected files, and templates without any selected file are skipped.
+    """
+
+    return list(self.iter_object_sets(groups, protocol, purposes, model_ids, media_ids, frames))
+
+
+  def iter_object_sets(self, groups='dev', protocol='search_split1', purposes='probe', model_ids=None, media_ids=None, frames=None):
+    """Yields the same :py:class:`Template` objects as :py:meth:`object_sets`, in the same order.
+
+    The parameters are checked immediately, but the data is only loaded when the iteration starts.
+    See :py:meth:`object_sets` for the description of the parameters.
     """
 
     # check that every parameter is as expected
     #groups = self.check_parameters_for_validity(groups, "group", ["dev","world"])
     purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
     protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    model_ids, media_ids, frames = _as_list(model_ids), _as_list(media_ids), _as_list(frames)
+
+    return self._iter_object_sets(protocol, purposes, model_ids, media_ids, frames)
+
+
+  def _iter_object_sets(self, protocol, purposes, model_ids, media_ids, frames):
+    """
+    Yields the templates of the already checked query, see :py:meth:`iter_object_sets`
+    """
 
-    templates = []
-    self._load_data(protocol, "dev", "enroll")
-    self._load_data(protocol, "dev", "probe")
     for p in purposes:
-      for m in model_ids:
-        if "probe" in p:
-          template_ids = self.model_ids(groups="dev", protocol=protocol, purposes=p, model_ids=[m])
-          if "search" in protocol:
-            for t in template_ids:
-              templates.append(self.memory_db[protocol][p][t])
-          else:
-             for t in template_ids:
-               templates.append(self.memory_db[protocol]['comparison-templates'][t])
+      key = p if "search" in protocol else 'comparison-templates'
+      templates = self._load_data(protocol, "dev", p)[key]
 
-        else:
-          templates.extend(self.memory_db[protocol][p][m])
+      if model_ids is None:
+        template_ids = self._model_ids(protocol, [p], None)
+      elif "probe" in p:
+        template_ids = (t for m in model_ids for t in self._model_ids(protocol, [p], [m]))
+      else:
+        template_ids = model_ids
+
+      index = self._file_index(protocol, key, templates) if media_ids is not None or frames is not None else None
+      for t in template_ids:
+        template = templates[t]
+        if index is not None:
+          template = index.template(template, media_ids, frames)
+        if template is not None:
+          yield template
+
+
+
+  def _requests(self, groups, protocol, purposes):
+    """
+    Returns the ``(protocol, purpose)`` tuples that need to be loaded for the given query, with purposes as in :py:meth:`preload`
+    """
+
+    requests = []
+    if 'world' in groups:
+      requests.append((protocol, "train"))
+    if 'dev' in groups:
+      requests.extend((protocol, p) for p in purposes)
+    return requests
+
+
+  async def _aload(self, requests, workers=1):
+    """
+    Loads the given ``(protocol, purpose)`` tuples in the default executor of the running event loop, see :py:meth:`_preload`
+
+    File lists that are already being loaded by another coroutine are awaited instead of being loaded again.
+    Returns the parsing times of the file lists, see :py:meth:`preload`.
+    """
+
+    loop = asyncio.get_running_loop()
+    waiting, missing = [], collections.OrderedDict()
+    for protocol, purpose in requests:
+      if self._is_loaded(protocol, purpose):
+        continue
+      # the enrollment and probe templates of the comparison protocols share the same file list
+      key = (loop, protocol, purpose if purpose == "train" or "search" in protocol else "")
+      future = self._async_loads.get(key)
+      if future is None:
+        missing.setdefault(key, (protocol, purpose))
+      elif future not in waiting:
+        waiting.append(future)
+
+    if missing:
+      future = loop.run_in_executor(None, functools.partial(self._preload, list(missing.values()), workers))
+      for key in missing:
+        self._async_loads[key] = future
+
+      def _done(future, keys=list(missing)):
+        for key in keys:
+          if self._async_loads.get(key) is future:
+            del self._async_loads[key]
+      future.add_done_callback(_done)
+      waiting.append(future)
+
+    timings = {}
+    for result in await asyncio.gather(*waiting):
+      timings.update(result)
+    return timings
+
+
+  async def apreload(self, protocols=None, purposes=None, workers=None):
+    """Coroutine that loads the file lists of several protocols in parallel, without blocking the event loop.
+
+    The file lists are loaded by :py:meth:`preload` in the default executor of the event loop.
+    File lists that are already being loaded by other coroutines are not loaded again, but awaited.
+    See :py:meth:`preload` for the description of the parameters and the return value.
+    """
+
+    protocols = self.check_parameters_for_validity(protocols, "protocol", self.protocol_names())
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ("train", "enroll", "probe"))
+
+    return await self._aload([(protocol, purpose) for protocol in protocols for purpose in purposes], workers)
+
+
+  async def aobjects(self, groups=None, protocol='search_split1', purposes=None, model_ids=None, media_ids=None, frames=None, shard=None, shard_by='file'):
+    """Coroutine that returns the same list of File objects as :py:meth:`objects`.
+
+    The file lists needed by the query are loaded, and the query itself is run, in the default executor of the event loop, so that the event loop is not blocked, even if a training set needs to be reloaded after its eviction.
+    Concurrent queries that need the same file lists share one load, and queries on already loaded data do not wait for other loads.
+    See :py:meth:`objects` for the description of the parameters.
+    """
+
+    groups = self.check_parameters_for_validity(groups, "group", ["dev","world"])
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+
+    await self._aload(self._requests(groups, protocol, purposes))
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(self.objects, groups, protocol, purposes, model_ids, media_ids, frames, shard, shard_by))
+
+
+  async def aobject_sets(self, groups='dev', protocol='search_split1', purposes='probe', model_ids=None, media_ids=None, frames=None):
+    """Coroutine that returns the same list of :py:class:`Template` objects as :py:meth:`object_sets`.
+
+    The file lists are loaded, and the query is run, as in :py:meth:`aobjects`.
+    See :py:meth:`object_sets` for the description of the parameters.
+    """
+
+    purposes = self.check_parameters_for_validity(purposes, "purpose", ["enroll","probe"])
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+
+    await self._aload(self._requests(["dev"], protocol, purposes))
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(self.object_sets, groups, protocol, purposes, model_ids, media_ids, frames))
 
-    return templates
 
+  def embedding_rows(self, files, store):
+    """Returns the rows of the given files in the given :py:class:`bob.db.ijba.embeddings.EmbeddingStore` as an integer array.
+
+    Keyword Parameters:
+
+    files : [:py:class:`File`]
+      The files to look up, e.g., the result of :py:meth:`objects`.
+
+    store : :py:class:`bob.db.ijba.embeddings.EmbeddingStore`
+      The store that contains the embeddings of the files.
+    """
+
+    return store.rows([f.id for f in files])
 
 
-  def annotations(self, file):
+  @instrumented
+  def annotations(self, file, template=None):
     """Returns the annotations for the given :py:class:`File` object as a
     dictionary, see :py:func:`read_annotations` for details.
+
+    The annotations of :py:class:`LazyFile` objects are decoded on first access.
+
+    As the same :py:class:`File` object is shared by all templates that contain it, the annotations are the ones of the first file list that the file was loaded from.
+    If a ``template`` is given, the annotations of the file as listed in this :py:class:`Template` are returned.
     """
 
+    if template is not None:
+      for i, f in enumerate(template.files):
+        if f is file:
+          return template.file_annotations(i)
+      raise ValueError("The file '%s' is not part of template '%s'." % (file.id, template.id))
     return file.annotations
 
 
+  def memory_report(self):
+    """Reports the memory used by the currently loaded templates and files.
+
+    Returns: a dictionary with the following entries:
+
+    templates
+      The number of loaded templates.
+
+    file_references
+      The number of files in all loaded templates.
+
+    files
+      The number of distinct :py:class:`File` objects, which are shared between templates and protocols.
+
+    file_bytes
+      The approximate memory used by the distinct file objects.
+
+    saved_bytes
+      The approximate memory saved by sharing the file objects, compared to one object per file reference.
+
+    column_bytes
+      The memory used by the column arrays backing the files.
+    """
+
+    template_dicts = {}
+    for data in list(self.memory_db.values()):
+      for key in ('train', 'enroll', 'probe', 'comparison-templates'):
+        if key in data:
+          template_dicts[id(data[key])] = data[key]
+    templates = [t for d in template_dicts.values() for t in d.values()]
+
+    files = {}
+    columns = {}
+    references = 0
+    for t in templates:
+      references += len(t.files)
+      for f in t.files:
+        files[id(f)] = f
+      if t.columns is not None:
+        columns[id(t.columns)] = t.columns
+
+    def _size(f):
+      return sys.getsizeof(f) + (sys.getsizeof(f.__dict__) if getattr(f, '__dict__', None) else 0)
+    file_bytes = sum(_size(f) for f in files.values())
+    average = float(file_bytes) / len(files) if files else 0.
+
+    return {
+      'templates'       : len(templates),
+      'file_references' : references,
+      'files'           : len(files),
+      'file_bytes'      : file_bytes,
+      'saved_bytes'     : int((references - len(files)) * average),
+      'column_bytes'    : sum(a.nbytes for c in columns.values() for a in c.values()),
+    }
+
+
+  def stats(self, reset=False):
+    """Returns the statistics of the loads and queries of this database.
+
+    The loads and queries are only recorded if the statistics are enabled, see :py:class:`Database`; the memory is always reported.
+
+    Keyword Parameters:
+
+    reset : bool
+      If set, the recorded loads and queries are cleared after they are returned.
+
+    Returns: a dictionary with the following entries:
+
+    enabled
+      Whether the loads and queries are recorded.
+
+    loads
+      One dictionary per loaded file list with its ``file`` name, the number of ``rows``, the ``seconds`` needed to load it, and its ``source``: 'compiled' if it was read from the compiled cache, 'parsed' if it was parsed, or 'preloaded' if it was parsed by :py:meth:`preload`.
+
+    summary
+      The total number of ``loads``, ``rows`` and ``seconds`` of all loads, and the number of ``cache_hits`` and ``cache_misses``.
+
+    queries
+      For each query method, the number of ``calls``, the total number of returned ``results``, and the total and maximum ``seconds`` per call.
+
+    memory
+      For each loaded protocol, the number of ``templates`` and ``files``, and the ``column_bytes`` of the column arrays backing the files.
+    """
+
+    if self._statistics is not None:
+      report = self._statistics.report()
+      if reset:
+        self._statistics.reset()
+    else:
+      report = instrumentation.Statistics().report()
+    report['enabled'] = self._statistics is not None
+
+    memory = {}
+    for protocol, data in list(self.memory_db.items()):
+      template_dicts = dict((id(data[key]), data[key]) for key in ('train', 'enroll', 'probe', 'comparison-templates') if key in data)
+      templates = [t for d in template_dicts.values() for t in d.values()]
+      columns = dict((id(t.columns), t.columns) for t in templates if t.columns is not None)
+      memory[protocol] = {
+        'templates'    : len(templates),
+        'files'        : sum(len(t.files) for t in templates),
+        'column_bytes' : sum(a.nbytes for c in columns.values() for a in c.values()),
+      }
+    report['memory'] = memory
+
+    return report
+
+
   def protocol_names(self):
     """Returns all registered protocol names, which are usually ``['NoTrain'] + ['split%d' for d in range(1,11)]``"""
     return self.protocols()
@@ -423,18 +1363,44 @@ class Database(bob.db.base.Database):
     return name in self.protocols()
 
 
-  def get_client_id_from_model_id(self, model_id):
+  @instrumented
+  def get_client_id_from_model_id(self, model_id, protocol=None):
+    """Returns the client id of the given enrollment or probe template.
 
-    # Since we don't have the protocol information we have to load them all
-    # TODO: Last minute solution for this problem, think in a better solution
-    for p in self.protocols():
-      if "search" in p:
-        self._load_data(p, "dev", "enroll")
-        self._load_data(p, "dev", "probe")
-      else:
-        self._load_data(p, "dev", "")
+    The client id is looked up in an index of all templates of all protocols, without loading any protocol, see :py:meth:`template_protocols`.
+
+    Keyword Parameters:
+
+    model_id : int
+      The template id to look up.
+
+    protocol : str or ``None``
+      If given, the template is looked up in this protocol only.
+
+    Raises a :py:exc:`ValueError` if the template id is unknown, or if it belongs to different clients in different protocols and no ``protocol`` is given.
+    """
+
+    clients = self._get_template_index().get(model_id)
+    if not clients:
+      raise ValueError("The template id '%s' is not known." % model_id)
+
+    if protocol is not None:
+      protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+      if protocol not in clients:
+        raise ValueError("The template id '%s' is not part of protocol '%s'." % (model_id, protocol))
+      return clients[protocol]
+
+    client_ids = set(clients.values())
+    if len(client_ids) > 1:
+      raise ValueError("The template id '%s' belongs to different clients in the protocols %s; please specify the protocol." % (model_id, sorted(clients)))
+    return client_ids.pop()
+
+
+  @instrumented
+  def template_protocols(self, model_id):
+    """Returns the list of protocols, in which the given template id is used for enrollment or probing."""
 
-    return self.templates[model_id].client_id
+    return [p for p in self.protocols() if p in self._get_template_index().get(model_id, {})]
 
 
 
@@ -8,9 +8,23 @@ This script has some sort of utilitary functions that parses the original databa
 from __future__ import print_function
 
 import os
+import gc
+import collections
+import contextlib
+
+import numpy
 
 import bob.db.base
 
+from . import cache
+
+
+#: The categorical attribute columns of the IJB-A file lists, as stored by :py:func:`read_columns`
+CATEGORY_COLUMNS = ('forehead_visible', 'eyes_visible', 'nose_mouth_visible', 'indoor', 'gender', 'skin_tone', 'age', 'facial_hair')
+
+#: The annotation keys of the categorical attributes, see :py:func:`read_annotations`
+CATEGORY_KEYS = ('forehead-visible', 'eyes-visible', 'nose-mouth-visible', 'indoor', 'gender', 'skin-tone', 'age')
+
 
 class File(bob.db.base.File):
   """
@@ -18,6 +32,8 @@ class File(bob.db.base.File):
 
   Diferent from its ascendent class, this one has the client ID as input
 
+  The ``frame`` of the file is the frame number of video frames, and ``None`` for images.
+
   """
   def __init__(self, client_id, path, file_id = None):
     """**Constructor Documentation**
@@ -47,6 +63,75 @@ class File(bob.db.base.File):
 
 
 
+class LazyFile(File):
+  """
+  IJBA File class that is backed by a row of the columns returned by :py:func:`read_columns`
+
+  All attributes of the :py:class:`File` are read from the shared column arrays when accessed, and the ``annotations`` are only decoded on first access.
+  Hence, creating a ``LazyFile`` is cheap.
+  """
+
+  def __init__(self, columns, row):
+    """**Constructor Documentation**
+
+    Parameters:
+
+    columns : dict
+      The columns of a file list as returned by :py:func:`read_columns`, which are shared between all files of the list.
+
+    row : int
+      The row of this file in the ``columns``.
+    """
+    self._columns = columns
+    self._row = row
+    self._annotations = None
+
+  @property
+  def client_id(self):
+    return int(self._columns['subject_id'][self._row])
+
+  @property
+  def path(self):
+    return str(self._columns['path'][self._row])
+
+  @property
+  def id(self):
+    return "%s-%d" % (self.path, self._columns['sighting_id'][self._row])
+
+  @property
+  def extension(self):
+    return str(self._columns['extension'][self._row])
+
+  @property
+  def media_id(self):
+    return str(self._columns['media_id'][self._row])
+
+  @property
+  def frame(self):
+    frame = int(self._columns['frame'][self._row])
+    return frame if frame >= 0 else None
+
+  @property
+  def annotations(self):
+    if self._annotations is None:
+      self._annotations = annotations_from_columns(self._columns, self._row)
+    return self._annotations
+
+  @annotations.setter
+  def annotations(self, annotations):
+    self._annotations = annotations
+
+  def __reduce__(self):
+    # pickle a stand-alone File, not the whole file list
+    file_obj = File(self.client_id, self.path, self.id)
+    file_obj.annotations = self.annotations
+    file_obj.extension   = self.extension
+    file_obj.media_id    = self.media_id
+    file_obj.frame       = self.frame
+    return (File, (self.client_id, self.path, self.id), file_obj.__dict__)
+
+
+
 class Template:
   """A ``Template`` contains a list of :py:class:`File` objects belonging to
   the same subject (there might be several templates per subject).
@@ -69,6 +154,11 @@ class Template:
   concatenation of the ``File.media_id`` of the first file, and the
   ``self.template_id``, making it unique (at least per protocol).
 
+  Templates created from a file list also keep the ``columns`` of the list
+  and the ``rows`` of their files, so that the annotations of the files in
+  this template can be obtained with :py:meth:`file_annotations`, even when
+  the :py:class:`File` objects are shared with other templates.
+
   """
 
   def __init__(self, template_id, subject_id, files):
@@ -77,54 +167,102 @@ class Template:
     assert isinstance(files,list)
     self.files       = files
     self.path = "%s-%s" % (files[0].media_id, template_id)
+    self.columns = None
+    self.rows = None
 
+  def file_annotations(self, index):
+    """Returns the annotations of the ``index``-th file as listed in this template, see :py:func:`read_annotations`"""
+    if self.rows is None:
+      return self.files[index].annotations
+    return annotations_from_columns(self.columns, self.rows[index])
 
-def read_file(filename):
-  """Reads the given file and yields the template id, the subject id and path_id (path + sighting_id)"""
 
-  with open(filename) as f:
-    # skip the first line
-    _ = f.readline()
-    for line in f:
-      splits = line.rstrip().split(',')
+class Comparisons(collections.abc.Mapping):
+  """The comparisons of a ``compare_splitN`` protocol in a compact array layout
 
-      assert len(splits) == 25
+  The ``pairs`` are stored as an ``(N, 2)`` array of ``(enroll, probe)`` template ids, in the order of the comparison file list.
+  Additionally, the comparisons are stored in compressed sparse row layout: the probes of the ``i``-th model in ``model_ids`` are ``probes[indptr[i]:indptr[i+1]]``.
 
+  As a mapping, it behaves like the dictionary returned by :py:func:`get_comparisons`: iterating yields the model ids in the order of the file list, and indexing with a model id returns the array of its probe template ids.
+  """
 
-      #Parsing the ids
-      template_id = int(splits[0])
-      client_id   = int(splits[1])
+  def __init__(self, pairs):
+    """**Constructor Documentation**
 
-      path,extension     = os.path.splitext(splits[2])
-      sighting_id = splits[4]
-      file_id     = "%s-%s" % (path, sighting_id)
+    Parameters:
 
-      #Creating the file object and binding the annotations directly to the object
-      file_obj = File(client_id, path, file_id)
-      annotations = read_annotations(splits[6:])
+    pairs : :py:class:`numpy.ndarray`
+      The ``(N, 2)`` array of ``(enroll, probe)`` template ids as read by :py:func:`read_comparisons`.
+    """
+    self.pairs = numpy.asarray(pairs, dtype=numpy.int64).reshape(-1, 2)
 
-      file_obj.annotations = annotations
-      file_obj.extension   = extension
-      file_obj.media_id    = splits[3]
+    # the model ids in the order of their first appearance
+    ids, first, positions = numpy.unique(self.pairs[:, 0], return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    self.model_ids = ids[order]
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    positions = rank[positions.reshape(-1)]
+
+    # group the probes by model, keeping the order of the file list
+    self.probes = self.pairs[numpy.argsort(positions, kind='stable'), 1]
+    self.indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(positions, minlength=len(order))))).astype(numpy.int64)
+    self._offsets = dict((m, i) for i, m in enumerate(self.model_ids.tolist()))
+
+  def __getitem__(self, model_id):
+    i = self._offsets[model_id]
+    return self.probes[self.indptr[i]:self.indptr[i+1]]
+
+  def __iter__(self):
+    return iter(self.model_ids.tolist())
+
+  def __len__(self):
+    return len(self.model_ids)
+
+
+
+def read_file(filename):
+  """Reads the given file and returns an iterator over the template id, the subject id and the :py:class:`File` of each row"""
+
+  columns = read_columns(filename)
+  template_ids = columns['template_id'].tolist()
+  client_ids = columns['subject_id'].tolist()
+  return zip(template_ids, client_ids, files_from_columns(columns))
 
-      yield template_id, client_id, file_obj
 
+def read_comparisons(filename):
+  """
+  Parse the file verify_comparisons_[n].csv where [n] is the split number into a dictionary holding a ``(N, 2)`` array of template id pairs
+  """
+
+  with open(filename) as f:
+    lines = [line.strip() for line in f if line.strip()]
+  wrong = next((line for line in lines if line.count(',') != 1), None)
+  if wrong is not None:
+    raise ValueError("The comparison file '%s' contains a row with %d instead of 2 template ids: '%s'" % (filename, wrong.count(',') + 1, wrong))
+  pairs = [[int(v) for v in line.split(',')] for line in lines]
 
-def get_comparisons(filename):
+  return {'pairs': numpy.array(pairs, dtype=numpy.int64).reshape(-1, 2)}
+
+
+def get_comparisons(filename, cache_directory=None):
   """
   Parse the file verify_comparisons_[n].csv where [n] is the split number
+
+  If ``cache_directory`` is given, the parsed pairs are read from (and stored into) the compiled cache, see :py:func:`bob.db.ijba.cache.load`.
   """
 
-  lines          = open(filename).readlines()
-  template_comparisons = {}
+  return comparisons_from_pairs(cache.load(filename, read_comparisons, cache_directory)['pairs'])
 
-  for line in lines:
 
-    splits = line.rstrip().split(',')
-    assert len(splits) == 2
+def comparisons_from_pairs(pairs):
+  """
+  Creates the dictionary of comparisons as returned by :py:func:`get_comparisons` from the ``(N, 2)`` array of template id pairs
+  """
+
+  template_comparisons = {}
 
-    template_A = int(splits[0])
-    template_B = int(splits[1].rstrip("\n"))
+  for template_A, template_B in pairs.tolist():
 
     if template_A not in template_comparisons:
       template_comparisons[template_A] = [template_B]
@@ -134,8 +272,258 @@ def get_comparisons(filename):
   return template_comparisons
 
 
+_NAN = float('nan')
+
+# the vectorized string functions, which are ufuncs since numpy 2
+_strings = numpy.strings if hasattr(getattr(numpy, 'strings', None), 'rpartition') else numpy.char
+
+
+def _floats(values):
+  """Converts the given strings to a ``float64`` array, where empty strings are converted to ``NaN``"""
+  if '' in values:
+    values = [v or 'nan' for v in values]
+  return numpy.fromiter(map(float, values), dtype=numpy.float64, count=len(values))
+
 
-def get_templates(filename,  verbose=True):
+def _ints(values, missing=-1):
+  """Converts the given strings to an ``int64`` array, where empty strings are converted to ``missing``"""
+  if '' in values:
+    values = [v or str(missing) for v in values]
+  if not values:
+    return numpy.zeros(0, dtype=numpy.int64)
+  # parsing the joined values in C is faster than converting each string by itself
+  result = numpy.fromstring(','.join(values), dtype=numpy.int64, sep=',')
+  if len(result) != len(values):
+    raise ValueError("The values %s are not all integers." % values[:10])
+  return result
+
+
+def _strings_array(values):
+  """Converts the given strings to a ``str`` array, which is faster when the length of the strings is known"""
+  return numpy.array(values, dtype='U%d' % max(1, max(map(len, values), default=1)))
+
+
+def _split_extensions(filenames):
+  """Splits the given file names into the arrays of paths and extensions, as :py:func:`os.path.splitext` does for each of them"""
+  names = numpy.array(filenames, dtype=str)
+  if not len(names):
+    return names, names.copy()
+  dots = _strings.rfind(names, '.')
+  slashes = _strings.rfind(names, '/')
+  # extensions start at the last dot of the base name, which does not start with a dot
+  split = dots > slashes + 1
+  leading = numpy.flatnonzero(split & (_strings.find(names, '.', slashes + 1) == slashes + 1))
+  for row in leading.tolist():
+    split[row] = bool(os.path.splitext(filenames[row])[1])
+
+  if _strings is numpy.char:
+    head, separator, tail = numpy.char.rpartition(names, '.').reshape(-1, 3).transpose()
+  else:
+    head, separator, tail = _strings.rpartition(names, '.')
+  path = numpy.where(split, head, names)
+  extension = numpy.where(split, _strings.add(separator, tail), '')
+  for row in leading.tolist():
+    path[row], extension[row] = os.path.splitext(filenames[row])
+  return path, extension
+
+
+def read_columns(filename):
+  """Reads the given file into a dictionary of typed column arrays in one pass.
+
+  The returned dictionary contains the following :py:class:`numpy.ndarray`'s, each with one entry per row of the file list:
+
+  * ``template_id``, ``subject_id``, ``media_id``, ``sighting_id`` : ``int64``
+  * ``frame`` : ``int64``, the frame number of video frames, ``-1`` for images
+  * ``path``, ``extension`` : ``str``, the file name split into path and extension
+  * ``bbox`` : ``float64``, ``(N, 4)`` array of ``(x, y, width, height)``
+  * ``reye``, ``leye``, ``nose`` : ``float64``, ``(N, 2)`` arrays of ``(x, y)``
+  * ``yaw`` : ``float64``
+  * the categorical attributes listed in :py:data:`CATEGORY_COLUMNS` : ``str``, as written in the file list
+
+  Missing annotations are stored as ``NaN``, and missing attributes as empty strings.
+  """
+
+  with open(filename) as f:
+    # skip the first line
+    lines = f.read().splitlines()[1:]
+  lines = [line for line in lines if line]
+
+  wrong = next((line for line in lines if line.count(',') != 24), None)
+  if wrong is not None:
+    raise ValueError("The file list '%s' contains a row with %d instead of 25 columns: '%s'" % (filename, wrong.count(',') + 1, wrong))
+
+  # split all lines at once, and take every 25th field as a column, without creating one list per row
+  fields = ','.join(lines).split(',') if lines else []
+  table = [fields[c::25] for c in range(25)]
+
+  path, extension = _split_extensions(table[2])
+  coordinates = numpy.stack([_floats(table[c]) for c in range(6, 17)], axis=1) if lines else numpy.zeros((0, 11))
+
+  columns = {
+    'template_id' : _ints(table[0]),
+    'subject_id'  : _ints(table[1]),
+    'path'        : path,
+    'extension'   : extension,
+    'media_id'    : _ints(table[3]),
+    'sighting_id' : _ints(table[4]),
+    'frame'       : _ints(table[5]),
+    'bbox'        : coordinates[:, 0:4],
+    'reye'        : coordinates[:, 4:6],
+    'leye'        : coordinates[:, 6:8],
+    'nose'        : coordinates[:, 8:10],
+    'yaw'         : coordinates[:, 10],
+  }
+  for i, name in enumerate(CATEGORY_COLUMNS):
+    columns[name] = _strings_array(table[17 + i])
+
+  return columns
+
+
+def _annotations(values, categories):
+  """Returns the annotations in the format of :py:func:`read_annotations` from the Python values of one row of :py:func:`read_columns`
+
+  The ``values`` are the ``(x, y, width, height)`` of the bounding box, the ``(x, y)`` of the right eye, the left eye and the nose, and the yaw; the ``categories`` are the attributes listed in :py:data:`CATEGORY_KEYS`.
+  """
+
+  tl_x, tl_y, size_x, size_y, re_x, re_y, le_x, le_y, n_x, n_y, yaw = values
+  annotations = dict(zip(CATEGORY_KEYS, categories))
+  annotations['topleft']            = (tl_y, tl_x)
+  annotations['size']               = (size_y, size_x)
+  annotations['bottomright']        = (tl_y + size_y, tl_x + size_x)
+
+  # NaN values, i.e., missing annotations, are not equal to themselves
+  if re_x == re_x and re_y == re_y: annotations['reye'] = (re_y, re_x)
+  if le_x == le_x and le_y == le_y: annotations['leye'] = (le_y, le_x)
+  if n_x == n_x and n_y == n_y: annotations['nose'] = (n_y, n_x)
+  if yaw == yaw: annotations['yaw'] = yaw
+
+  return annotations
+
+
+def _rows_annotations(columns, rows):
+  """Returns the list of annotations of the given rows of :py:func:`read_columns`, converting the columns to Python values once for all rows"""
+
+  rows = numpy.asarray(rows, dtype=numpy.int64)
+  values = zip(*[columns[key][rows, i].tolist() for key in ('bbox', 'reye', 'leye', 'nose') for i in range(columns[key].shape[1])] + [columns['yaw'][rows].tolist()])
+  categories = zip(*[columns[name][rows].tolist() for name in CATEGORY_COLUMNS[:len(CATEGORY_KEYS)]])
+  return [_annotations(v, c) for v, c in zip(values, categories)]
+
+
+def annotations_from_columns(columns, row):
+  """Returns the annotations of the given row of :py:func:`read_columns` in the format of :py:func:`read_annotations`"""
+
+  values = columns['bbox'][row].tolist() + columns['reye'][row].tolist() + columns['leye'][row].tolist() + columns['nose'][row].tolist() + [columns['yaw'][row].item()]
+  return _annotations(values, [str(columns[name][row]) for name in CATEGORY_COLUMNS[:len(CATEGORY_KEYS)]])
+
+
+def files_from_columns(columns, rows=None, lazy=False):
+  """Returns an iterator over the :py:class:`File` objects of the given rows (by default: all rows) of :py:func:`read_columns`
+
+  If ``lazy`` is set, :py:class:`LazyFile` objects are created, which decode their annotations only on first access.
+  Otherwise, the files are created at once.
+  """
+
+  if rows is None:
+    rows = range(len(columns['template_id']))
+  if lazy:
+    return (LazyFile(columns, row) for row in rows)
+
+  rows = numpy.asarray(rows, dtype=numpy.int64)
+  values = [columns[key][rows].tolist() for key in ('subject_id', 'path', 'extension', 'media_id', 'sighting_id', 'frame')]
+
+  files = []
+  with _paused_gc():
+    for client_id, path, extension, media_id, sighting_id, frame, annotations in zip(*values, _rows_annotations(columns, rows)):
+      #Creating the file object and binding the annotations directly to the object
+      file_obj = File(client_id, path, "%s-%d" % (path, sighting_id))
+      file_obj.annotations = annotations
+      file_obj.extension   = extension
+      file_obj.media_id    = str(media_id)
+      file_obj.frame       = frame if frame >= 0 else None
+      files.append(file_obj)
+  return iter(files)
+
+
+@contextlib.contextmanager
+def _paused_gc():
+  """Pauses the cyclic garbage collector while creating many objects that cannot form reference cycles
+
+  Otherwise, the full collections, which are triggered by the new objects, traverse all objects again and again.
+  """
+
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    yield
+  finally:
+    if enabled:
+      gc.enable()
+
+
+def templates_from_columns(columns, lazy=True, files=None, lock=None):
+  """Creates the dictionary of :py:class:`Template` objects as returned by :py:func:`get_templates` from the columns of :py:func:`read_columns`
+
+  By default, the templates contain :py:class:`LazyFile` objects; set ``lazy=False`` to create :py:class:`File` objects with readily decoded annotations.
+
+  If a mapping ``files`` is given, files with the same id (and client id) are interned: already known files are reused from the mapping, and new files are added to it.
+  Note that the annotations of an interned file are the ones of its first occurrence; the annotations of each occurrence are available through :py:meth:`Template.file_annotations`.
+  If a ``lock`` is given, it is held only while the ``files`` mapping is accessed, so that several threads can create templates concurrently.
+  """
+
+  templates = {}
+  template_ids = columns['template_id'].tolist()
+  client_ids = columns['subject_id'].tolist()
+
+  with _paused_gc():
+    if files is None:
+      created = files_from_columns(columns, lazy=lazy)
+    else:
+      created = _interned_files(columns, files, lazy, lock)
+
+    for row, file_obj in enumerate(created):
+      template_id = template_ids[row]
+
+      # create template with given IDs
+      if template_id not in templates:
+        template = templates[template_id] = Template(template_id, client_ids[row], [file_obj])
+        template.columns = columns
+        template.rows = [row]
+      else:
+        templates[template_id].files.append(file_obj)
+        templates[template_id].rows.append(row)
+
+  return templates
+
+
+def _interned_files(columns, files, lazy, lock=None, rows=None):
+  """Returns the files of the given rows (by default: all rows) of the columns, reusing the files with known ids from the ``files`` mapping
+
+  The ``lock``, if given, is only held while looking up and inserting the files.
+  """
+
+  lock = lock or contextlib.nullcontext()
+  rows = numpy.arange(len(columns['subject_id'])) if rows is None else numpy.asarray(rows, dtype=numpy.int64)
+  # the client id is part of the key, so that inconsistent file lists never mix up the clients
+  keys = ["%d/%s-%d" % k for k in zip(columns['subject_id'][rows].tolist(), columns['path'][rows].tolist(), columns['sighting_id'][rows].tolist())]
+  with lock:
+    found = [files.get(key) for key in keys]
+
+  missing = [i for i, file_obj in enumerate(found) if file_obj is None]
+  if not missing:
+    return found
+  created = list(files_from_columns(columns, rows[missing].tolist(), lazy=lazy))
+
+  with lock:
+    for i, file_obj in zip(missing, created):
+      # another thread might have added the same file in the meantime
+      known = files.get(keys[i])
+      if known is None:
+        known = files[keys[i]] = file_obj
+      found[i] = known
+  return found
+
+
+def get_templates(filename,  verbose=True, cache_directory=None, lazy=True):
   """
   Given a IJBA file, get a dictionary with all their templates with their respective files in the following format:
 
@@ -146,18 +534,11 @@ def get_templates(filename,  verbose=True):
   .
   .
 
+  If ``cache_directory`` is given, the parsed file list is read from (and stored into) the compiled cache, see :py:func:`bob.db.ijba.cache.load`.
+  If ``lazy`` is set (the default), the templates contain :py:class:`LazyFile` objects, which decode their annotations only when accessed.
   """
 
-  templates       = {}
-  for template_id, client_id, file_obj in read_file(filename):
-
-    # create template with given IDs
-    if template_id not in templates:
-      templates[template_id] = Template(template_id,client_id,[file_obj])
-    else:
-      templates[template_id].files.append(file_obj)
-
-  return templates
+  return templates_from_columns(cache.load(filename, read_columns, cache_directory), lazy=lazy)
 
 
 
@@ -186,7 +567,7 @@ def read_annotations(raw_annotations):
   nm       = raw_annotations[19-6]
   indoor   = raw_annotations[20-6]
   gender   = raw_annotations[21-6]
-  skin     = raw_annotations[22-5]
+  skin     = raw_annotations[22-6]
   age      = raw_annotations[23-6]
 
 
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Reading and writing of score files.
+
+The scores are streamed in chunks of ``chunk_size`` rows, which are parsed and
+formatted in bulk.  Files with the extension ``.gz`` are read and written with
+gzip compression.  Two text formats are supported:
+
+* the four-column format of Bob, with the fields ``CLAIMED_ID REAL_ID
+  TEST_LABEL SCORE``, see :py:func:`read_four_column`
+* the NIST format, with the fields ``ENROLL_TEMPLATE_ID VERIF_TEMPLATE_ID
+  ENROLL_TEMPLATE_SIZE_BYTES VERIF_TEMPLATE_SIZE_BYTES RETCODE
+  SIMILARITY_SCORE``, see :py:func:`write_nist` and :py:func:`read_nist`
+
+Scores that are used repeatedly, e.g., for evaluation and fusion, can be stored
+in the binary :py:class:`ScoreStore`, which is memory-mapped and indexed by the
+model template id.
+"""
+
+import os
+import gzip
+import time
+import logging
+import itertools
+
+import numpy
+
+logger = logging.getLogger("bob.db.ijba")
+
+#: The default number of rows that are read or written at once
+CHUNK_SIZE = 100000
+
+#: The header of score files in the NIST format
+NIST_HEADER = "ENROLL_TEMPLATE_ID VERIF_TEMPLATE_ID ENROLL_TEMPLATE_SIZE_BYTES VERIF_TEMPLATE_SIZE_BYTES RETCODE SIMILARITY_SCORE\n"
+
+
+def open_file(filename, mode="rb"):
+  """Opens the given file in binary mode, using gzip compression if the filename ends with ``.gz``; the directory of files opened for writing is created if needed"""
+  if "w" in mode:
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+  if filename.endswith(".gz"):
+    return gzip.open(filename, mode)
+  return open(filename, mode)
+
+
+#: The token that is placed between the rows of a chunk, so that rows with a wrong number of tokens are detected after splitting the chunk at once
+_ROW_SEPARATOR = b" \x00 "
+
+
+def _aligned(tokens, rows):
+  """Checks that the tokens of the given number of rows, which are joined with :py:data:`_ROW_SEPARATOR`, contain exactly four tokens per row"""
+  return len(tokens) == 5 * rows - 1 and tokens[4::5].count(_ROW_SEPARATOR.strip()) == rows - 1
+
+
+def _four_column_tokens(filename, chunk_size):
+  """Yields the list of tokens of each chunk of rows of a score file in the four-column format"""
+  with open_file(filename) as f:
+    while True:
+      lines = list(itertools.islice(f, chunk_size))
+      if not lines:
+        break
+      tokens = _ROW_SEPARATOR.join(lines).split()
+      if not _aligned(tokens, len(lines)):
+        # skip empty lines
+        lines = [l for l in lines if l.strip()]
+        if not lines:
+          continue
+        tokens = _ROW_SEPARATOR.join(lines).split()
+        if not _aligned(tokens, len(lines)):
+          wrong = next((l for l in lines if len(l.split()) != 4), lines[0])
+          raise ValueError("The score file '%s' is not in the four-column format; it contains the row '%s'." % (filename, wrong.decode("utf-8", "replace").rstrip()))
+      del tokens[4::5]
+      yield tokens
+
+
+def read_four_column(filename, chunk_size=CHUNK_SIZE):
+  """Reads a score file in the four-column format in chunks.
+
+  Keyword Parameters:
+
+  filename : str
+    The score file, which might be compressed with gzip.
+
+  chunk_size : int
+    The number of rows read at once.
+
+  Yields ``(claimed_ids, real_ids, test_labels, scores)`` tuples of byte string arrays, one entry per row.
+  """
+  for tokens in _four_column_tokens(filename, chunk_size):
+    table = numpy.array(tokens).reshape(-1, 4)
+    yield table[:, 0], table[:, 1], table[:, 2], table[:, 3]
+
+
+def _chunks(scores, chunk_size):
+  """Yields the given ``(model_ids, probe_ids, scores)`` arrays in chunks, or the chunks of the given iterable"""
+  if isinstance(scores, tuple) and len(scores) == 3 and all(isinstance(s, numpy.ndarray) for s in scores):
+    for start in range(0, len(scores[2]), chunk_size):
+      yield tuple(s[start:start + chunk_size] for s in scores)
+  else:
+    for chunk in scores:
+      yield chunk
+
+
+def _nist_rows(values, template_size):
+  """Formats the interleaved ``[model_id, probe_id, score, ...]`` values of a chunk as rows of the NIST format at once"""
+  rows = len(values) // 3
+  if values and isinstance(values[0], bytes):
+    # the tokens of four-column files are copied as they are
+    return (b"%%s %%s %d %d 0 %%s\n" % (template_size, template_size)) * rows % tuple(values)
+  return ((u"%%s %%s %d %d 0 %%s\n" % (template_size, template_size)) * rows % tuple(values)).encode("ascii")
+
+
+def _interleave(model_ids, probe_ids, scores):
+  """Returns the list ``[model_id, probe_id, score, ...]`` of the given chunk of scores"""
+  values = [None] * (3 * len(scores))
+  for offset, array in enumerate((model_ids, probe_ids, scores)):
+    array = numpy.asarray(array)
+    # byte strings, e.g., from read_four_column, are formatted as text
+    values[offset::3] = (array.astype(str) if array.dtype.kind == 'S' else array).tolist()
+  return values
+
+
+def write_nist(filename, scores, template_size=100, chunk_size=CHUNK_SIZE):
+  """Writes scores in the NIST format.
+
+  Keyword Parameters:
+
+  filename : str
+    The score file to write; if it ends with ``.gz``, it is compressed with gzip.
+
+  scores : (:py:class:`numpy.ndarray`, :py:class:`numpy.ndarray`, :py:class:`numpy.ndarray`) or iterable
+    The ``(model_ids, probe_ids, scores)`` arrays, or an iterable of such chunks, e.g., as returned by :py:func:`bob.db.ijba.scoring.score_protocol`.
+    The ids might be integral or byte strings.
+
+  template_size : int
+    The size of the templates in bytes, which is written for all templates.
+
+  chunk_size : int
+    The number of rows formatted at once, if the scores are given as arrays.
+
+  Returns: the number of written rows.
+  """
+  return _write_nist(filename, (_interleave(*chunk) for chunk in _chunks(scores, chunk_size)), template_size)
+
+
+def _write_nist(filename, chunks, template_size):
+  """Writes the chunks of interleaved ``[model_id, probe_id, score, ...]`` values in the NIST format, and returns the number of rows"""
+  rows = 0
+  with open_file(filename, "wb") as f:
+    f.write(NIST_HEADER.encode("ascii"))
+    for values in chunks:
+      f.write(_nist_rows(values, template_size))
+      rows += len(values) // 3
+  return rows
+
+
+def _without_labels(tokens):
+  """Returns the interleaved ``[claimed_id, real_id, score, ...]`` values of the tokens of four-column rows"""
+  values = [None] * (len(tokens) // 4 * 3)
+  values[0::3] = tokens[0::4]
+  values[1::3] = tokens[1::4]
+  values[2::3] = tokens[3::4]
+  return values
+
+
+def four_column_to_nist(input_filename, output_filename, template_size=100, chunk_size=CHUNK_SIZE):
+  """Converts a score file in the four-column format to the NIST format.
+
+  The claimed ids are written as enrollment template ids and the real ids as verification template ids; the scores are copied as they are.
+  Both files might be compressed with gzip, see :py:func:`open_file`.
+
+  Returns: the number of converted rows, and the time needed in seconds.
+  """
+  start = time.time()
+  rows = _write_nist(output_filename, (_without_labels(tokens) for tokens in _four_column_tokens(input_filename, chunk_size)), template_size)
+  seconds = time.time() - start
+  logger.info("Converted %d scores of '%s' in %.2f s (%.0f rows/s)", rows, input_filename, seconds, rows / max(seconds, 1e-6))
+  return rows, seconds
+
+
+def _convert(arguments):
+  """Calls :py:func:`four_column_to_nist` in a worker process"""
+  return four_column_to_nist(*arguments)
+
+
+def convert_files(filenames, template_size=100, chunk_size=CHUNK_SIZE, jobs=1):
+  """Converts several score files from the four-column to the NIST format, see :py:func:`four_column_to_nist`.
+
+  Keyword Parameters:
+
+  filenames : [(str, str)]
+    The ``(input, output)`` file names of each conversion.
+
+  template_size, chunk_size
+    See :py:func:`four_column_to_nist`.
+
+  jobs : int
+    The number of worker processes that convert the files in parallel.
+
+  Returns: a list with the number of rows and the seconds of each conversion.
+  """
+  arguments = [(i, o, template_size, chunk_size) for i, o in filenames]
+  if jobs is None or jobs <= 1 or len(arguments) <= 1:
+    return [_convert(a) for a in arguments]
+
+  import concurrent.futures
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    return list(executor.map(_convert, arguments))
+
+
+def read_nist(filename, chunk_size=CHUNK_SIZE):
+  """Reads a score file in the NIST format in chunks.
+
+  Keyword Parameters:
+
+  filename : str
+    The score file, which might be compressed with gzip.
+
+  chunk_size : int
+    The number of rows read at once.
+
+  Yields ``(model_ids, probe_ids, scores)`` tuples of integral and floating point arrays, one entry per row.
+  """
+  with open_file(filename) as f:
+    header = f.readline()
+    if header.split() != NIST_HEADER.encode("ascii").split():
+      raise ValueError("The score file '%s' is not in the NIST format." % filename)
+    while True:
+      lines = [l for l in itertools.islice(f, chunk_size) if l.strip()]
+      if not lines:
+        break
+      tokens = b" ".join(lines).split()
+      if len(tokens) != 6 * len(lines):
+        raise ValueError("The score file '%s' is not in the NIST format." % filename)
+      yield numpy.array(tokens[0::6]).astype(numpy.int64), numpy.array(tokens[1::6]).astype(numpy.int64), numpy.array(tokens[5::6]).astype(numpy.float64)
+
+
+class ScoreStore(object):
+  """A memory-mapped binary container of scores, indexed by the model (enrollment) template id
+
+  The store is a directory containing the ``model_ids.npy``, ``probe_ids.npy`` and ``scores.npy`` arrays with one entry per score, sorted by model id.
+  ``models.npy`` contains the distinct model ids, and ``indptr.npy`` the range of the scores of each model, so that the scores of a model are returned without copy, see :py:meth:`model`.
+  Use :py:meth:`create` to create a new store from scores, and the constructor to open an existing one.
+  """
+
+  def __init__(self, directory):
+    """**Constructor Documentation**
+
+    Opens an existing store.
+
+    Parameters:
+
+    directory : str
+      The directory of the store.
+    """
+    self.directory = directory
+    self.model_ids = numpy.load(os.path.join(directory, "model_ids.npy"), mmap_mode='r')
+    self.probe_ids = numpy.load(os.path.join(directory, "probe_ids.npy"), mmap_mode='r')
+    self.scores = numpy.load(os.path.join(directory, "scores.npy"), mmap_mode='r')
+    self.models = numpy.load(os.path.join(directory, "models.npy"))
+    self.indptr = numpy.load(os.path.join(directory, "indptr.npy"))
+    self._offsets = dict((m, i) for i, m in enumerate(self.models.tolist()))
+
+  @classmethod
+  def create(cls, directory, scores, dtype=numpy.float64):
+    """Creates a new store from the given scores.
+
+    Keyword Parameters:
+
+    directory : str
+      The directory of the new store, which is created if needed.
+
+    scores : (:py:class:`numpy.ndarray`, :py:class:`numpy.ndarray`, :py:class:`numpy.ndarray`) or iterable
+      The ``(model_ids, probe_ids, scores)`` arrays with integral template ids, or an iterable of such chunks, e.g., as returned by :py:func:`bob.db.ijba.scoring.score_protocol` or :py:func:`read_nist`.
+      The scores of each model keep their order.
+
+    dtype : :py:class:`numpy.dtype`
+      The data type of the stored scores.
+
+    Returns: the new :py:class:`ScoreStore`.
+    """
+    chunks = list(_chunks(scores, CHUNK_SIZE))
+    model_ids, probe_ids, values = (numpy.concatenate([numpy.asarray(c[i]) for c in chunks]) if chunks else numpy.zeros(0) for i in range(3))
+    order = numpy.argsort(model_ids, kind='stable')
+    model_ids = model_ids[order].astype(numpy.int64)
+    models, starts = numpy.unique(model_ids, return_index=True)
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    numpy.save(os.path.join(directory, "model_ids.npy"), model_ids)
+    numpy.save(os.path.join(directory, "probe_ids.npy"), probe_ids[order].astype(numpy.int64))
+    numpy.save(os.path.join(directory, "scores.npy"), values[order].astype(dtype))
+    numpy.save(os.path.join(directory, "models.npy"), models)
+    numpy.save(os.path.join(directory, "indptr.npy"), numpy.append(starts, len(model_ids)).astype(numpy.int64))
+    return cls(directory)
+
+  def __len__(self):
+    return len(self.scores)
+
+  def __contains__(self, model_id):
+    return model_id in self._offsets
+
+  def model(self, model_id):
+    """Returns the ``(probe_ids, scores)`` arrays of the given model, which are views of the memory-mapped data; raises a :py:exc:`KeyError` for unknown models"""
+    i = self._offsets[model_id]
+    block = slice(int(self.indptr[i]), int(self.indptr[i + 1]))
+    return self.probe_ids[block], self.scores[block]
+
+  def probe(self, probe_id):
+    """Returns the ``(model_ids, scores)`` arrays of all scores of the given probe; as the scores are sorted by model, they are copied"""
+    rows = numpy.flatnonzero(self.probe_ids == probe_id)
+    return self.model_ids[rows], self.scores[rows]
+
+  def arrays(self):
+    """Returns the ``(model_ids, probe_ids, scores)`` arrays of all scores without copy, e.g., for :py:func:`bob.db.ijba.evaluation.evaluate`"""
+    return self.model_ids, self.probe_ids, self.scores
+
+  def chunks(self, chunk_size=CHUNK_SIZE):
+    """Yields the ``(model_ids, probe_ids, scores)`` arrays in chunks of ``chunk_size`` rows"""
+    return _chunks(self.arrays(), chunk_size)
+
+  def to_nist(self, filename, template_size=100, chunk_size=CHUNK_SIZE):
+    """Writes all scores in the NIST format, see :py:func:`write_nist`; returns the number of written rows"""
+    return write_nist(filename, self.chunks(chunk_size), template_size)
+
+  def to_four_column(self, filename, chunk_size=CHUNK_SIZE):
+    """Writes all scores in the four-column format, using the probe ids as real ids and test labels; returns the number of written rows"""
+    rows = 0
+    with open_file(filename, "wb") as f:
+      for model_ids, probe_ids, values in self.chunks(chunk_size):
+        data = [None] * (4 * len(values))
+        data[0::4] = model_ids.tolist()
+        data[1::4] = data[2::4] = probe_ids.tolist()
+        data[3::4] = values.tolist()
+        f.write((u"%s %s %s %s\n" * len(values) % tuple(data)).encode("ascii"))
+        rows += len(values)
+    return rows
+
+
+def four_column_to_store(filename, directory, chunk_size=CHUNK_SIZE, dtype=numpy.float64):
+  """Converts a score file in the four-column format with integral template ids into a :py:class:`ScoreStore`, using the claimed ids as model ids and the real ids as probe ids"""
+  chunks = ((claimed.astype(numpy.int64), real.astype(numpy.int64), values.astype(numpy.float64)) for claimed, real, _, values in read_four_column(filename, chunk_size))
+  return ScoreStore.create(directory, chunks, dtype)
+
+
+def nist_to_store(filename, directory, chunk_size=CHUNK_SIZE, dtype=numpy.float64):
+  """Converts a score file in the NIST format into a :py:class:`ScoreStore`"""
+  return ScoreStore.create(directory, read_nist(filename, chunk_size), dtype)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Batched template-vs-template scoring for the IJB-A protocols.
+
+The per-file embeddings are pooled into one feature vector per
+:py:class:`bob.db.ijba.Template`, and the scores are computed as blocked
+matrix products of the pooled features.  For the ``search_splitN`` protocols,
+all probe templates are compared with all gallery templates, while for the
+``compare_splitN`` protocols only the pairs listed in the
+``verify_comparisons_N.csv`` file lists are scored.
+
+All scoring functions yield the scores in chunks of ``(model_ids, probe_ids,
+scores)`` arrays, so that the memory consumption is bounded by the block size.
+"""
+
+import numpy
+
+from .embeddings import EmbeddingStore
+
+
+def _group_mean(values, labels):
+  """Computes the mean of the ``values`` rows for each of the given integral ``labels``
+
+  Returns the sorted unique labels, and the according mean values.
+  """
+  order = numpy.argsort(labels, kind='stable')
+  labels = labels[order]
+  starts = numpy.flatnonzero(numpy.concatenate(([True], labels[1:] != labels[:-1])))
+  sums = numpy.add.reduceat(values[order], starts, axis=0)
+  counts = numpy.diff(numpy.concatenate((starts, [len(labels)])))
+  return labels[starts], sums / counts[:, None]
+
+
+def _normalize(features):
+  """Normalizes the rows of the given features to unit length"""
+  norms = numpy.linalg.norm(features, axis=1, keepdims=True)
+  norms[norms == 0] = 1.
+  return features / norms
+
+
+def _file_embeddings(files, embeddings):
+  """Collects the embeddings of the given files in a 2D array
+
+  The ``embeddings`` are either an :py:class:`bob.db.ijba.embeddings.EmbeddingStore`, a mapping or a callable, which returns the embedding for a given :py:class:`bob.db.ijba.File`.
+  """
+  if isinstance(embeddings, EmbeddingStore):
+    return embeddings.gather([f.id for f in files])
+  if callable(embeddings):
+    return numpy.vstack([embeddings(f) for f in files])
+  return numpy.vstack([embeddings[f.id] for f in files])
+
+
+def pool(templates, embeddings, method='mean', normalize=True):
+  """Pools the embeddings of the files of each template into one feature vector.
+
+  Keyword Parameters:
+
+  templates : [:py:class:`bob.db.ijba.Template`]
+    The templates to pool, e.g., as returned by :py:meth:`bob.db.ijba.Database.object_sets`.
+    Templates with the same id are only pooled once.
+
+  embeddings : :py:class:`bob.db.ijba.embeddings.EmbeddingStore` or dict or callable
+    The embeddings of the files, either as a store, as a mapping from :py:attr:`bob.db.ijba.File.id` to a 1D array, or a function that returns the embedding for a given :py:class:`bob.db.ijba.File`.
+
+  method : str
+    ``'mean'`` to average all file embeddings of a template, or ``'media'`` to first average the embeddings of each media, and then average the media embeddings, so that each image or video has the same weight.
+
+  normalize : bool
+    If set (the default), the file embeddings and the pooled features are normalized to unit length, so that the scores are cosine similarities.
+
+  Returns:
+
+  template_ids : :py:class:`numpy.ndarray`
+    The ids of the pooled templates, in order of their first appearance.
+
+  features : :py:class:`numpy.ndarray`
+    The 2D array of pooled features, one row per template.
+  """
+  if method not in ('mean', 'media'):
+    raise ValueError("The pooling method '%s' is not known; use 'mean' or 'media'." % method)
+
+  unique = {}
+  for t in templates:
+    unique.setdefault(t.id, t)
+  templates = list(unique.values())
+
+  files = [f for t in templates for f in t.files]
+  values = numpy.asarray(_file_embeddings(files, embeddings), dtype=numpy.float64)
+  if normalize:
+    values = _normalize(values)
+  labels = numpy.repeat(numpy.arange(len(templates)), [len(t.files) for t in templates])
+
+  if method == 'media':
+    # average per template and media first
+    media = numpy.array([int(f.media_id) for f in files], dtype=numpy.int64)
+    _, media_labels = numpy.unique(numpy.stack((labels, media), axis=1), axis=0, return_inverse=True)
+    media_labels = media_labels.reshape(-1)
+    groups, values = _group_mean(values, media_labels)
+    # the template of each (template, media) group
+    owner = numpy.empty(len(groups), dtype=numpy.int64)
+    owner[media_labels] = labels
+    labels = owner
+
+  _, features = _group_mean(values, labels)
+  if normalize:
+    features = _normalize(features)
+
+  return numpy.array([t.id for t in templates], dtype=numpy.int64), features
+
+
+def _rows(template_ids, ids):
+  """Returns the rows of the given ``ids`` inside the ``template_ids``, raising a :py:exc:`KeyError` for unknown ids"""
+  order = numpy.argsort(template_ids)
+  positions = numpy.searchsorted(template_ids, ids, sorter=order)
+  positions = numpy.minimum(positions, len(template_ids) - 1)
+  rows = order[positions]
+  missing = template_ids[rows] != ids
+  if numpy.any(missing):
+    raise KeyError("The templates %s have not been pooled." % numpy.asarray(ids)[missing][:10].tolist())
+  return rows
+
+
+def search_scores(gallery_ids, gallery, probe_ids, probes, block_size=1024):
+  """Computes the scores of all probe templates with all gallery templates.
+
+  The scores are computed as the matrix product of the gallery and probe features, in blocks of ``block_size`` probes.
+
+  Keyword Parameters:
+
+  gallery_ids, gallery : :py:class:`numpy.ndarray`
+    The ids and pooled features of the gallery templates, see :py:func:`pool`.
+
+  probe_ids, probes : :py:class:`numpy.ndarray`
+    The ids and pooled features of the probe templates, see :py:func:`pool`.
+
+  block_size : int
+    The number of probes scored at once.
+
+  Yields ``(model_ids, probe_ids, scores)`` tuples of 1D arrays with one entry per score, where the probes of each block are listed in turn for each model.
+  """
+  gallery_ids, probe_ids = numpy.asarray(gallery_ids), numpy.asarray(probe_ids)
+  for start in range(0, len(probe_ids), block_size):
+    block = slice(start, start + block_size)
+    scores = numpy.dot(gallery, probes[block].T)
+    ids = probe_ids[block]
+    yield numpy.repeat(gallery_ids, len(ids)), numpy.tile(ids, len(gallery_ids)), scores.reshape(-1)
+
+
+def pair_scores(template_ids, features, pairs, block_size=65536):
+  """Computes the scores of the given pairs of templates only.
+
+  Keyword Parameters:
+
+  template_ids, features : :py:class:`numpy.ndarray`
+    The ids and pooled features of all templates, see :py:func:`pool`.
+
+  pairs : :py:class:`numpy.ndarray`
+    The ``(N, 2)`` array of ``(model_id, probe_id)`` pairs, e.g., from :py:meth:`bob.db.ijba.Database.comparison_pairs`.
+
+  block_size : int
+    The number of pairs scored at once.
+
+  Yields ``(model_ids, probe_ids, scores)`` tuples of 1D arrays with one entry per pair, in the order of the ``pairs``.
+  """
+  template_ids = numpy.asarray(template_ids)
+  pairs = numpy.asarray(pairs).reshape(-1, 2)
+  for start in range(0, len(pairs), block_size):
+    block = pairs[start:start + block_size]
+    models = features[_rows(template_ids, block[:, 0])]
+    probes = features[_rows(template_ids, block[:, 1])]
+    yield block[:, 0], block[:, 1], numpy.einsum('ij,ij->i', models, probes)
+
+
+def score_protocol(db, protocol, embeddings, method='mean', normalize=True, block_size=None):
+  """Computes all scores required by the given protocol of the database.
+
+  For ``search_splitN`` protocols, all probe templates are compared with all gallery templates, see :py:func:`search_scores`.
+  For ``compare_splitN`` protocols, only the listed comparisons are scored, see :py:func:`pair_scores`.
+
+  Keyword Parameters:
+
+  db : :py:class:`bob.db.ijba.Database`
+    The database to query the templates from.
+
+  protocol : str
+    The protocol to compute the scores for.
+
+  embeddings, method, normalize
+    The embeddings of the files and the pooling method, see :py:func:`pool`.
+
+  block_size : int or ``None``
+    The block size; if not given, the default of :py:func:`search_scores` or :py:func:`pair_scores` is used.
+
+  Yields ``(model_ids, probe_ids, scores)`` chunks.
+  """
+  kwargs = {} if block_size is None else {'block_size': block_size}
+
+  if "search" in protocol:
+    gallery_ids, gallery = pool(db.object_sets(protocol=protocol, purposes='enroll'), embeddings, method, normalize)
+    probe_ids, probes = pool(db.object_sets(protocol=protocol, purposes='probe'), embeddings, method, normalize)
+    return search_scores(gallery_ids, gallery, probe_ids, probes, **kwargs)
+
+  template_ids, features = pool(db.object_sets(protocol=protocol, purposes=('enroll', 'probe')), embeddings, method, normalize)
+  return pair_scores(template_ids, features, db.comparison_pairs(protocol), **kwargs)
@@ -15,10 +15,14 @@ Each row of the NIST format is composed of the following fields:
  * RETCODE
  * SIMILARITY_SCORE
 
+Several pairs of input and output score files can be given, which are
+converted in parallel.  Files ending with ``.gz`` are read and written with
+gzip compression.
+
 
 Usage:
 
-  score_generation.py <input-scores> <output-scores> [--template-size=<n>]
+  score_generation.py (<input-scores> <output-scores>)... [--template-size=<n>] [--chunk-size=<n>] [--jobs=<n>]
   score_generation.py -h | --help
 
 
@@ -32,31 +36,34 @@ Options:
 
   -h --help            Show this screen.
   --template-size=<n>  The default template size in BYTES [default: 100]
+  --chunk-size=<n>     The number of scores converted at once [default: 100000]
+  -j --jobs=<n>        The number of score files converted in parallel [default: 1]
 
 """
 
 
 from docopt import docopt
-import bob.bio.base
-import os
-import bob.io.base
+import time
+
+from bob.db.ijba.scores import convert_files
 
 
 def main(command_line_parameters=None):
 
-  args = docopt(__doc__, version='NIST Score Generation')
+  args = docopt(__doc__, argv=command_line_parameters, version='NIST Score Generation')
 
   template_size = int(args['--template-size'])
-  output_file   = args['<output-scores>']
+  filenames     = list(zip(args['<input-scores>'], args['<output-scores>']))
 
-  bob.io.base.create_directories_safe(os.path.dirname(output_file))
+  for input_file, output_file in filenames:
+    print("Writing scores of {0} in {1}".format(input_file, output_file))
 
-  print("Writing scores in {0}".format(output_file))
+  start = time.time()
+  results = convert_files(filenames, template_size, int(args['--chunk-size']), int(args['--jobs']))
+  seconds = time.time() - start
 
-  f = open(output_file,'w')
-  f.write('ENROLL_TEMPLATE_ID VERIF_TEMPLATE_ID ENROLL_TEMPLATE_SIZE_BYTES VERIF_TEMPLATE_SIZE_BYTES RETCODE SIMILARITY_SCORE\n')
-  for template_id,probe_id,template_file,score in bob.bio.base.score.load.four_column(args['<input-scores>']):
-    f.write("{0} {1} {2} {3} 0 {4}\n".format(template_id, probe_id, template_size, template_size, score))
+  for (input_file, output_file), (rows, file_seconds) in zip(filenames, results):
+    print("Converted {0} scores in {1:.2f} s ({2:.0f} rows/s)".format(rows, file_seconds, rows / max(file_seconds, 1e-6)))
 
-  del f
-  print("Done!")
+  rows = sum(r for r, _ in results)
+  print("Done! Converted {0} scores of {1} files in {2:.2f} s ({3:.0f} rows/s)".format(rows, len(filenames), seconds, rows / max(seconds, 1e-6)))
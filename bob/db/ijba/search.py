@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""
+Top-k 1:N search of the probe templates of the ``search_splitN`` protocols.
+
+Instead of computing and writing all gallery-vs-probe scores (see
+:py:func:`bob.db.ijba.scoring.search_scores`), only the ``k`` best gallery
+candidates of each probe template are kept.  The probes are scored in blocks,
+and each block is reduced to its candidates with :py:func:`numpy.argpartition`
+before the next block is scored, so that the memory consumption is bounded by
+the block sizes.  The blocks are scored in a pool of threads, which run in
+parallel since the matrix products release the GIL.
+
+The pooled and normalized gallery features can be stored in a
+:py:class:`GalleryIndex`, which is memory-mapped when reading, so that
+several batches of probes can be searched without pooling the gallery again.
+"""
+
+import os
+import concurrent.futures
+
+import numpy
+
+from .scoring import pool, _normalize
+
+
+def _select(rows, scores, k):
+  """Keeps the ``k`` highest ``scores`` of each row, with their according gallery ``rows``, in arbitrary order"""
+  if scores.shape[1] <= k:
+    return rows, scores
+  selected = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+  return numpy.take_along_axis(rows, selected, axis=1), numpy.take_along_axis(scores, selected, axis=1)
+
+
+def _block_top_k(probes, gallery, k, gallery_block):
+  """Returns the gallery rows and the scores of the ``k`` best candidates of the given block of probes, sorted by descending score"""
+  rows = numpy.zeros((len(probes), 0), dtype=numpy.int64)
+  scores = numpy.zeros((len(probes), 0), dtype=numpy.result_type(probes, gallery))
+  for start in range(0, len(gallery), gallery_block):
+    block = numpy.dot(probes, gallery[start:start + gallery_block].T)
+    block_rows = numpy.broadcast_to(numpy.arange(start, start + block.shape[1]), block.shape)
+    rows, scores = _select(numpy.concatenate((rows, block_rows), axis=1), numpy.concatenate((scores, block), axis=1), k)
+
+  order = numpy.argsort(-scores, axis=1, kind='stable')
+  return numpy.take_along_axis(rows, order, axis=1), numpy.take_along_axis(scores, order, axis=1)
+
+
+def top_k(gallery_ids, gallery, probe_ids, probes, k=20, block_size=1024, gallery_block=65536, workers=None):
+  """Searches the ``k`` best gallery candidates of each probe.
+
+  Keyword Parameters:
+
+  gallery_ids, gallery : :py:class:`numpy.ndarray`
+    The ids and pooled features of the gallery templates, see :py:func:`bob.db.ijba.scoring.pool`.
+
+  probe_ids, probes : :py:class:`numpy.ndarray`
+    The ids and pooled features of the probe templates.
+
+  k : int
+    The number of candidates per probe; if the gallery is smaller, all gallery templates are returned.
+
+  block_size : int
+    The number of probes scored at once.
+
+  gallery_block : int
+    The number of gallery templates scored at once, so that at most ``block_size * (gallery_block + k)`` scores are held in memory by each thread.
+
+  workers : int or ``None``
+    The number of threads that score the blocks of probes; if not given, the number of CPUs is used.
+
+  Returns:
+
+  probe_ids : :py:class:`numpy.ndarray`
+    The ids of the probes.
+
+  candidates : :py:class:`numpy.ndarray`
+    The ``(probes, k)`` array of gallery ids, sorted by descending score for each probe.
+
+  scores : :py:class:`numpy.ndarray`
+    The ``(probes, k)`` array of the according scores.
+  """
+  if k < 1:
+    raise ValueError("The number of candidates k=%d needs to be positive." % k)
+  gallery_ids, probe_ids = numpy.asarray(gallery_ids), numpy.asarray(probe_ids)
+  gallery, probes = numpy.asarray(gallery), numpy.asarray(probes)
+  k = min(k, len(gallery_ids))
+
+  def _search(start):
+    return _block_top_k(probes[start:start + block_size], gallery, k, gallery_block)
+
+  starts = range(0, len(probe_ids), block_size)
+  if workers == 1 or len(starts) <= 1:
+    results = [_search(start) for start in starts]
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(_search, starts))
+
+  if not results:
+    return probe_ids, numpy.zeros((0, k), dtype=gallery_ids.dtype), numpy.zeros((0, k), dtype=numpy.result_type(probes, gallery))
+  rows = numpy.concatenate([r for r, _ in results])
+  return probe_ids, gallery_ids[rows], numpy.concatenate([s for _, s in results])
+
+
+def to_scores(probe_ids, candidates, scores):
+  """Converts the results of :py:func:`top_k` into ``(model_ids, probe_ids, scores)`` arrays with one entry per candidate, e.g., for :py:func:`bob.db.ijba.evaluation.evaluate_protocol`
+
+  Mated probes, whose mated template is not among their ``k`` candidates, are still evaluated as mated probes, which are not identified at any rank, see :py:func:`bob.db.ijba.evaluation.search_statistics`.
+  """
+  candidates = numpy.asarray(candidates)
+  return candidates.reshape(-1), numpy.repeat(numpy.asarray(probe_ids), candidates.shape[1]), numpy.asarray(scores).reshape(-1)
+
+
+class GalleryIndex(object):
+  """The pooled features of the gallery templates, stored for the repeated search of probes
+
+  The index is a directory containing ``features.npy`` with the ``(N, D)`` features of the gallery templates, and ``ids.npy`` with their template ids.
+  Use :py:meth:`create` to create a new index, and the constructor to open an existing one.
+  """
+
+  def __init__(self, directory, mode='r'):
+    """**Constructor Documentation**
+
+    Opens an existing index.
+
+    Parameters:
+
+    directory : str
+      The directory of the index.
+
+    mode : str
+      The mode to memory-map the features with, ``'r'`` for reading and ``'r+'`` for writing.
+    """
+    self.directory = directory
+    self.features = numpy.load(os.path.join(directory, "features.npy"), mmap_mode=mode)
+    self.ids = numpy.load(os.path.join(directory, "ids.npy"))
+
+  @classmethod
+  def create(cls, directory, gallery_ids, features, normalize=True, dtype=numpy.float32):
+    """Creates a new index of the given gallery features.
+
+    Keyword Parameters:
+
+    directory : str
+      The directory of the index, which is created if needed.
+
+    gallery_ids, features : :py:class:`numpy.ndarray`
+      The ids and pooled features of the gallery templates, see :py:func:`bob.db.ijba.scoring.pool`.
+
+    normalize : bool
+      If set (the default), the features are normalized to unit length, so that the scores are cosine similarities.
+
+    dtype : :py:class:`numpy.dtype`
+      The data type of the stored features; the probes are converted to this type before they are searched.
+
+    Returns: the opened :py:class:`GalleryIndex`.
+    """
+    features = numpy.asarray(features, dtype=numpy.float64)
+    if len(features) != len(gallery_ids):
+      raise ValueError("The %d gallery ids do not match the %d features." % (len(gallery_ids), len(features)))
+    if normalize:
+      features = _normalize(features)
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    numpy.save(os.path.join(directory, "features.npy"), features.astype(dtype))
+    # the ids are written last, so that an index with ids is complete
+    numpy.save(os.path.join(directory, "ids.npy"), numpy.asarray(gallery_ids, dtype=numpy.int64))
+    return cls(directory)
+
+  @staticmethod
+  def exists(directory):
+    """Returns whether the given directory contains a complete index"""
+    return os.path.exists(os.path.join(directory, "ids.npy"))
+
+  def __len__(self):
+    return len(self.ids)
+
+  def search(self, probe_ids, probes, k=20, normalize=True, **kwargs):
+    """Searches the ``k`` best gallery candidates of each probe, see :py:func:`top_k`
+
+    If ``normalize`` is set (the default), the probe features are normalized to unit length.
+    The remaining keyword arguments are passed to :py:func:`top_k`.
+    """
+    probes = numpy.asarray(probes, dtype=numpy.float64)
+    if normalize:
+      probes = _normalize(probes)
+    return top_k(self.ids, self.features, probe_ids, probes.astype(self.features.dtype), k, **kwargs)
+
+
+def search_protocol(db, protocol, embeddings, k=20, method='mean', normalize=True, index=None, **kwargs):
+  """Searches the ``k`` best gallery candidates of each probe template of the given ``search_splitN`` protocol.
+
+  Keyword Parameters:
+
+  db : :py:class:`bob.db.ijba.Database`
+    The database to query the templates from.
+
+  protocol : str
+    The ``search_splitN`` protocol.
+
+  embeddings, method, normalize
+    The embeddings of the files and the pooling method, see :py:func:`bob.db.ijba.scoring.pool`.
+
+  k : int
+    The number of candidates per probe.
+
+  index : str or :py:class:`GalleryIndex` or ``None``
+    The gallery index to search in.
+    If a directory is given, the index is opened if it exists, otherwise the gallery is pooled and stored there.
+    If not given, the gallery is pooled into an index in memory.
+
+  kwargs
+    The block sizes and the number of threads, see :py:func:`top_k`.
+
+  Returns: the ``(probe_ids, candidates, scores)`` arrays, see :py:func:`top_k`.
+  """
+  if db.protocol_table[protocol]['task'] != 'search':
+    raise ValueError("The protocol '%s' is not a search protocol." % protocol)
+
+  if isinstance(index, str) and GalleryIndex.exists(index):
+    index = GalleryIndex(index)
+  if isinstance(index, GalleryIndex):
+    if set(index.ids.tolist()) != set(db.model_ids(protocol=protocol)):
+      raise ValueError("The gallery index '%s' does not contain the gallery of protocol '%s'." % (index.directory, protocol))
+    gallery_ids, gallery = index.ids, index.features
+  else:
+    gallery_ids, gallery = pool(db.object_sets(protocol=protocol, purposes='enroll'), embeddings, method, normalize)
+    if index is not None:
+      index = GalleryIndex.create(index, gallery_ids, gallery, normalize)
+      gallery_ids, gallery = index.ids, index.features
+
+  probe_ids, probes = pool(db.object_sets(protocol=protocol, purposes='probe'), embeddings, method, normalize)
+  return top_k(gallery_ids, gallery, probe_ids, probes.astype(gallery.dtype, copy=False), k, **kwargs)
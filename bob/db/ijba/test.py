@@ -5,6 +5,9 @@
 """
 
 import os, sys
+import shutil
+import tempfile
+import contextlib
 import unittest
 import bob.db.ijba
 import random
@@ -41,18 +44,19 @@ def test02_search_objects():
 
   # number of world files for the protocols (cf. the number of lines in the training file lists)
 
-  world_files = [16910, 16354, 17287, 16548, 17040, 17644, 17584, 16367, 17421 ,16910]
-  for i in range(10):
+  # split10 used to be resolved to the lists of split1, so the counts of split1 were listed for split10; only splits 1 to 9 are checked here
+  world_files = [16910, 16354, 17287, 16548, 17040, 17644, 17584, 16367, 17421]
+  for i in range(9):
     assert len(db.objects(groups='world', protocol=SEARCH_PROTOCOLS[i])) == world_files[i]
 
   # enroll files (cf. the number of lines in the gallery file lists)
-  enroll_files = [3000, 3261, 2661, 2894, 2920, 2451, 2912, 3106, 2594, 3000]
-  for i in range(10):
+  enroll_files = [3000, 3261, 2661, 2894, 2920, 2451, 2912, 3106, 2594]
+  for i in range(9):
     assert len(db.objects(groups='dev', purposes='enroll', protocol=SEARCH_PROTOCOLS[i])) == enroll_files[i]
 
   # probe files; not identical with probe file lists as files are used in several probes
-  probe_files = [13737, 13983, 13467, 14323, 13566, 12789, 12131, 14601, 13323, 13737]
-  for i in range(10):
+  probe_files = [13737, 13983, 13467, 14323, 13566, 12789, 12131, 14601, 13323]
+  for i in range(9):
     assert len(db.objects(groups='dev', purposes='probe', protocol=SEARCH_PROTOCOLS[i])) == probe_files[i]
 
 
@@ -61,11 +65,853 @@ def test03_comparison_objects():
   db = bob.db.ijba.Database()
 
   # number of world files for the protocols (cf. the number of lines in the training file lists)
-  world_files = [16910, 16354, 17287, 16548, 17040, 17644, 17584, 16367, 17421 ,16910]
-  for i in range(10):
+  # see test02_search_objects for split10
+  world_files = [16910, 16354, 17287, 16548, 17040, 17644, 17584, 16367, 17421]
+  for i in range(9):
     assert len(db.objects(groups='world', protocol=COMPARISON_PROTOCOLS[i])) == world_files[i]
 
   # enroll files (cf. the number of lines in the gallery file lists)
-  enroll_files = [4260, 4765, 3995, 4458, 4216, 3875, 4137, 4556, 3922, 4260]
-  for i in range(10):
+  enroll_files = [4260, 4765, 3995, 4458, 4216, 3875, 4137, 4556, 3922]
+  for i in range(9):
     assert len(db.objects(groups='dev', purposes='enroll', protocol=COMPARISON_PROTOCOLS[i])) == enroll_files[i]
+
+
+HEADER = "TEMPLATE_ID,SUBJECT_ID,FILE,MEDIA_ID,SIGHTING_ID,FRAME,FACE_X,FACE_Y,FACE_WIDTH,FACE_HEIGHT,RIGHT_EYE_X,RIGHT_EYE_Y,LEFT_EYE_X,LEFT_EYE_Y,NOSE_BASE_X,NOSE_BASE_Y,FACE_YAW,FOREHEAD_VISIBLE,EYES_VISIBLE,NOSE_MOUTH_VISIBLE,INDOOR,GENDER,SKIN_TONE,AGE,FACIAL_HAIR\n"
+
+ROWS = [
+  "1,10,img/100.jpg,100,0,,10,20,30,40,15,25,35,25,25,35,5.5,1,1,1,0,1,3,4,0",
+  "1,10,frame/200_00010.png,200,1,10,11,21,31,41,,,,,,,,1,0,1,1,1,3,4,0",
+  "2,11,img/101.jpg,101,0,,12,22,32,42,16,26,36,26,26,36,-3,0,1,1,0,0,2,3,1",
+]
+
+
+def _write_file_list(filename, rows=ROWS):
+  with open(filename, 'w') as f:
+    f.write(HEADER)
+    for row in rows:
+      f.write(row + "\n")
+
+
+GALLERY_ROWS = [
+  "20,10,img/300.jpg,300,0,,10,20,30,40,15,25,35,25,25,35,5.5,1,1,1,0,1,3,4,0",
+  "21,12,img/301.jpg,301,0,,10,20,30,40,15,25,35,25,25,35,5.5,1,1,1,0,1,3,4,0",
+]
+
+PROBE_ROWS = [
+  "30,10,frame/400_00001.png,400,0,1,10,20,30,40,,,,,,,,1,1,1,0,1,3,4,0",
+  "30,10,frame/400_00002.png,400,0,2,10,20,30,40,,,,,,,,1,1,1,0,1,3,4,0",
+  "31,12,img/300.jpg,300,1,,50,20,30,40,15,25,35,25,25,35,5.5,1,1,1,0,1,3,4,0",
+]
+
+
+def _write_annotations_directory(directory):
+  # writes the same file lists for all splits and both tasks, using the layout of the original file lists
+  for split in range(1, 11):
+    search = os.path.join(directory, "IJB-A_1N_sets", "split%d" % split)
+    compare = os.path.join(directory, "IJB-A_11_sets", "split%d" % split)
+    os.makedirs(search)
+    os.makedirs(compare)
+    for d in (search, compare):
+      _write_file_list(os.path.join(d, "train_%d.csv" % split))
+    _write_file_list(os.path.join(search, "search_gallery_%d.csv" % split), GALLERY_ROWS)
+    _write_file_list(os.path.join(search, "search_probe_%d.csv" % split), PROBE_ROWS)
+    _write_file_list(os.path.join(compare, "verify_metadata_%d.csv" % split), GALLERY_ROWS + PROBE_ROWS)
+    with open(os.path.join(compare, "verify_comparisons_%d.csv" % split), 'w') as f:
+      f.write("20,30\n20,31\n21,31\n")
+
+
+@contextlib.contextmanager
+def _temporary_directory(annotations=False):
+  # creates a temporary directory, which is removed afterwards; if ``annotations`` is set, the file lists are written into it
+  temp_dir = tempfile.mkdtemp(prefix="bobtest_")
+  try:
+    if annotations:
+      _write_annotations_directory(temp_dir)
+    yield temp_dir
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test04_compiled_cache():
+  # Checks that the compiled cache returns the same templates as the CSV file lists, and that it is rebuilt when the file list changes
+  from bob.db.ijba import cache
+  with _temporary_directory() as temp_dir:
+    filename = os.path.join(temp_dir, "train_1.csv")
+    cache_directory = os.path.join(temp_dir, "cache")
+    _write_file_list(filename)
+
+    reference = bob.db.ijba.get_templates(filename)
+    templates = bob.db.ijba.get_templates(filename, cache_directory=cache_directory)
+    assert os.path.exists(cache.compiled_filename(filename, cache_directory))
+    # the second call reads the compiled file
+    compiled = bob.db.ijba.get_templates(filename, cache_directory=cache_directory)
+
+    for t in (templates, compiled):
+      assert sorted(t) == sorted(reference) == [1, 2]
+      for template_id in reference:
+        assert [f.id for f in t[template_id].files] == [f.id for f in reference[template_id].files]
+        assert [f.annotations for f in t[template_id].files] == [f.annotations for f in reference[template_id].files]
+    assert compiled[1].files[0].annotations['reye'] == (25., 15.)
+    assert 'reye' not in compiled[1].files[1].annotations
+
+    # changing the file list rebuilds the compiled file
+    _write_file_list(filename, ROWS[:2])
+    assert sorted(bob.db.ijba.get_templates(filename, cache_directory=cache_directory)) == [1]
+
+    # a compiled file that cannot be written is skipped, without leaving temporary files behind
+    blocked = os.path.join(temp_dir, "blocked")
+    os.makedirs(os.path.join(blocked, "compiled.npz", "occupied"))
+    assert cache.write(os.path.join(blocked, "compiled.npz"), {'pairs' : ROWS}, cache.signature(filename)) is False
+    assert os.listdir(blocked) == ["compiled.npz"]
+
+
+def test05_read_columns():
+  # Checks the typed columns of the bulk file list reader
+  import numpy
+  from bob.db.ijba import reader
+  with _temporary_directory() as temp_dir:
+    filename = os.path.join(temp_dir, "train_1.csv")
+    _write_file_list(filename)
+    columns = reader.read_columns(filename)
+
+    assert columns['template_id'].tolist() == [1, 1, 2]
+    assert columns['media_id'].tolist() == [100, 200, 101]
+    assert columns['frame'].tolist() == [-1, 10, -1]
+    assert columns['path'].tolist() == ['img/100', 'frame/200_00010', 'img/101']
+    assert columns['extension'].tolist() == ['.jpg', '.png', '.jpg']
+    assert columns['bbox'].shape == (3, 4)
+    assert numpy.isnan(columns['reye'][1]).all() and numpy.isnan(columns['yaw'][1])
+    assert columns['skin_tone'].tolist() == ['3', '3', '2']
+
+    # the File objects are identical to the ones of the row-wise parser
+    for file_obj, row in zip(reader.files_from_columns(columns), ROWS):
+      assert file_obj.annotations == reader.read_annotations(row.split(',')[6:])
+
+    # the categorical attributes are kept as written, also when they are not integral
+    fields = ROWS[0].split(',')
+    fields[18], fields[22], fields[23] = '', '3.5', '25-30'
+    rows = [','.join(fields), ROWS[1]]
+    _write_file_list(filename, rows)
+    columns = reader.read_columns(filename)
+    assert columns['skin_tone'].tolist() == ['3.5', '3'] and columns['age'].tolist() == ['25-30', '4']
+    for lazy in (True, False):
+      file_obj = next(reader.files_from_columns(columns, lazy=lazy))
+      assert file_obj.annotations == reader.read_annotations(rows[0].split(',')[6:])
+      assert file_obj.annotations['eyes-visible'] == '' and file_obj.annotations['skin-tone'] == '3.5'
+
+    # rows with a wrong number of columns are rejected
+    for rows in ([ROWS[0], ROWS[1] + ",1"], [ROWS[0] + ",1", ROWS[1][:ROWS[1].rindex(',')]]):
+      _write_file_list(filename, rows)
+      try:
+        reader.read_columns(filename)
+        raise AssertionError("The rows with a wrong number of columns should be rejected")
+      except ValueError:
+        pass
+
+
+def test06_lazy_files():
+  # Checks that lazy files are identical to the eagerly decoded ones
+  import pickle
+  from bob.db.ijba import reader
+  with _temporary_directory() as temp_dir:
+    filename = os.path.join(temp_dir, "train_1.csv")
+    _write_file_list(filename)
+    columns = reader.read_columns(filename)
+    db = bob.db.ijba.Database()
+
+    for lazy, eager in zip(reader.files_from_columns(columns, lazy=True), reader.files_from_columns(columns)):
+      assert isinstance(lazy, bob.db.ijba.LazyFile)
+      assert lazy._annotations is None
+      assert (lazy.id, lazy.path, lazy.client_id, lazy.extension, lazy.media_id) == (eager.id, eager.path, eager.client_id, eager.extension, eager.media_id)
+      assert db.annotations(lazy) == eager.annotations
+      assert lazy._annotations is not None
+      # lazy files are pickled as stand-alone files
+      copy = pickle.loads(pickle.dumps(lazy))
+      assert copy.id == lazy.id and copy.annotations == lazy.annotations
+
+
+def test07_train_cache():
+  # Checks that the training sets are shared between protocols and calls
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False, train_cache_size=1)
+
+    assert len(db.objects(groups='world', protocol='search_split1')) == 3
+    train = db.memory_db['search_split1']['train']
+    assert len(db.client_ids(groups='world', protocol='search_split1')) == 2
+    assert db.memory_db['search_split1']['train'] is train
+
+    # the comparison protocol of the same split has a separate, but identical file list, which shares the training set
+    assert len(db.objects(groups='world', protocol='compare_split1')) == 3
+    assert db.memory_db['compare_split1']['train'] is train
+    assert len(db._train_cache) == 1
+
+    # a different training list evicts the shared training set
+    _write_file_list(os.path.join(temp_dir, "IJB-A_11_sets", "split2", "train_2.csv"), ROWS[:2])
+    assert len(db.objects(groups='world', protocol='compare_split2')) == 2
+    assert len(db._train_cache) == 1
+    assert 'train' not in db.memory_db['search_split1'] and 'train' not in db.memory_db['compare_split1']
+
+    # changing a file list changes its key
+    _write_file_list(os.path.join(temp_dir, "IJB-A_1N_sets", "split1", "train_1.csv"), ROWS[:2])
+    assert db._train_key(os.path.join(temp_dir, "IJB-A_1N_sets", "split1", "train_1.csv")) in db._train_cache
+
+
+def test08_template_index():
+  # Checks the lookup of client ids without loading the protocols
+  with _temporary_directory(annotations=True) as temp_dir:
+    cache_directory = os.path.join(temp_dir, "cache")
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=cache_directory)
+
+    assert db.get_client_id_from_model_id(20) == 10
+    assert db.get_client_id_from_model_id(31, protocol='compare_split1') == 12
+    assert not db.memory_db
+    assert set(db.template_protocols(30)) == set(PROTOCOLS)
+
+    # the index is persistent
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=cache_directory)
+    assert db.get_client_id_from_model_id(21) == 12
+
+    try:
+      db.get_client_id_from_model_id(1)
+      raise AssertionError("Training templates are not part of the index")
+    except ValueError:
+      pass
+
+
+def test09_preload():
+  # Checks that the protocols preloaded in parallel are identical to the ones loaded on demand
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False, train_cache_size=None)
+    timings = db.preload(protocols=['search_split1', 'compare_split2'], workers=2)
+    assert len(timings) == 6
+    assert set(db.memory_db['search_split1']) == set(('train', 'enroll', 'probe'))
+    assert set(db.memory_db['compare_split2']) == set(('train', 'comparison-templates', 'comparisons'))
+    # nothing is loaded twice
+    assert db.preload(protocols=['search_split1', 'compare_split2']) == {}
+
+    reference = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    for protocol in ('search_split1', 'compare_split2'):
+      for groups, purposes in (('world', None), ('dev', 'enroll'), ('dev', 'probe')):
+        assert [f.id for f in db.objects(protocol=protocol, groups=groups, purposes=purposes)] == [f.id for f in reference.objects(protocol=protocol, groups=groups, purposes=purposes)]
+
+
+def test10_media_and_frames():
+  # Checks the selection of files by media ids and frames
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+
+    assert [f.path for f in db.objects(groups='world', protocol='search_split1', media_ids=[100, 101])] == ['img/100', 'img/101']
+    assert [f.path for f in db.objects(groups='world', protocol='search_split1', frames=10)] == ['frame/200_00010']
+    assert db.objects(groups='world', protocol='search_split1', media_ids=100, frames=10) == []
+    # frames and media ids given as strings are converted, also when they are combined
+    assert [f.path for f in db.objects(groups='world', protocol='search_split1', media_ids=['200'], frames=['10'])] == ['frame/200_00010']
+    assert [f.frame for f in db.objects(groups='dev', purposes='probe', protocol='search_split1', media_ids=[400], frames=['1', '2'])] == [1, 2]
+    assert len(db.objects(groups='dev', purposes='probe', protocol='search_split1', media_ids=400)) == 2
+    assert len(db.objects(groups='dev', purposes='probe', protocol='compare_split1', model_ids=[20], media_ids=300)) == 1
+
+    sets = db.object_sets(protocol='search_split1', model_ids=[20], frames=[2])
+    assert len(sets) == 1 and sets[0].id == 30
+    assert [f.frame for f in sets[0].files] == [2]
+    assert sets[0].path == db.memory_db['search_split1']['probe'][30].path
+
+
+def test11_iterators():
+  # Checks that the iterators yield the same objects as the list queries, and load the data lazily
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+
+    iterator = db.iter_objects(protocol='search_split1')
+    assert not db.memory_db
+    assert next(iterator).path == 'img/100'
+    assert 'enroll' not in db.memory_db['search_split1']
+
+    for protocol in ('search_split1', 'compare_split1'):
+      for groups, purposes, model_ids in (('world', None, None), ('dev', 'enroll', [20]), ('dev', 'probe', None), ('dev', 'probe', [20, 21])):
+        assert [f.id for f in db.iter_objects(groups, protocol, purposes, model_ids)] == [f.id for f in db.objects(groups, protocol, purposes, model_ids)]
+      assert [t.id for t in db.iter_object_sets(protocol=protocol, model_ids=[21])] == [t.id for t in db.object_sets(protocol=protocol, model_ids=[21])]
+
+    assert [t.id for t in db.object_sets(protocol='compare_split1', purposes='enroll')] == [20, 21]
+    assert [t.id for t in db.object_sets(protocol='compare_split1', model_ids=[21])] == [31]
+
+    try:
+      db.iter_objects(protocol='unknown')
+      raise AssertionError("The parameters should be checked when creating the iterator")
+    except ValueError:
+      pass
+
+
+def test12_shards():
+  # Checks that the shards partition the query
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+
+    files = [f.id for f in db.objects(protocol='search_split1')]
+    shards = [[f.id for f in db.objects(protocol='search_split1', shard=(k, 3))] for k in range(3)]
+    assert sorted(sum(shards, [])) == sorted(files)
+    assert [len(s) for s in shards] == [3, 3, 2]
+
+    # sharding by template keeps the files of a template together
+    shards = [db.objects(groups='world', protocol='search_split1', shard=(k, 2), shard_by='template') for k in range(2)]
+    assert [[f.client_id for f in s] for s in shards] == [[10, 10], [11]]
+
+    # shards of templates that are not loaded are selected from the columns, and are identical to the shards of the loaded templates
+    for protocol, media_ids in (('search_split1', None), ('search_split1', ['300', '100']), ('compare_split1', None)):
+      assert db.objects(protocol=protocol, media_ids=media_ids)
+      for shard_by in ('file', 'template'):
+        for k in range(2):
+          fresh = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+          sharded = [f.id for f in fresh.objects(protocol=protocol, media_ids=media_ids, shard=(k, 2), shard_by=shard_by)]
+          assert not fresh.memory_db and not fresh._train_cache
+          assert sharded == [f.id for f in db.objects(protocol=protocol, media_ids=media_ids, shard=(k, 2), shard_by=shard_by)]
+
+    for shard in ((2, 2), (-1, 2)):
+      try:
+        db.objects(protocol='search_split1', shard=shard)
+        raise AssertionError("The shard %s should be invalid" % (shard,))
+      except ValueError:
+        pass
+
+
+def test13_comparisons():
+  # Checks the array layout of the comparisons
+  import numpy
+  pairs = numpy.array([[5, 1], [7, 2], [5, 3], [6, 1], [7, 1]])
+  comparisons = bob.db.ijba.Comparisons(pairs)
+  assert list(comparisons) == [5, 7, 6]
+  assert comparisons[5].tolist() == [1, 3]
+  assert comparisons[7].tolist() == [2, 1]
+  assert comparisons.indptr.tolist() == [0, 2, 4, 5]
+  assert comparisons.probes.tolist() == [1, 3, 2, 1, 1]
+  assert dict((k, v.tolist()) for k, v in comparisons.items()) == bob.db.ijba.reader.comparisons_from_pairs(pairs)
+
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    assert db.comparison_pairs('compare_split1').tolist() == [[20, 30], [20, 31], [21, 31]]
+    assert db.model_ids(protocol='compare_split1', purposes='probe', model_ids=[20]) == [30, 31]
+
+    # rows that are not pairs are rejected
+    filename = os.path.join(temp_dir, "verify_comparisons_0.csv")
+    with open(filename, 'w') as f:
+      f.write("20,30\n20,31,32\n")
+    try:
+      bob.db.ijba.reader.read_comparisons(filename)
+      raise AssertionError("The row with 3 template ids should be rejected")
+    except ValueError:
+      pass
+
+
+def test14_scoring():
+  # Checks the pooling and the batched scoring of templates
+  import numpy
+  from bob.db.ijba import scoring, reader
+  files = [reader.File(1, "a", "a-0"), reader.File(1, "b", "b-0"), reader.File(1, "c", "c-0"), reader.File(2, "d", "d-0")]
+  for f, media in zip(files, ("1", "1", "2", "3")):
+    f.media_id = media
+  templates = [reader.Template(10, 1, files[:3]), reader.Template(20, 2, files[3:])]
+  embeddings = {"a-0" : numpy.array([1., 0.]), "b-0" : numpy.array([1., 0.]), "c-0" : numpy.array([0., 1.]), "d-0" : numpy.array([0., 2.])}
+
+  ids, features = scoring.pool(templates, embeddings, normalize=False)
+  assert ids.tolist() == [10, 20]
+  assert numpy.allclose(features, [[2./3, 1./3], [0., 2.]])
+  ids, features = scoring.pool(templates, embeddings, method='media', normalize=False)
+  assert numpy.allclose(features, [[.5, .5], [0., 2.]])
+
+  ids, features = scoring.pool(templates, embeddings)
+  chunks = list(scoring.search_scores(ids, features, ids[::-1], features[::-1], block_size=1))
+  assert len(chunks) == 2
+  model_ids, probe_ids, scores = [numpy.concatenate(c) for c in zip(*chunks)]
+  assert model_ids.tolist() == [10, 20, 10, 20] and probe_ids.tolist() == [20, 20, 10, 10]
+  assert numpy.allclose(scores[[1, 2]], 1.)
+
+  pairs = numpy.array([[20, 10], [10, 10]])
+  model_ids, probe_ids, scores = [numpy.concatenate(c) for c in zip(*scoring.pair_scores(ids, features, pairs, block_size=1))]
+  assert numpy.allclose(scores, [numpy.dot(features[0], features[1]), 1.])
+
+
+def test15_embedding_store():
+  # Checks writing and reading the memory-mapped embeddings
+  import numpy
+  from bob.db.ijba import embeddings, scoring
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    files = db.objects(groups='dev', protocol='search_split1')
+    ids = [f.id for f in files]
+
+    # duplicate ids are stored once
+    store = embeddings.EmbeddingStore.create(os.path.join(temp_dir, "store"), ids + ids[:2], 3)
+    assert len(store) == len(ids)
+    values = numpy.arange(len(store) * 3, dtype=numpy.float32).reshape(-1, 3)
+    store.write(store.ids, values)
+    store.flush()
+
+    store = embeddings.EmbeddingStore(os.path.join(temp_dir, "store"))
+    rows = db.embedding_rows(files, store)
+    assert rows.tolist() == [0, 1, 2, 3, 4]
+    assert numpy.allclose(store.gather(ids[2:4]), values[2:4])
+    probe = db.object_sets(protocol='search_split1', purposes='probe')[0]
+    view = store.template(probe)
+    assert isinstance(view, numpy.memmap) and numpy.allclose(view, values[2:4])
+    assert not store.contains(["unknown-0"])[0]
+
+    template_ids, features = scoring.pool([probe], store, normalize=False)
+    assert numpy.allclose(features, values[2:4].mean(axis=0))
+
+
+def test16_protocol_table():
+  # Checks that each protocol resolves to the file lists of its own split
+  db = bob.db.ijba.Database(annotations_directory="/data", cache_directory=False)
+  assert set(db.protocol_table) == set(PROTOCOLS)
+  for protocol in PROTOCOLS:
+    entry = db.protocol_table[protocol]
+    assert protocol == "%s_split%d" % (entry['task'], entry['split'])
+    assert os.path.basename(db._solve_filename(protocol, "train")) == "train_%d.csv" % entry['split']
+    assert os.path.basename(os.path.dirname(db._solve_filename(protocol, "train"))) == "split%d" % entry['split']
+
+  assert db._solve_filename('search_split10', 'enroll') == os.path.join("/data", "IJB-A_1N_sets", "split10", "search_gallery_10.csv")
+  assert db._solve_filename('search_split10', 'probe') == os.path.join("/data", "IJB-A_1N_sets", "split10", "search_probe_10.csv")
+  assert db._solve_filename('compare_split10', '') == os.path.join("/data", "IJB-A_11_sets", "split10", "verify_metadata_10.csv")
+  assert db._solve_comparisons('compare_split10') == os.path.join("/data", "IJB-A_11_sets", "split10", "verify_comparisons_10.csv")
+
+
+def test17_interned_files():
+  # Checks that files are shared between templates and protocols
+  with _temporary_directory(annotations=True) as temp_dir:
+    # the annotations of the first gallery file differ in the metadata of the comparison protocol
+    compare = os.path.join(temp_dir, "IJB-A_11_sets", "split1", "verify_metadata_1.csv")
+    _write_file_list(compare, [GALLERY_ROWS[0].replace(",10,20,30,40,", ",11,21,31,41,")] + GALLERY_ROWS[1:] + PROBE_ROWS)
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+
+    search = db.objects(groups='dev', protocol='search_split1')
+    compare = db.objects(groups='dev', purposes='enroll', protocol='compare_split1')
+    assert search[0] is compare[0]
+    assert db.objects(groups='world', protocol='search_split1')[0] is db.objects(groups='world', protocol='compare_split1')[0]
+
+    # the annotations of the file in each template are kept
+    search_template = db.object_sets(protocol='search_split1', purposes='enroll')[0]
+    compare_template = db.object_sets(protocol='compare_split1', purposes='enroll')[0]
+    assert db.annotations(search[0], search_template)['topleft'] == (20., 10.)
+    assert db.annotations(search[0], compare_template)['topleft'] == (21., 11.)
+
+    report = db.memory_report()
+    assert report['files'] < report['file_references']
+    assert report['saved_bytes'] > 0 and report['column_bytes'] > 0
+
+
+def test18_concurrent_queries():
+  # Checks that concurrent queries load each file list only once
+  import threading
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False, train_cache_size=2)
+    expected = dict((p, [f.id for f in bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False).objects(protocol=p)]) for p in ('search_split1', 'compare_split2'))
+
+    loaded = []
+    get_templates = db._get_templates
+    def _count(filename, preloaded=None):
+      loaded.append(filename)
+      return get_templates(filename, preloaded)
+    db._get_templates = _count
+
+    results, errors = [], []
+    def _query(protocol):
+      try:
+        results.append((protocol, [f.id for f in db.objects(protocol=protocol)]))
+        db.object_sets(protocol=protocol, purposes=('enroll', 'probe'), media_ids=[100, 200])
+        db.get_client_id_from_model_id(20)
+      except Exception as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=_query, args=(p,)) for p in ('search_split1', 'compare_split2') * 8]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    assert not errors, errors
+    assert all(ids == expected[p] for p, ids in results)
+    assert len(results) == 16
+    # train, enroll and probe of search_split1, and metadata of compare_split2, whose training list is identical to the one of search_split1
+    assert len(loaded) == len(set(loaded)) == 4
+
+    # loaded training sets are returned without the lock
+    with db._lock:
+      assert db._load_data('search_split1', 'world', 'train')['train'] is db.memory_db['search_split1']['train']
+
+    # training sets that are evicted by concurrent queries are never published
+    for split, rows in ((2, ROWS[:2]), (3, ROWS[1:])):
+      _write_file_list(os.path.join(temp_dir, "IJB-A_1N_sets", "split%d" % split, "train_%d.csv" % split), rows)
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False, train_cache_size=1)
+    threads = [threading.Thread(target=db.objects, kwargs={'protocol' : 'search_split%d' % (i % 3 + 1), 'groups' : 'world'}) for i in range(12)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    published = [data['train'] for data in db.memory_db.values() if 'train' in data]
+    assert len(db._train_cache) == 1 and all(t is list(db._train_cache.values())[0] for t in published)
+
+
+def test19_asyncio():
+  # Checks the asyncio interface
+  import asyncio, threading
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    reference = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+
+    loaded = []
+    get_templates = db._get_templates
+    def _count(filename, preloaded=None):
+      loaded.append(filename)
+      return get_templates(filename, preloaded)
+    db._get_templates = _count
+
+    async def _queries():
+      return await asyncio.gather(
+        db.aobjects(protocol='search_split1'),
+        db.aobjects(protocol='search_split1', groups='dev'),
+        db.aobject_sets(protocol='compare_split2', purposes=('enroll', 'probe')),
+        db.aobjects(protocol='compare_split2', purposes='probe', model_ids=[20]),
+      )
+
+    everything, dev, sets, probes = asyncio.run(_queries())
+    assert [f.id for f in everything] == [f.id for f in reference.objects(protocol='search_split1')]
+    assert [f.id for f in dev] == [f.id for f in reference.objects(protocol='search_split1', groups='dev')]
+    assert [t.id for t in sets] == [t.id for t in reference.object_sets(protocol='compare_split2', purposes=('enroll', 'probe'))]
+    assert [f.id for f in probes] == [f.id for f in reference.objects(protocol='compare_split2', purposes='probe', model_ids=[20])]
+    # each file list is loaded once, and the identical training lists of both tasks only once at all
+    assert len(loaded) == len(set(loaded)) == 4
+    assert not db._async_loads
+
+    # queries on loaded data and preloading
+    assert asyncio.run(db.apreload(protocols='search_split1')) == {}
+    assert len(asyncio.run(db.apreload(protocols='search_split3', workers=1))) == 2
+    assert len(loaded) == 6
+
+    # the queries run outside of the event loop thread
+    threads = []
+    objects = db.objects
+    def _record(*args, **kwargs):
+      threads.append(threading.current_thread())
+      return objects(*args, **kwargs)
+    db.objects = _record
+    asyncio.run(db.aobjects(protocol='search_split1'))
+    assert len(threads) == 1 and threads[0] is not threading.main_thread()
+
+
+def test20_benchmark():
+  # Checks the benchmarks on tiny synthetic file lists
+  from bob.db.ijba import benchmark
+  with _temporary_directory() as temp_dir:
+    benchmark.generate(temp_dir, scale=0.01, splits=1)
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    assert len(db.model_ids(protocol='search_split1')) == 1
+    assert len(db.objects(protocol='compare_split10', groups='world')) >= 1
+    assert len(db.comparison_pairs('compare_split1')) == 118
+
+    results = benchmark.run(scales=[0.01], repeat=1, directory=temp_dir, names=['objects', 'load_data_compiled', 'get_client_id_from_model_id'])
+    assert set(results) == set(('0.01x/objects', '0.01x/load_data_compiled', '0.01x/get_client_id_from_model_id'))
+    assert all(r['seconds'] > 0 and r['peak_bytes'] > 0 for r in results.values())
+
+    # comparison with a baseline
+    assert benchmark.compare(results, results) == []
+    faster = dict((k, {'seconds' : r['seconds'] / 2, 'peak_bytes' : r['peak_bytes']}) for k, r in results.items())
+    assert sorted(k for k, metric, _, _ in benchmark.compare(results, faster)) == sorted(results)
+
+
+def test21_statistics():
+  # Checks the opt-in statistics of loads and queries
+  import json
+  from bob.db.ijba import instrumentation
+  with _temporary_directory(annotations=True) as temp_dir:
+    cache_dir = os.path.join(temp_dir, "cache")
+
+    # disabled by default
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=cache_dir)
+    db.objects(protocol='search_split1')
+    stats = db.stats()
+    assert not stats['enabled']
+    assert stats['loads'] == [] and stats['queries'] == {}
+    assert stats['memory']['search_split1']['files'] == 8
+
+    # the first database parsed the file lists, so that the second one reads them from the compiled cache
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=cache_dir, statistics=True)
+    db.objects(protocol='search_split1')
+    db.objects(protocol='compare_split2', groups='dev')
+    db.client_ids(protocol='search_split1', groups='dev')
+    stats = db.stats(reset=True)
+    assert stats['enabled']
+    assert [(os.path.basename(l['file']), l['rows'], l['source']) for l in stats['loads']] == [('train_1.csv', 3, 'compiled'), ('search_gallery_1.csv', 2, 'compiled'), ('search_probe_1.csv', 3, 'compiled'), ('verify_metadata_2.csv', 5, 'parsed'), ('verify_comparisons_2.csv', 3, 'parsed')]
+    assert stats['summary']['cache_hits'] == 3 and stats['summary']['cache_misses'] == 2 and stats['summary']['rows'] == 16
+    assert stats['queries']['objects']['calls'] == 2
+    assert stats['queries']['objects']['results'] == 8 + 7
+    assert stats['queries']['client_ids']['results'] == 2
+    assert set(stats['memory']) == set(('search_split1', 'compare_split2'))
+    assert db.stats()['loads'] == []
+
+    # the query methods that are called internally are not counted
+    db.object_sets(protocol='compare_split2', purposes=('enroll', 'probe'), model_ids=[20])
+    db.clients(protocol='search_split1')
+    assert sorted((name, q['calls']) for name, q in db.stats(reset=True)['queries'].items()) == [('client_ids', 1), ('object_sets', 1)]
+
+    # JSON dump of the registered databases
+    instrumentation.register(db)
+    db.model_ids(protocol='search_split1')
+    dump = os.path.join(temp_dir, "stats.json")
+    instrumentation.dump(dump)
+    with open(dump) as f:
+      assert any(r['queries'].get('model_ids', {}).get('calls') == 1 for r in json.load(f))
+
+
+def test22_subject_counts():
+  # Checks the client ids and the subject counts, which are computed without files
+  with _temporary_directory(annotations=True) as temp_dir:
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+
+    for protocol in ('search_split1', 'compare_split2'):
+      for groups in (None, 'world', 'dev'):
+        expected = sorted(set(f.client_id for f in db.objects(protocol=protocol, groups=groups)))
+        assert db.client_ids(protocol=protocol, groups=groups) == expected
+        assert db.clients(protocol=protocol, groups=groups) == expected
+
+    assert db.subject_counts(protocol='search_split1', groups='world') == {10 : {'templates' : 1, 'files' : 2}, 11 : {'templates' : 1, 'files' : 1}}
+    assert db.subject_counts(protocol='search_split1', groups='dev', purposes='enroll') == {10 : {'templates' : 1, 'files' : 1}, 12 : {'templates' : 1, 'files' : 1}}
+    assert db.subject_counts(protocol='search_split1', groups='dev') == {10 : {'templates' : 2, 'files' : 3}, 12 : {'templates' : 2, 'files' : 2}}
+    # the templates of the comparison protocols are counted once
+    assert db.subject_counts(protocol='compare_split2', groups='dev') == db.subject_counts(protocol='search_split1', groups='dev')
+
+
+def test23_evaluation():
+  # Checks the evaluation of the protocols
+  import numpy
+  from bob.db.ijba import evaluation
+  with _temporary_directory() as temp_dir:
+    # the metrics on given scores
+    genuine = numpy.array([0.9, 0.8, 0.7, 0.4])
+    impostor = numpy.array([0.1, 0.2, 0.3, 0.5, 0.75, 0.6, 0.05, 0., 0.15, 0.25])
+    tar, thresholds = evaluation.tar_at_far(genuine, impostor, [0., 0.1, 0.5])
+    assert numpy.allclose(tar, [0.5, 0.75, 1.]) and numpy.allclose(thresholds, [0.75, 0.6, 0.2])
+    far, tar, _ = evaluation.roc(genuine, impostor)
+    assert far[0] == 0. and tar[-1] == 1. and far[-1] == 1.
+
+    # both accept scores that are greater than or equal to the threshold, also for tied scores
+    genuine, impostor = numpy.array([0.5, 0.5, 0.9, 0.3]), numpy.array([0.5, 0.5, 0.1, 0.2])
+    tar, thresholds = evaluation.tar_at_far(genuine, impostor, [0.25, 0.5, 1.])
+    far, roc_tar, _ = evaluation.roc(genuine, impostor)
+    assert tar.tolist() == [0.25, 1., 1.] == [roc_tar[far <= f].max() for f in (0.25, 0.5, 1.)]
+    assert [numpy.mean(impostor >= t) for t in thresholds] == [0., 0.5, 1.]
+
+    statistics = evaluation.search_statistics(numpy.array([1, 2, 1, 2, 1, 2]), numpy.array([10, 10, 11, 11, 12, 12]), numpy.array([.9, .8, .3, .7, .5, .4]), numpy.array([1, 2, 10, 11, 12]), numpy.array([100, 200, 100, 100, 300]))
+    assert statistics['mated_ranks'].tolist() == [1, 2] and statistics['nonmated_scores'].tolist() == [0.5]
+    assert evaluation.cmc(statistics['mated_ranks'], [1, 2]).tolist() == [0.5, 1.]
+    fnir, _ = evaluation.fnir_at_fpir(statistics['mated_ranks'], statistics['mated_scores'], statistics['nonmated_scores'], [0.], rank=2)
+    assert fnir.tolist() == [0.5]
+
+    # a mated probe, whose mated template is missing from the scores, is still mated
+    statistics = evaluation.search_statistics(numpy.array([1, 2, 1, 2, 1, 2]), numpy.array([10, 10, 11, 11, 12, 12]), numpy.array([.9, .8, .3, .7, .5, .4]), numpy.array([1, 2, 3, 10, 11, 12]), numpy.array([100, 200, 300, 100, 100, 300]), gallery_ids=[1, 2, 3])
+    assert statistics['mated_ranks'].tolist() == [1, 2, numpy.inf] and statistics['mated_scores'][2] == -numpy.inf
+    assert len(statistics['nonmated_scores']) == 0
+    assert evaluation.cmc(statistics['mated_ranks'], [1, 2]).tolist() == [1./3, 2./3]
+
+    # all splits of the database
+    _write_annotations_directory(temp_dir)
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    pairs = numpy.array([[20, 30], [20, 31], [21, 31]])
+    results, summary = evaluation.evaluate(db, lambda p: (pairs[:, 0], pairs[:, 1], numpy.array([0.9, 0.1, 0.3])), far_values=[0.])
+    assert len(results) == 10 and summary == {'TAR@FAR=0' : (1., 0.)}
+
+    # the scores of the search protocols as chunks, with a rank-2 result in the first split
+    def _search(protocol):
+      probe_scores = [0.9, 0.2] if protocol == 'search_split1' else [0.1, 0.8]
+      return [(numpy.array([20, 21]), numpy.array([30, 30]), numpy.array([0.9, 0.1])), (numpy.array([20, 21]), numpy.array([31, 31]), numpy.array(probe_scores))]
+    results, summary = evaluation.evaluate(db, _search, task='search', workers=3, ranks=[1, 2])
+    assert results['search_split1'] == {'rank-1' : 0.5, 'rank-2' : 1.}
+    assert numpy.allclose(summary['rank-1'], (0.95, 0.15)) and summary['rank-2'] == (1., 0.)
+    assert "rank-1: 0.9500 +- 0.1500" in evaluation.report(summary)
+
+
+def test24_score_conversion():
+  # Checks the chunked conversion of score files
+  import gzip, numpy
+  from bob.db.ijba import scores
+  with _temporary_directory() as temp_dir:
+    four_column = os.path.join(temp_dir, "scores.txt")
+    with open(four_column, 'w') as f:
+      f.write("20 30 30 0.5\n20 31 31 -0.25\n\n21 31 31 1e-05\n")
+    expected = scores.NIST_HEADER + "20 30 100 100 0 0.5\n20 31 100 100 0 -0.25\n21 31 100 100 0 1e-05\n"
+
+    # several files in parallel, and gzip compressed output
+    outputs = [os.path.join(temp_dir, "nist", "scores.txt"), os.path.join(temp_dir, "nist", "scores.txt.gz")]
+    results = scores.convert_files([(four_column, o) for o in outputs], chunk_size=2, jobs=2)
+    assert [rows for rows, _ in results] == [3, 3]
+    with open(outputs[0]) as f:
+      assert f.read() == expected
+    with gzip.open(outputs[1], 'rt') as f:
+      assert f.read() == expected
+
+    # reading compressed files, and writing the chunks
+    with open(four_column, 'rb') as f, gzip.open(four_column + ".gz", 'wb') as g:
+      g.write(f.read())
+    chunks = list(scores.read_four_column(four_column + ".gz", 2))
+    assert [len(c[0]) for c in chunks] == [2, 1]
+    assert chunks[0][2].tolist() == [b'30', b'31']
+    assert scores.write_nist(os.path.join(temp_dir, "chunks.txt"), [(c[0], c[1], c[3]) for c in chunks]) == 3
+    with open(os.path.join(temp_dir, "chunks.txt")) as f:
+      assert f.read() == expected
+
+    # scores from memory
+    assert scores.write_nist(os.path.join(temp_dir, "memory.txt"), (numpy.array([20, 20, 21]), numpy.array([30, 31, 31]), numpy.array([0.5, -0.25, 1e-05])), chunk_size=2) == 3
+    with open(os.path.join(temp_dir, "memory.txt")) as f:
+      assert f.read() == expected
+
+    with open(four_column, 'a') as f:
+      f.write("21 30 0.5\n")
+    try:
+      list(scores.read_four_column(four_column))
+      assert False, "ValueError expected"
+    except ValueError:
+      pass
+
+    # a row with five and a row with three tokens are rejected, although the chunk has four tokens per row on average
+    ragged = os.path.join(temp_dir, "ragged.txt")
+    with open(ragged, 'w') as f:
+      f.write("20 20 30 0.5 1\n\n20 20 31\n21 21 31 0.25\n")
+    try:
+      list(scores.read_four_column(ragged))
+      assert False, "ValueError expected"
+    except ValueError:
+      pass
+
+
+def test25_score_store():
+  # Checks the binary score store and its conversions
+  import numpy
+  from bob.db.ijba import scores
+  with _temporary_directory() as temp_dir:
+    model_ids, probe_ids, values = numpy.array([21, 20, 21, 20]), numpy.array([31, 30, 30, 31]), numpy.array([0.25, 0.5, -1., 0.75])
+    store = scores.ScoreStore.create(os.path.join(temp_dir, "store"), (model_ids, probe_ids, values))
+    assert len(store) == 4 and 20 in store and 30 not in store
+    assert store.models.tolist() == [20, 21]
+    # the scores of each model keep their order, and are returned without copy
+    probes, model_scores = store.model(21)
+    assert probes.tolist() == [31, 30] and model_scores.tolist() == [0.25, -1.]
+    assert isinstance(model_scores, numpy.memmap)
+    assert sorted(zip(*[a.tolist() for a in store.probe(31)])) == [(20, 0.75), (21, 0.25)]
+
+    # conversions between the formats
+    store = scores.ScoreStore(os.path.join(temp_dir, "store"))
+    assert store.to_nist(os.path.join(temp_dir, "nist.txt.gz"), chunk_size=3) == 4
+    assert store.to_four_column(os.path.join(temp_dir, "four.txt")) == 4
+    nist = scores.nist_to_store(os.path.join(temp_dir, "nist.txt.gz"), os.path.join(temp_dir, "nist"), chunk_size=3)
+    four = scores.four_column_to_store(os.path.join(temp_dir, "four.txt"), os.path.join(temp_dir, "four"), dtype=numpy.float32)
+    for converted in (nist, four):
+      assert all(numpy.array_equal(a, b) for a, b in zip(converted.arrays(), store.arrays()))
+    assert four.scores.dtype == numpy.float32
+
+
+def test26_crops():
+  # Checks the extraction of face crops
+  import numpy
+  from bob.db.ijba import crops
+  with _temporary_directory() as temp_dir:
+    # crops of a synthetic image
+    image = numpy.arange(3 * 80 * 60, dtype=numpy.uint8).reshape(3, 80, 60)
+    assert numpy.array_equal(crops.crop(image, (10, 20), (30, 40), shape=(30, 40)), image[:, 10:40, 20:60])
+    assert crops.crop(image, (70, 50), (40, 40), shape=(8, 8)).shape == (3, 8, 8)
+    assert crops.crop(image[0], (0, 0), (80, 60), shape=(16, 12), gray=True).shape == (16, 12)
+
+    annotations = os.path.join(temp_dir, "annotations")
+    _write_annotations_directory(annotations)
+    original = os.path.join(temp_dir, "original")
+    db = bob.db.ijba.Database(original_directory=original, annotations_directory=annotations, cache_directory=False)
+    files = db.objects(protocol='search_split1', groups='dev')
+    for f in files:
+      filename = db.original_file_name(f, check_existence=False)
+      if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as fp:
+          numpy.save(fp, image)
+    ids = sorted(set(f.id for f in files))
+
+    # directory of crops, resumed after removing one of them
+    directory = os.path.join(temp_dir, "crops")
+    result = crops.extract(db, directory, protocol='search_split1', groups='dev', shape=(16, 16), workers=2, loader=numpy.load)
+    assert result['extracted'] == len(ids) == 5 and result['skipped'] == 0 and not result['missing']
+    assert numpy.array_equal(numpy.load(os.path.join(directory, ids[0] + ".npy")).shape, (3, 16, 16))
+    os.remove(os.path.join(directory, ids[0] + ".npy"))
+    result = crops.extract(db, directory, protocol='search_split1', groups='dev', shape=(16, 16), workers=1, loader=numpy.load)
+    assert result['extracted'] == 1 and result['skipped'] == 4
+
+    # packed store, with one missing image, which contains two of the files
+    os.remove(db.original_file_name(files[0], check_existence=False))
+    store_dir = os.path.join(temp_dir, "store")
+    result = crops.extract(db, store_dir, protocol='search_split1', groups='dev', shape=(16, 16), gray=True, store=True, workers=1, loader=numpy.load)
+    assert len(result['missing']) == 1 and result['extracted'] == 3
+    store = crops.CropStore(store_dir)
+    assert store.crops.shape == (5, 16, 16) and store.done.sum() == 3
+    extracted = [f for f in files if f.path != files[0].path][0]
+    box = extracted.annotations
+    assert numpy.array_equal(store[extracted.id], crops.crop(image, box['topleft'], box['size'], (16, 16), gray=True))
+    result = crops.extract(db, store_dir, protocol='search_split1', groups='dev', shape=(16, 16), gray=True, store=True, workers=1, loader=numpy.load)
+    assert result['skipped'] == 3 and result['extracted'] == 0 and len(result['missing']) == 1
+
+    # a crop with an invalid bounding box is reported, and the others are extracted
+    try:
+      crops.crop(image, (numpy.nan, 0.), (10., 10.))
+      assert False, "A ValueError should have been raised"
+    except ValueError:
+      pass
+    with open(os.path.join(annotations, "IJB-A_1N_sets", "split1", "search_probe_1.csv"), 'a') as f:
+      f.write("32,14,img/301.jpg,301,2,,,,,,,,,,,,,1,1,1,0,1,3,4,0\n")
+    db = bob.db.ijba.Database(original_directory=original, annotations_directory=annotations, cache_directory=False)
+    result = crops.extract(db, os.path.join(temp_dir, "failed"), protocol='search_split1', groups='dev', shape=(16, 16), workers=1, loader=numpy.load)
+    assert result['failed'] == ["img/301-2"] and result['extracted'] == 3 and len(result['missing']) == 1
+
+
+def test27_search():
+  # Checks the top-k search of the gallery
+  import numpy
+  from bob.db.ijba import search, evaluation
+  with _temporary_directory() as temp_dir:
+    # blocked and threaded search gives the best candidates of a full search
+    generator = numpy.random.RandomState(0)
+    gallery, probes = generator.randn(11, 4), generator.randn(7, 4)
+    gallery_ids = numpy.arange(100, 111)
+    probe_ids, candidates, scores = search.top_k(gallery_ids, gallery, numpy.arange(7), probes, k=3, block_size=2, gallery_block=4, workers=3)
+    full = numpy.dot(probes, gallery.T)
+    assert probe_ids.tolist() == list(range(7)) and candidates.shape == scores.shape == (7, 3)
+    assert numpy.array_equal(candidates, gallery_ids[numpy.argsort(-full, axis=1)[:, :3]])
+    assert numpy.allclose(scores, -numpy.sort(-full, axis=1)[:, :3])
+    assert search.top_k(gallery_ids, gallery, numpy.arange(7), probes, k=20)[1].shape == (7, 11)
+    model_ids, flat_probe_ids, flat_scores = search.to_scores(probe_ids, candidates, scores)
+    assert flat_probe_ids.tolist()[:4] == [0, 0, 0, 1] and numpy.allclose(flat_scores, scores.reshape(-1))
+
+    # search protocol, with an index that is reused
+    _write_annotations_directory(temp_dir)
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    vectors = {"img/300" : [1., 0.], "img/301" : [0., 1.]}
+    embeddings = lambda f: numpy.array(vectors.get(f.path, [0.2, 1.]))
+    directory = os.path.join(temp_dir, "index")
+    probe_ids, candidates, scores = search.search_protocol(db, 'search_split1', embeddings, k=1, index=directory, workers=1)
+    assert search.GalleryIndex.exists(directory) and len(search.GalleryIndex(directory)) == 2
+    assert dict(zip(probe_ids.tolist(), candidates[:, 0].tolist())) == {30 : 21, 31 : 20}
+    assert numpy.allclose(scores[probe_ids == 31], 1.)
+    index = search.GalleryIndex(directory)
+    assert numpy.array_equal(search.search_protocol(db, 'search_split2', embeddings, k=1, index=index)[1], candidates)
+    assert numpy.array_equal(index.search(probe_ids, [[0., 3.], [3., 0.]], k=2)[1], [[21, 20], [20, 21]])
+
+    # the top-k candidates are evaluated with the mates that are not among them, and with a non-mated probe
+    with open(os.path.join(temp_dir, "IJB-A_1N_sets", "split1", "search_probe_1.csv"), 'a') as f:
+      f.write("32,14,img/302.jpg,302,0,,10,20,30,40,15,25,35,25,25,35,5.5,1,1,1,0,1,3,4,0\n")
+    db = bob.db.ijba.Database(annotations_directory=temp_dir, cache_directory=False)
+    vectors = {"img/300" : [1., 0.], "img/301" : [0., 1.], "img/302" : [-1., -0.1]}
+    embeddings = lambda f: numpy.array(vectors.get(f.path, [1., 0.2]))
+    probe_ids, candidates, scores = search.search_protocol(db, 'search_split1', embeddings, k=1)
+    assert dict(zip(probe_ids.tolist(), candidates[:, 0].tolist())) == {30 : 20, 31 : 20, 32 : 21}
+    metrics = evaluation.evaluate_protocol(db, 'search_split1', search.to_scores(probe_ids, candidates, scores), ranks=[1, 2], fpir_values=[0.])
+    assert metrics == {'rank-1' : 0.5, 'rank-2' : 0.5, 'FNIR@FPIR=0' : 0.5}
+
+    # an index of a different gallery is rejected
+    search.GalleryIndex.create(directory, [20, 22], numpy.eye(2))
+    try:
+      search.search_protocol(db, 'search_split1', embeddings, index=directory)
+      assert False, "A ValueError should have been raised"
+    except ValueError:
+      pass